@@ -12,9 +12,13 @@ from pylearn2.datasets.cifar10 import CIFAR10
 
 
 
-def get_nll(x, parzen, batch_size=10):
+def get_nll(x, parzen, batch_size=100):
     """
     Credit: Yann N. Dauphin
+
+    parzen may return either one log-likelihood per example, or an
+    (n_sigmas, n_examples) array of them (see theano_parzen_multi), in which
+    case the returned array has the same leading dimension.
     """
 
     inds = range(x.shape[0])
@@ -27,12 +31,12 @@ def get_nll(x, parzen, batch_size=10):
         nll = parzen(x[inds[i::n_batches]])
         end = time.time()
         times.append(end-begin)
-        nlls.extend(nll)
+        nlls.append(nll)
 
         if i % 10 == 0:
-            print i, numpy.mean(times), numpy.mean(nlls)
+            print i, numpy.mean(times), numpy.mean(numpy.concatenate(nlls, axis=-1))
 
-    return numpy.array(nlls)
+    return numpy.concatenate(nlls, axis=-1)
 
 
 def log_mean_exp(a):
@@ -45,30 +49,77 @@ def log_mean_exp(a):
     return max_ + T.log(T.exp(a - max_.dimshuffle(0, 'x')).mean(1))
 
 
-def theano_parzen(mu, sigma):
+def theano_parzen_multi(mu, sigmas, sample_block_size=1000):
     """
-    Credit: Yann N. Dauphin
+    Parzen window log-likelihood for several sigmas at once.
+
+    Returns a function mapping a batch of examples x to an
+    (len(sigmas), x.shape[0]) array of log-likelihoods. The squared
+    distances are computed as ||x||^2 + ||mu||^2 - 2 x.mu, one block of
+    sample_block_size samples at a time, and the log-sum-exp is accumulated
+    over the blocks, so memory is bounded by
+    len(sigmas) * x.shape[0] * sample_block_size regardless of the number
+    of samples. All the sigmas share the same distance computation.
     """
 
+    sigmas = numpy.asarray(sigmas, dtype=theano.config.floatX).reshape(-1)
+    n_samples = mu.shape[0]
+
     x = T.matrix()
-    mu = theano.shared(mu)
-    a = ( x.dimshuffle(0, 'x', 1) - mu.dimshuffle('x', 0, 1) ) / sigma
-    E = log_mean_exp(-0.5*(a**2).sum(2))
-    Z = mu.shape[1] * T.log(sigma * numpy.sqrt(numpy.pi * 2))
+    start = T.lscalar()
+    stop = T.lscalar()
+    mu_shared = theano.shared(numpy.asarray(mu, dtype=theano.config.floatX))
+    mu_sq = theano.shared(numpy.asarray((mu**2).sum(1), dtype=theano.config.floatX))
+    block = mu_shared[start:stop]
+    d2 = (x**2).sum(1).dimshuffle(0, 'x') + mu_sq[start:stop].dimshuffle('x', 0) \
+            - 2. * T.dot(x, block.T)
+    # the expansion can be slightly negative due to rounding
+    d2 = T.maximum(d2, 0.)
+    a = -0.5 * d2.dimshuffle('x', 0, 1) / T.constant(sigmas ** 2).dimshuffle(0, 'x', 'x')
+    max_ = a.max(2)
+    block_lse = max_ + T.log(T.exp(a - max_.dimshuffle(0, 1, 'x')).sum(2))
+    block_fn = theano.function([x, start, stop], block_lse)
+
+    Z = mu.shape[1] * numpy.log(sigmas * numpy.sqrt(numpy.pi * 2))
+
+    def parzen(x):
+        lse = None
+        for begin in range(0, n_samples, sample_block_size):
+            end = min(begin + sample_block_size, n_samples)
+            cur = block_fn(x, begin, end)
+            if lse is None:
+                lse = cur
+            else:
+                lse = numpy.logaddexp(lse, cur)
+        return lse - numpy.log(n_samples) - Z.reshape(-1, 1)
+
+    return parzen
+
+
+def theano_parzen(mu, sigma, sample_block_size=1000):
+    """
+    Credit: Yann N. Dauphin
 
-    return theano.function([x], E - Z)
+    Single sigma version of theano_parzen_multi.
+    """
 
+    parzen = theano_parzen_multi(mu, [sigma], sample_block_size)
 
-def cross_validate_sigma(samples, data, sigmas, batch_size):
+    return lambda x: parzen(x)[0]
 
-    lls = []
-    for sigma in sigmas:
-        print sigma
-        parzen = theano_parzen(samples, sigma)
-        tmp = get_nll(data, parzen, batch_size = batch_size)
-        lls.append(numpy.asarray(tmp).mean())
-        del parzen
-        gc.collect()
+
+def cross_validate_sigma(samples, data, sigmas, batch_size, sample_block_size=1000):
+    """
+    Evaluates all the sigmas in a single pass over the data and returns the
+    one with the highest mean log-likelihood.
+    """
+
+    parzen = theano_parzen_multi(samples, sigmas, sample_block_size)
+    lls = get_nll(data, parzen, batch_size = batch_size).mean(axis=1)
+    for sigma, ll in zip(sigmas, lls):
+        print sigma, ll
+    del parzen
+    gc.collect()
 
     ind = numpy.argmax(lls)
     return sigmas[ind]
@@ -110,6 +161,8 @@ def main():
     parser.add_argument('-n', '--num_samples', default=10000, type=int)
     parser.add_argument('-l', '--limit_size', default=1000, type=int)
     parser.add_argument('-b', '--batch_size', default=100, type=int)
+    parser.add_argument('-k', '--sample_block_size', default=1000, type=int,
+                            help="Number of samples processed at a time")
     parser.add_argument('-c', '--cross_val', default=10, type=int,
                             help="Number of cross valiation folds")
     parser.add_argument('--sigma_start', default=-1, type=float)
@@ -139,7 +192,8 @@ def main():
     if args.sigma is None:
         valid = get_valid(args.dataset, limit_size = args.limit_size, fold = args.fold)
         sigma_range = numpy.logspace(args.sigma_start, args.sigma_end, num=args.cross_val)
-        sigma = cross_validate_sigma(samples, valid, sigma_range, batch_size)
+        sigma = cross_validate_sigma(samples, valid, sigma_range, batch_size,
+                                     args.sample_block_size)
     else:
         sigma = float(args.sigma)
 
@@ -147,7 +201,7 @@ def main():
     gc.collect()
 
     # fit and evaulate
-    parzen = theano_parzen(samples, sigma)
+    parzen = theano_parzen(samples, sigma, args.sample_block_size)
     ll = get_nll(test.X, parzen, batch_size = batch_size)
     se = ll.std() / numpy.sqrt(test.X.shape[0])
 
@@ -12,11 +12,16 @@ __maintainer__ = "David Warde-Farley"
 __email__ = "pylearn-dev@googlegroups"
 
 import logging
+import Queue
+import threading
 import warnings
 import numpy as np
 
 from theano import config
 from theano import function
+from theano import shared
+from theano import tensor as T
+from theano.ifelse import ifelse
 from theano.compat.python2x import OrderedDict
 from theano.gof.op import get_debug_values
 
@@ -152,6 +157,31 @@ class SGD(TrainingAlgorithm):
     seed : valid argument to np.random.RandomState, optional
         The seed used for the random number generate to be passed to the
         training dataset iterator (if any)
+    discriminator_steps : int, optional
+        Number of discriminator updates to take before each generator
+        update.
+    prefetch_depth : int, optional
+        If greater than 0, training batches are pulled from the dataset
+        iterator by a background thread and up to `prefetch_depth` ready
+        batches are queued ahead of the update functions, so batch
+        assembly overlaps with the compiled Theano step. The cost's
+        on_load_batch callbacks are then run by the background thread
+        as well, so they must depend only on the batch they are given.
+        Defaults to 0 (load each batch synchronously).
+    health_check : str, optional
+        How the parameters are checked for NaN/Inf values during
+        training. 'full' (the default) copies every parameter to the
+        host and scans it at the start and end of each epoch. 'fused'
+        instead folds a single finite-check reduction over the updated
+        parameters into d_func/g_func, accumulating it in a shared flag
+        that is read every `health_check_freq` batches and at the end of
+        each epoch, and monitored as the 'params_nonfinite' channel. The
+        full host-side scan is only run once the flag is raised, to
+        report the offending parameters.
+    health_check_freq : int, optional
+        In 'fused' mode, the number of batches between reads of the
+        health flag. If None, the flag is read only at the end of each
+        epoch.
     """
     def __init__(self, learning_rate, cost=None, batch_size=None,
                  monitoring_batch_size=None, monitoring_batches=None,
@@ -161,8 +191,22 @@ class SGD(TrainingAlgorithm):
                  set_batch_size = False,
                  train_iteration_mode = None, batches_per_iter=None,
                  theano_function_mode = None, monitoring_costs=None,
-                 seed=[2012, 10, 5], discriminator_steps=1):
+                 seed=[2012, 10, 5], discriminator_steps=1,
+                 prefetch_depth=0, health_check='full',
+                 health_check_freq=None):
         self.discriminator_steps = discriminator_steps
+        if prefetch_depth < 0:
+            raise ValueError("prefetch_depth must be non-negative, got " +
+                             str(prefetch_depth))
+        self.prefetch_depth = prefetch_depth
+        if health_check not in ['full', 'fused']:
+            raise ValueError("health_check must be 'full' or 'fused', got " +
+                             str(health_check))
+        if health_check_freq is not None and health_check_freq <= 0:
+            raise ValueError("health_check_freq must be positive, got " +
+                             str(health_check_freq))
+        self.health_check = health_check
+        self.health_check_freq = health_check_freq
 
         if isinstance(cost, (list, tuple, set)):
             raise TypeError("SGD no longer supports using collections of " +
@@ -197,6 +241,7 @@ class SGD(TrainingAlgorithm):
                                  "but not a monitoring dataset.")
         self.termination_criterion = termination_criterion
         self._register_update_callbacks(update_callbacks)
+        self.fused_update_builders = []
         if train_iteration_mode is None:
             train_iteration_mode = 'shuffled_sequential'
         self.train_iteration_mode = train_iteration_mode
@@ -228,6 +273,10 @@ class SGD(TrainingAlgorithm):
                           if np.any(np.isnan(param.get_value()))]
             raise ValueError("These params are NaN: "+str(nan_params))
         self.model = model
+        if self.health_check == 'fused':
+            # Set to 1 by the update functions as soon as an update
+            # produces a non-finite parameter value
+            self.params_nonfinite = sharedX(0., 'params_nonfinite')
 
         self._synchronize_batch_size(model)
         model._test_batch_size = self.batch_size
@@ -299,6 +348,12 @@ class SGD(TrainingAlgorithm):
                                      val=learning_rate,
                                      data_specs=(NullSpace(), ''),
                                      dataset=monitoring_dataset)
+            if self.health_check == 'fused':
+                self.monitor.add_channel(name='params_nonfinite',
+                                         ipt=None,
+                                         val=self.params_nonfinite,
+                                         data_specs=(NullSpace(), ''),
+                                         dataset=monitoring_dataset)
 
             if self.learning_rule:
                 self.learning_rule.add_channels_to_monitor(
@@ -395,6 +450,17 @@ class SGD(TrainingAlgorithm):
                         raise ValueError("debug value of %s contains nans" %
                                 update.name)
 
+            if self.health_check == 'fused':
+                # NaN and Inf both propagate through a sum, so one
+                # reduction over the new values flags any bad parameter.
+                total = sum([T.sum(updates[param]) for param in cur_params])
+                nonfinite = T.or_(T.isnan(total), T.isinf(total))
+                flag = self.params_nonfinite
+                updates[flag] = T.maximum(flag,
+                                          T.cast(nonfinite, flag.dtype))
+
+            for builder in self.fused_update_builders:
+                updates.update(builder(updates))
 
             with log_timing(log, 'Compiling sgd_update'):
                 return function(theano_args,
@@ -402,9 +468,29 @@ class SGD(TrainingAlgorithm):
                                            name='sgd_update',
                                            on_unused_input='ignore',
                                            mode=self.theano_function_mode)
+        self._get_func = get_func
         self.d_func = get_func(1, 0)
         self.g_func = get_func(0, 1)
 
+    def add_fused_updates(self, builder):
+        """
+        Folds extra shared variable updates into d_func and g_func, so
+        they run as part of every SGD step instead of as a separately
+        compiled update callback. If setup has already been called, both
+        functions are recompiled.
+
+        Parameters
+        ----------
+        builder : callable
+            Called with the OrderedDict mapping each shared variable to
+            its updated value within a step; must return an OrderedDict
+            of additional updates.
+        """
+        self.fused_update_builders.append(builder)
+        if hasattr(self, 'd_func'):
+            self.d_func = self._get_func(1, 0)
+            self.g_func = self._get_func(0, 1)
+
     def train(self, dataset):
         """
         Runs one epoch of SGD training on the specified dataset.
@@ -417,10 +503,8 @@ class SGD(TrainingAlgorithm):
             raise Exception("train called without first calling setup")
 
         # Make sure none of the parameters have bad values
-        for param in self.params:
-            value = param.get_value(borrow=True)
-            if np.any(np.isnan(value)) or np.any(np.isinf(value)):
-                raise Exception("NaN in " + param.name)
+        if self.health_check == 'full':
+            self._check_params()
 
         self.first = False
         rng = self.rng
@@ -449,32 +533,73 @@ class SGD(TrainingAlgorithm):
                 rng = rng, num_batches = self.batches_per_iter)
 
         on_load_batch = self.on_load_batch
+        if self.prefetch_depth > 0:
+            # The worker thread runs on_load_batch itself, off the
+            # critical path of the update functions
+            iterator = _PrefetchIterator(iterator, self.prefetch_depth,
+                                         on_load_batch)
+            on_load_batch = []
         i = self.i
-        for batch in iterator:
-            for callback in on_load_batch:
-                callback(*batch)
-            if i == self.discriminator_steps:
-                self.g_func(*batch)
-                i = 0
-            else:
-                self.d_func(*batch)
-                i += 1
-            # iterator might return a smaller batch if dataset size
-            # isn't divisible by batch_size
-            # Note: if data_specs[0] is a NullSpace, there is no way to know
-            # how many examples would actually have been in the batch,
-            # since it was empty, so actual_batch_size would be reported as 0.
-            actual_batch_size = flat_data_specs[0].np_batch_size(batch)
-            self.monitor.report_batch(actual_batch_size)
-            for callback in self.update_callbacks:
-                callback(self)
+        health_check_freq = None
+        if self.health_check == 'fused':
+            health_check_freq = self.health_check_freq
+        try:
+            for batch_idx, batch in enumerate(iterator):
+                for callback in on_load_batch:
+                    callback(*batch)
+                if i == self.discriminator_steps:
+                    self.g_func(*batch)
+                    i = 0
+                else:
+                    self.d_func(*batch)
+                    i += 1
+                # iterator might return a smaller batch if dataset size
+                # isn't divisible by batch_size
+                # Note: if data_specs[0] is a NullSpace, there is no way to
+                # know how many examples would actually have been in the
+                # batch, since it was empty, so actual_batch_size would be
+                # reported as 0.
+                actual_batch_size = flat_data_specs[0].np_batch_size(batch)
+                self.monitor.report_batch(actual_batch_size)
+                for callback in self.update_callbacks:
+                    callback(self)
+                if health_check_freq is not None and \
+                        (batch_idx + 1) % health_check_freq == 0:
+                    self._check_health_flag()
+        finally:
+            if isinstance(iterator, _PrefetchIterator):
+                iterator.close()
 
         # Make sure none of the parameters have bad values
+        if self.health_check == 'full':
+            self._check_params()
+        else:
+            self._check_health_flag()
+        self.i = i
+
+    def _check_params(self):
+        """
+        Scans every parameter on the host and raises an Exception naming
+        the first one that contains a NaN or Inf.
+        """
         for param in self.params:
             value = param.get_value(borrow=True)
             if np.any(np.isnan(value)) or np.any(np.isinf(value)):
                 raise Exception("NaN in " + param.name)
-        self.i = i
+
+    def _check_health_flag(self):
+        """
+        Reads the flag maintained by the fused health check and, if it is
+        raised, falls back to the full scan to report the bad parameter.
+        """
+        if self.params_nonfinite.get_value() == 0:
+            return
+        self._check_params()
+        # The sum of large finite values can overflow, so the flag may be
+        # raised even though every parameter is finite.
+        log.warning('Fused health check raised on overflowing parameter '
+                    'sum, but all parameters are finite. Resetting it.')
+        self.params_nonfinite.set_value(0.)
 
     def continue_learning(self, model):
         """
@@ -491,6 +616,84 @@ class SGD(TrainingAlgorithm):
         else:
             return self.termination_criterion.continue_learning(self.model)
 
+class _PrefetchIterator(object):
+    """
+    Only to be used by SGD.train. Do not use directly.
+    Wraps a dataset iterator so that batches are drawn (and the
+    on_load_batch callbacks run) by a daemon thread, which keeps at most
+    `depth` batches queued ahead of the consumer. Batches are yielded in
+    the order the wrapped iterator produces them, and an exception raised
+    while loading is re-raised in the consuming thread.
+
+    Parameters
+    ----------
+    iterator : iterable
+        The dataset iterator to read batches from.
+    depth : int
+        Maximum number of ready batches to hold in the queue.
+    on_load_batch : list, optional
+        Callbacks to call with each batch before it is queued.
+    """
+
+    _END = object()
+
+    def __init__(self, iterator, depth, on_load_batch=None):
+        assert depth > 0
+        if on_load_batch is None:
+            on_load_batch = []
+        self._queue = Queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        args=(iterator, on_load_batch),
+                                        name='sgd_prefetch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        # Poll so that close() can stop a worker blocked on a full queue
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _run(self, iterator, on_load_batch):
+        try:
+            for batch in iterator:
+                for callback in on_load_batch:
+                    callback(*batch)
+                if not self._put((None, batch)):
+                    return
+        except Exception as e:
+            log.exception('Error while prefetching training batches')
+            self._put((e, None))
+            return
+        self._put((None, self._END))
+
+    def __iter__(self):
+        while True:
+            error, batch = self._queue.get()
+            if error is not None:
+                raise error
+            if batch is self._END:
+                return
+            yield batch
+
+    def close(self):
+        """
+        Stops the worker thread and discards any queued batches.
+        """
+        self._stop.set()
+        while True:
+            try:
+                self._queue.get_nowait()
+            except Queue.Empty:
+                break
+        self._thread.join()
+
+
 class MonitorBasedLRAdjuster(TrainExtension):
     """
     A TrainExtension that uses the on_monitor callback to adjust
@@ -1026,19 +1229,70 @@ class _PolyakWorker(object):
     ----------
     model : a Model
         The model whose parameters we want to train with Polyak averaging
+    average_every : int, optional
+        Only every `average_every`-th SGD step contributes to the average.
+    ema_decay : float, optional
+        If specified, keep an exponential moving average with this decay
+        rate instead of the uniform average.
+    fused : bool, optional
+        If True, no averaging function is compiled; the updates returned
+        by get_updates are meant to be folded into the SGD step with
+        SGD.add_fused_updates.
     """
 
-    def __init__(self, model):
-        avg_updates = OrderedDict()
-        t = sharedX(1.)
+    def __init__(self, model, average_every=1, ema_decay=None, fused=False):
+        self.average_every = average_every
+        self.ema_decay = ema_decay
+        self.fused = fused
+        self.t = sharedX(1.)
         self.param_to_mean = OrderedDict()
         for param in model.get_params():
             mean = sharedX(param.get_value())
             assert type(mean) == type(param)
             self.param_to_mean[param] = mean
-            avg_updates[mean] = mean - (mean - param) / t
-            avg_updates[t] = t + 1.
-        self.avg = function([], updates = avg_updates)
+        self._steps = 0
+        if fused:
+            self._step = shared(np.cast['int64'](0), 'polyak_step')
+        else:
+            self.avg = function([], updates = self.get_updates())
+
+    def get_updates(self, new_values=None):
+        """
+        Returns the updates of the averaged parameters.
+
+        Parameters
+        ----------
+        new_values : dict, optional
+            Maps parameters to their values after the current SGD step.
+            Parameters missing from it are averaged at their current
+            value.
+
+        Returns
+        -------
+        avg_updates : OrderedDict
+            In fused mode, these only take effect on every
+            `average_every`-th call of the function they are compiled
+            into.
+        """
+        if new_values is None:
+            new_values = {}
+        avg_updates = OrderedDict()
+        t = self.t
+        for param, mean in self.param_to_mean.items():
+            value = new_values.get(param, param)
+            if self.ema_decay is None:
+                avg_updates[mean] = mean - (mean - value) / t
+            else:
+                avg_updates[mean] = mean - (1. - self.ema_decay) * \
+                        (mean - value)
+        avg_updates[t] = t + 1.
+        if self.fused and self.average_every > 1:
+            step = self._step
+            average = T.eq((step + 1) % self.average_every, 0)
+            for var in avg_updates:
+                avg_updates[var] = ifelse(average, avg_updates[var], var)
+            avg_updates[step] = step + 1
+        return avg_updates
 
     def __call__(self, algorithm):
         """
@@ -1049,7 +1303,9 @@ class _PolyakWorker(object):
         ----------
         algorithm : WRITEME
         """
-        self.avg()
+        self._steps += 1
+        if self._steps % self.average_every == 0:
+            self.avg()
 
 class PolyakAveraging(TrainExtension):
     """
@@ -1089,6 +1345,18 @@ class PolyakAveraging(TrainExtension):
         WRITEME
     save_freq : int, optional
         WRITEME
+    fused : bool, optional
+        If True, the averaging updates are compiled into the SGD update
+        functions themselves instead of being run by a separate function
+        after every step. The SGD functions are recompiled once, when
+        averaging starts.
+    average_every : int, optional
+        Only fold every `average_every`-th SGD step into the average.
+    ema_decay : float, optional
+        If specified, keep an exponential moving average of the
+        parameters with this decay rate instead of the uniform average
+        over all steps since `start`, so that the average mostly reflects
+        the last 1 / (1 - ema_decay) averaged steps.
 
     Notes
     -----
@@ -1096,12 +1364,17 @@ class PolyakAveraging(TrainExtension):
     rate. It may be used in conjunction with momentum.
     """
 
-    def __init__(self, start, save_path=None, save_freq=1):
+    def __init__(self, start, save_path=None, save_freq=1, fused=False,
+                 average_every=1, ema_decay=None):
         self.__dict__.update(locals())
         del self.self
         self._count = 0
         assert isinstance(start, py_integer_types)
         assert start >= 0
+        assert isinstance(average_every, py_integer_types)
+        assert average_every > 0
+        if ema_decay is not None:
+            assert 0. < ema_decay < 1.
 
     def on_monitor(self, model, dataset, algorithm):
         """
@@ -1115,8 +1388,12 @@ class PolyakAveraging(TrainExtension):
         algorithm : WRITEME
         """
         if self._count == self.start:
-            self._worker = _PolyakWorker(model)
-            algorithm.update_callbacks.append(self._worker)
+            self._worker = _PolyakWorker(model, self.average_every,
+                                         self.ema_decay, self.fused)
+            if self.fused:
+                algorithm.add_fused_updates(self._worker.get_updates)
+            else:
+                algorithm.update_callbacks.append(self._worker)
             #HACK
             try:
                 model.add_polyak_channels(self._worker.param_to_mean,
@@ -3,6 +3,7 @@ import theano.tensor as T
 from pylearn2.costs.cost import Cost
 from theano.printing import Print
 from pylearn2.expr.nnet import softmax_ratio
+from pylearn2.models import mlp
 from pylearn2.models.mlp import MLP
 from pylearn2.utils import block_gradient
 from pylearn2.utils import safe_izip
@@ -11,6 +12,183 @@ from theano.sandbox.rng_mrg import MRG_RandomStreams
 import warnings
 
 
+def softmax_logits(Y_hat):
+    """
+    Returns the input of the softmax that produced Y_hat, looking through
+    a Print op if there is one.
+    """
+
+    assert hasattr(Y_hat, 'owner')
+    owner = Y_hat.owner
+    assert owner is not None
+    op = owner.op
+    if isinstance(op, Print):
+        assert len(owner.inputs) == 1
+        Y_hat, = owner.inputs
+        owner = Y_hat.owner
+        op = owner.op
+    assert isinstance(op, T.nnet.Softmax)
+    z ,= owner.inputs
+    assert z.ndim == 2
+    return z
+
+def fprop_logits(layer, state_below):
+    """
+    Returns the pre-softmax output of a softmax layer. Uses the layer's
+    get_logits method if it has one (see Softmax).
+    """
+
+    if hasattr(layer, 'get_logits'):
+        return layer.get_logits(state_below)
+    return softmax_logits(layer.fprop(state_below))
+
+class Softmax(mlp.Softmax):
+    """
+    A softmax layer whose pre-softmax output can be asked for directly,
+    rather than read back from the graph by softmax_logits.
+    """
+
+    def get_logits(self, state_below):
+
+        self.input_space.validate(state_below)
+
+        if self.needs_reformat:
+            state_below = self.input_space.format_as(state_below,
+                                                     self.desired_space)
+
+        self.desired_space.validate(state_below)
+        assert state_below.ndim == 2
+
+        if not hasattr(self, 'no_affine'):
+            self.no_affine = False
+
+        if self.no_affine:
+            return state_below
+
+        assert self.W.ndim == 2
+        return T.dot(state_below, self.W) + self.b
+
+    def fprop(self, state_below):
+        return T.nnet.softmax(self.get_logits(state_below))
+
+def dropout_schedule(model, default_input_include_prob=.5, input_include_probs=None,
+        default_input_scale=2., input_scales=None):
+    """
+    Returns the (include_prob, scale) pair used to drop the input of each
+    layer of model, looked up by layer name as in MLP.dropout_fprop.
+    """
+
+    if input_include_probs is None:
+        input_include_probs = {}
+
+    if input_scales is None:
+        input_scales = {}
+
+    assert all(layer_name in model.layer_names for layer_name in input_include_probs)
+    assert all(layer_name in model.layer_names for layer_name in input_scales)
+
+    rval = []
+    for layer in model.layers:
+        rval.append((input_include_probs.get(layer.layer_name, default_input_include_prob),
+            input_scales.get(layer.layer_name, default_input_scale)))
+    return rval
+
+def model_dropout_schedule(model):
+    """
+    Returns the (include_prob, scale) pair used to drop the input of each
+    layer by model.fprop(X, apply_dropout=True), or None if the model does
+    not describe its dropout with the dropout_input_include_prob and
+    dropout_include_probs attributes.
+    """
+
+    if not hasattr(model, 'dropout_include_probs') or \
+            not hasattr(model, 'dropout_input_include_prob'):
+        return None
+
+    def default_scale(prob):
+        if prob in [None, 1., 1]:
+            return 1.
+        return 1. / prob
+
+    probs = [model.dropout_input_include_prob] + list(model.dropout_include_probs)
+    scales = getattr(model, 'dropout_scales', None)
+    if scales is None:
+        scales = [default_scale(prob) for prob in model.dropout_include_probs]
+    input_scale = getattr(model, 'dropout_input_scale', None)
+    if input_scale is None:
+        input_scale = default_scale(probs[0])
+    scales = [input_scale] + list(scales)
+
+    # The last entry drops the output of the last layer, which we do not
+    # support
+    if probs[-1] not in [None, 1., 1]:
+        return None
+
+    return zip(probs[:-1], scales[:-1])
+
+def ensemble_and_dropout_logits(model, X, schedule, theano_rng=None):
+    """
+    Returns the logits (z_e, z_d) of model's final softmax layer for the
+    deterministic pass and for a dropout pass.
+
+    The layers before the first one whose input is dropped see the same
+    input in both passes, so they are applied once and their output is
+    shared. This only saves work when the schedule keeps the input of the
+    first layer. DropoutBoosting drops it by default and the esp configs
+    drop it too, so there this is just the two passes. Units are dropped
+    by model.apply_dropout, as in MLP.dropout_fprop. The logits come from
+    the last layer's get_logits method when it has one (see Softmax).
+
+    schedule: a list giving the (include_prob, scale) of the input of
+              each layer (see dropout_schedule)
+    """
+
+    if theano_rng is None:
+        theano_rng = MRG_RandomStreams(max(model.rng.randint(2**15), 1))
+
+    layers = model.layers
+    assert len(schedule) == len(layers)
+
+    def fprop(layer, state):
+        if layer is layers[-1]:
+            return fprop_logits(layer, state)
+        return layer.fprop(state)
+
+    state = X
+    pos = 0
+    while pos < len(layers) and schedule[pos][0] in [None, 1.0, 1]:
+        state = fprop(layers[pos], state)
+        pos += 1
+
+    z_e = state
+    z_d = state
+    for layer, (include_prob, scale) in safe_izip(layers[pos:], schedule[pos:]):
+        z_e = fprop(layer, z_e)
+        z_d = model.apply_dropout(state=z_d, include_prob=include_prob,
+                theano_rng=theano_rng, scale=scale,
+                mask_value=layer.dropout_input_mask_value,
+                input_space=layer.get_input_space())
+        z_d = fprop(layer, z_d)
+
+    return z_e, z_d
+
+def ensemble_and_model_dropout_logits(model, X):
+    """
+    Like ensemble_and_dropout_logits, but drops units the way
+    model.fprop(X, apply_dropout=True) does. Uses two separate
+    model.fprop passes when there is no undropped first layer to share or
+    the model's dropout settings are not understood.
+    """
+
+    schedule = model_dropout_schedule(model)
+    if schedule is None or schedule[0][0] not in [None, 1.0, 1]:
+        z_e = softmax_logits(model.fprop(X))
+        z_d = softmax_logits(model.fprop(X, apply_dropout=True))
+        return z_e, z_d
+    return ensemble_and_dropout_logits(model, X, schedule)
+
+
+
 class BoostTry1(Cost):
     """
     This isn't thought through all that carefully, probably not correct at all
@@ -133,19 +311,7 @@ class BoostTry4(Cost):
         weight = self.get_weight(model, X, Y)
 
         Y_hat = model.fprop(X, apply_dropout=True)
-
-        assert hasattr(Y_hat, 'owner')
-        owner = Y_hat.owner
-        assert owner is not None
-        op = owner.op
-        if isinstance(op, Print):
-            assert len(owner.inputs) == 1
-            Y_hat, = owner.inputs
-            owner = Y_hat.owner
-            op = owner.op
-        assert isinstance(op, T.nnet.Softmax)
-        z ,= owner.inputs
-        assert z.ndim == 2
+        z = softmax_logits(Y_hat)
 
         z = z - z.max(axis=1).dimshuffle(0, 'x')
         log_prob = z - T.log(T.exp(z).sum(axis=1).dimshuffle(0, 'x'))
@@ -165,8 +331,9 @@ class EnsembleLikelihoodTrainOne(Cost):
 
     def __call__(self, model, X, Y, **kwargs):
 
-        Y_hat_e = model.fprop(X)
-        Y_hat = model.fprop(X, apply_dropout=True)
+        z_e, z = ensemble_and_model_dropout_logits(model, X)
+        Y_hat_e = T.nnet.softmax(z_e)
+        Y_hat = T.nnet.softmax(z)
 
         softmax_r = softmax_ratio(Y_hat_e, Y_hat)
 
@@ -176,19 +343,6 @@ class EnsembleLikelihoodTrainOne(Cost):
 
         neg = - neg_terms.sum(axis=1).mean(axis=0)
 
-        assert hasattr(Y_hat, 'owner')
-        owner = Y_hat.owner
-        assert owner is not None
-        op = owner.op
-        if isinstance(op, Print):
-            assert len(owner.inputs) == 1
-            Y_hat, = owner.inputs
-            owner = Y_hat.owner
-            op = owner.op
-        assert isinstance(op, T.nnet.Softmax)
-        z ,= owner.inputs
-        assert z.ndim == 2
-
         z = z - z.max(axis=1).dimshuffle(0, 'x')
         log_prob = z - T.log(T.exp(z).sum(axis=1).dimshuffle(0, 'x'))
         # we use sum and not mean because this is really one variable per row
@@ -207,21 +361,9 @@ class PoE_SameMask(Cost):
 
     def __call__(self, model, X, Y, **kwargs):
 
-        Y_hat_e = model.fprop(X)
-        Y_hat = model.fprop(X, apply_dropout=True)
-
-        assert hasattr(Y_hat, 'owner')
-        owner = Y_hat.owner
-        assert owner is not None
-        op = owner.op
-        if isinstance(op, Print):
-            assert len(owner.inputs) == 1
-            Y_hat, = owner.inputs
-            owner = Y_hat.owner
-            op = owner.op
-        assert isinstance(op, T.nnet.Softmax)
-        z ,= owner.inputs
-        assert z.ndim == 2
+        z_e, z = ensemble_and_model_dropout_logits(model, X)
+        Y_hat_e = T.nnet.softmax(z_e)
+        Y_hat = T.nnet.softmax(z)
 
         z_weight = Y_hat - Y_hat_e
         z_weight = block_gradient(z_weight)
@@ -267,24 +409,12 @@ class DropoutBoosting(Cost):
         del self.self
 
     def __call__(self, model, X, Y, ** kwargs):
-        Y_hat = model.dropout_fprop(X, default_input_include_prob=self.default_input_include_prob,
+        schedule = dropout_schedule(model, default_input_include_prob=self.default_input_include_prob,
                 input_include_probs=self.input_include_probs, default_input_scale=self.default_input_scale,
-                input_scales=self.input_scales
-                )
-        Y_hat_e = model.fprop(X)
-
-        assert hasattr(Y_hat, 'owner')
-        owner = Y_hat.owner
-        assert owner is not None
-        op = owner.op
-        if isinstance(op, Print):
-            assert len(owner.inputs) == 1
-            Y_hat, = owner.inputs
-            owner = Y_hat.owner
-            op = owner.op
-        assert isinstance(op, T.nnet.Softmax)
-        z ,= owner.inputs
-        assert z.ndim == 2
+                input_scales=self.input_scales)
+        z_e, z = ensemble_and_dropout_logits(model, X, schedule)
+        Y_hat_e = T.nnet.softmax(z_e)
+        Y_hat = T.nnet.softmax(z)
 
         z_weight = Y_hat - Y_hat_e
         z_weight = block_gradient(z_weight)
@@ -502,19 +632,7 @@ class LoneRangerDropoutBoosting(Cost):
                 input_include_probs=self.input_include_probs, default_input_scale=self.default_input_scale,
                 input_scales=self.input_scales, scale_ensemble=self.scale_ensemble, dont_drop_input = self.dont_drop_input
                 )
-
-        assert hasattr(Y_hat, 'owner')
-        owner = Y_hat.owner
-        assert owner is not None
-        op = owner.op
-        if isinstance(op, Print):
-            assert len(owner.inputs) == 1
-            Y_hat, = owner.inputs
-            owner = Y_hat.owner
-            op = owner.op
-        assert isinstance(op, T.nnet.Softmax)
-        z ,= owner.inputs
-        assert z.ndim == 2
+        z = softmax_logits(Y_hat)
 
         z_weight = Y_hat - Y_hat_e
         z_weight = block_gradient(z_weight)
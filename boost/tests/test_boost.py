@@ -0,0 +1,101 @@
+import numpy as np
+
+from theano import config
+from theano import function
+import theano.tensor as T
+
+from pylearn2.models.mlp import MLP
+from pylearn2.models.mlp import RectifiedLinear
+
+from galatea.boost import Softmax
+from galatea.boost import dropout_schedule
+from galatea.boost import ensemble_and_dropout_logits
+from galatea.boost import ensemble_and_model_dropout_logits
+from galatea.boost import model_dropout_schedule
+from galatea.boost import softmax_logits
+
+def make_model():
+    return MLP(layers=[RectifiedLinear(dim=7, layer_name='h0', irange=.5),
+                       RectifiedLinear(dim=6, layer_name='h1', irange=.5),
+                       Softmax(n_classes=3, layer_name='y', irange=.5)],
+               nvis=5)
+
+def make_data():
+    rng = np.random.RandomState([2013, 6, 1])
+    return rng.randn(4, 5).astype(config.floatX)
+
+def test_ensemble_logits():
+
+    model = make_model()
+    X = T.matrix()
+    X_val = make_data()
+
+    expected = function([X], softmax_logits(model.fprop(X)))(X_val)
+
+    # with {} the input of h0 is dropped, so nothing is shared; with
+    # {'h0' : 1.} it is kept, so h0 is shared
+    for input_include_probs in [{}, {'h0' : 1.}]:
+        schedule = dropout_schedule(model,
+                input_include_probs=input_include_probs)
+        z_e, z_d = ensemble_and_dropout_logits(model, X, schedule)
+        z_e, z_d = function([X], [z_e, z_d])(X_val)
+        assert z_e.shape == expected.shape
+        assert z_d.shape == expected.shape
+        assert np.allclose(z_e, expected)
+
+def test_no_dropout():
+
+    model = make_model()
+    X = T.matrix()
+    X_val = make_data()
+
+    schedule = dropout_schedule(model, default_input_include_prob=1.,
+            default_input_scale=1.)
+    z_e, z_d = ensemble_and_dropout_logits(model, X, schedule)
+    z_e, z_d = function([X], [z_e, z_d])(X_val)
+
+    assert np.allclose(z_e, z_d)
+    assert np.allclose(z_e, function([X], softmax_logits(model.fprop(X)))(X_val))
+
+def test_shared_prefix_dropout():
+
+    # Only the input of y is dropped. y has identity weights and no bias,
+    # so each logit of the dropout pass is either 0 or scale times the
+    # matching output of h1.
+    model = MLP(layers=[RectifiedLinear(dim=7, layer_name='h0', irange=.5),
+                        RectifiedLinear(dim=3, layer_name='h1', irange=.5),
+                        Softmax(n_classes=3, layer_name='y', irange=.5)],
+                nvis=5)
+    y = model.layers[-1]
+    y.W.set_value(np.identity(3).astype(y.W.dtype))
+    y.b.set_value(np.zeros(3, dtype=y.b.dtype))
+    X = T.matrix()
+    X_val = make_data()
+    scale = 3.
+
+    schedule = dropout_schedule(model,
+            input_include_probs={'h0' : 1., 'h1' : 1.},
+            input_scales={'y' : scale})
+    z_e, z_d = ensemble_and_dropout_logits(model, X, schedule)
+    h1 = model.layers[1].fprop(model.layers[0].fprop(X))
+    z_e, z_d, h1 = function([X], [z_e, z_d, h1])(X_val)
+
+    assert np.allclose(z_e, h1)
+    assert not np.allclose(z_d, z_e)
+    assert np.all(np.isclose(z_d, 0.) | np.isclose(z_d, scale * h1))
+
+def test_model_dropout_schedule_undropped_input():
+
+    model = make_model()
+    model.dropout_input_include_prob = None
+    model.dropout_include_probs = [.5, .25, 1.]
+    X = T.matrix()
+    X_val = make_data()
+
+    schedule = model_dropout_schedule(model)
+    assert schedule == [(None, 1.), (.5, 2.), (.25, 4.)]
+
+    z_e, z_d = ensemble_and_model_dropout_logits(model, X)
+    z_e, z_d = function([X], [z_e, z_d])(X_val)
+    assert np.allclose(z_e, function([X], softmax_logits(model.fprop(X)))(X_val))
+    assert z_d.shape == z_e.shape
@@ -20,7 +20,37 @@ except ImportError:
     print('Failed to import pylearn - clone it from https://hg.assembla.com/pylearn')
     raise
 
+def iter_batches(X, y, batchsize, chunk_rows=None):
+    """
+    Yields (x, y) minibatches of at most batchsize rows, in order. The
+    last batch holds the remaining rows if batchsize does not divide the
+    number of examples.
+
+    If chunk_rows is given, X (and y) only need to support slicing rows,
+    and are read chunk_rows rows at a time with np.asarray, so that X can
+    be a memory mapped matrix or a set of feature shards (see
+    galatea.darpa_imagenet.utils.ShardedArray) larger than RAM.
+    """
+    n = X.shape[0]
+    if chunk_rows is None:
+        chunk_rows = n
+    # keep the batches aligned across chunk boundaries
+    chunk_rows = max(batchsize, chunk_rows - chunk_rows % batchsize)
+    for start in xrange(0, n, chunk_rows):
+        x_chunk = np.asarray(X[start:start+chunk_rows])
+        y_chunk = np.asarray(y[start:start+chunk_rows])
+        for i in xrange(0, x_chunk.shape[0], batchsize):
+            yield x_chunk[i:i+batchsize], y_chunk[i:i+batchsize]
+
 class TheanoSGDClassifier(object):
+    """
+    loss_fn: 'log', 'hinge' (multi-class hinge margin) or 'ovr_hinge'
+             (one binary hinge loss per class, trained one-vs-rest from
+             a single feature pass per batch)
+    chunk_rows: if given, fit streams the training and validation
+             features chunk_rows rows at a time instead of requiring them
+             in memory
+    """
     def __init__(self,
             n_classes,
             batchsize=100,
@@ -33,18 +63,14 @@ class TheanoSGDClassifier(object):
             center_and_normalize=False,
             copy_X=True,
             loss_fn='hinge',
+            chunk_rows=None,
             ):
         # add arguments to class
         self.__dict__.update(locals()); del self.self
 
     def fit(self, X_train, y_train, X_valid, y_valid):
         batchsize = self.batchsize
-
-        n_train = X_train.shape[0]
-
-        # decrease to a multiple of batchsize
-        while n_train % batchsize:
-            n_train -= 1
+        chunk_rows = self.chunk_rows
 
         assert not self.center_and_normalize
 
@@ -56,6 +82,8 @@ class TheanoSGDClassifier(object):
         x_i = tensor.matrix(dtype=X_train.dtype)
         y_i = tensor.vector(dtype=y_train.dtype)
         lr = tensor.scalar(dtype=X_train.dtype)
+        # the final batch may be smaller than batchsize
+        n_i = tensor.cast(x_i.shape[0], dtype=X_train.dtype)
 
         feature_logreg = LogisticRegression.new(x_i,
                 n_in = train_features.shape[1], n_out=self.n_classes,
@@ -66,6 +94,13 @@ class TheanoSGDClassifier(object):
         elif self.loss_fn=='hinge':
             raw_output = tensor.dot(feature_logreg.input, feature_logreg.w)+feature_logreg.b
             traincost = multi_hinge_margin(raw_output, y_i).sum()
+        elif self.loss_fn=='ovr_hinge':
+            # all the binary classifiers share this one product
+            raw_output = tensor.dot(feature_logreg.input, feature_logreg.w)+feature_logreg.b
+            targets = tensor.eq(y_i.dimshuffle(0, 'x'),
+                    tensor.arange(self.n_classes).dimshuffle('x', 0))
+            signs = 2 * tensor.cast(targets, raw_output.dtype) - 1
+            traincost = tensor.maximum(0, 1 - signs * raw_output).sum()
         else:
             raise NotImplementedError(self.loss_fn)
         traincost = traincost + abs(feature_logreg.w).sum() * self.l1_regularization
@@ -76,7 +111,7 @@ class TheanoSGDClassifier(object):
                 updates=pylearn.gd.sgd.sgd_updates(
                     params=feature_logreg.params,
                     grads=tensor.grad(traincost, feature_logreg.params),
-                    stepsizes=[lr/batchsize,lr/(10*batchsize)]))
+                    stepsizes=[lr/n_i,lr/(10*n_i)]))
 
         test_logreg_fn = theano.function([x_i, y_i],
                 feature_logreg.errors(y_i))
@@ -106,16 +141,13 @@ class TheanoSGDClassifier(object):
                 (epoch+1)/float(self.anneal_epoch))-2)))
 
             if True:
-                n_valid = X_valid.shape[0]
                 l01s = []
-                for i in xrange(n_valid/batchsize):
-                    x_i = valid_features[i*batchsize:(i+1)*batchsize]
-                    y_i = valid_labels[i*batchsize:(i+1)*batchsize]
-
+                for x_i, y_i in iter_batches(valid_features, valid_labels,
+                        batchsize, chunk_rows):
                     #lr=0.0 -> no learning, safe for validation set
                     l01 = test_logreg_fn((x_i), y_i)
                     l01s.append(l01)
-                valid_rate = 1-np.mean(l01s)
+                valid_rate = 1-np.concatenate(l01s).mean()
                 #print('Epoch %i validation accuracy: %f'%(epoch, valid_rate))
 
                 if valid_rate > best_epoch_valid:
@@ -134,13 +166,14 @@ class TheanoSGDClassifier(object):
             #train
             l01s = []
             nlls = []
-            for i in xrange(n_train/batchsize):
-                x_i = train_features[i*batchsize:(i+1)*batchsize]
-                y_i = train_labels[i*batchsize:(i+1)*batchsize]
+            sizes = []
+            for x_i, y_i in iter_batches(train_features, train_labels,
+                    batchsize, chunk_rows):
                 nll, l01 = train_logreg_fn((x_i), y_i, e_lr)
                 nlls.append(nll)
                 l01s.append(l01)
-            train_rate = 1-np.mean(l01s)
+                sizes.append(x_i.shape[0])
+            train_rate = 1-np.average(l01s, weights=sizes)
             #print('Epoch %i train accuracy: %f'%(epoch, train_rate))
 
     def predict(self, X):
@@ -165,9 +198,23 @@ args = eval(s)
 
 clf = TheanoSGDClassifier(500, ** args)
 
+class SelectedRows(object):
+    """ Lazy view of the given rows of a (memory mapped) matrix """
+    def __init__(self, X, rows):
+        self.X = X
+        self.rows = rows
+        self.shape = (rows.shape[0],) + X.shape[1:]
+        self.dtype = X.dtype
+
+    def __getitem__(self, idx):
+        return self.X[self.rows[idx]]
+
 def load(featpath,  labelpath):
     print 'loading'
-    X = np.load(featpath)
+    if clf.chunk_rows is None:
+        X = np.load(featpath)
+    else:
+        X = np.load(featpath, mmap_mode='r')
     y = np.load(labelpath)
 
 
@@ -176,21 +223,21 @@ def load(featpath,  labelpath):
     assert X.shape[0] == y.shape[0]
 
     print 'generating mask'
-    mask = np.zeros((X.shape[0],),dtype='bool')
-    for i in xrange(X.shape[0]):
-        mask[i] = ( (i % 1000) < 500 ) == (1-which_set)
-        if which_set == 0 and mask[i]:
-            if y[i] >= 500:
-                print y[i]
-                print i
-                assert False
-            assert y[i] < 500
+    mask = ( (np.arange(X.shape[0]) % 1000) < 500 ) == (1-which_set)
+    if which_set == 0 and np.any(y[mask] >= 500):
+        i = np.nonzero(mask & (y >= 500))[0][0]
+        print y[i]
+        print i
+        assert False
 
     print mask.sum(), X.shape
     assert mask.sum() == X.shape[0]/2
 
     print 'applying mask to X'
-    X = X[mask,:]
+    if clf.chunk_rows is None:
+        X = X[mask,:]
+    else:
+        X = SelectedRows(X, np.nonzero(mask)[0])
     print 'applying mask to y'
     y = y[mask]
 
@@ -207,7 +254,11 @@ def load(featpath,  labelpath):
 print 'getting training data'
 X_train, y_train =  load('/mnt/scratch/stitched/train.npy', '/mnt/scratch/stitched/trainl.npy')
 print 'getting valid data'
-X_valid = np.load( [ '/mnt/scratch/S3C_5625/valid1_S3C_5625.npy', '/mnt/scratch/S3C_5625/valid2_S3C_5625.npy' ] [which_set] )
+if clf.chunk_rows is None:
+    mmap_mode = None
+else:
+    mmap_mode = 'r'
+X_valid = np.load( [ '/mnt/scratch/S3C_5625/valid1_S3C_5625.npy', '/mnt/scratch/S3C_5625/valid2_S3C_5625.npy' ] [which_set], mmap_mode=mmap_mode )
 y_valid = np.load( [ '/mnt/scratch/S3C_5625/validl1_S3C_5625.npy', '/mnt/scratch/S3C_5625/validl2_S3C_5625.npy' ] [which_set] )
 
 y_valid -= which_set * 500
@@ -17,24 +17,83 @@ from pylearn2.datasets.tl_challenge import TL_Challenge
 import sys
 config.floatX = 'float32'
 
-class halver:
-    def __init__(self,f,nhid):
+def default_device_memory_budget():
+    """
+    Returns the number of bytes of features to compute per call of the
+    theano function: an eighth of the free GPU memory, leaving room for
+    the intermediate values of inference, or None (no limit) when
+    running on the CPU.
+    """
+
+    if not (config.device.startswith('gpu') or config.device.startswith('cuda')):
+        return None
+    try:
+        from theano.sandbox.cuda import cuda_ndarray
+        free, total = cuda_ndarray.cuda_ndarray.mem_info()
+    except (ImportError, AttributeError):
+        return 2 ** 28
+    return free // 8
+
+class row_chunker:
+    """
+    Wraps a function of a design matrix so that it is called on chunks
+    of at most max_rows rows, keeping each call's output under a memory
+    budget. A memory_budget of None calls the function on the whole
+    design matrix.
+    """
+    def __init__(self,f,nhid,memory_budget):
         self.f = f
         self.nhid = nhid
+        if memory_budget is None:
+            self.max_rows = None
+        else:
+            self.max_rows = max(1, memory_budget // (4 * nhid))
 
     def __call__(self,X):
         m = X.shape[0]
-        #mid = m/2
-        m1 = m/3
-        m2 = 2*m/3
+        if self.max_rows is None or m <= self.max_rows:
+            return self.f(X)
 
         rval = np.zeros((m,self.nhid),dtype='float32')
-        rval[0:m1,:] = self.f(X[0:m1,:])
-        rval[m1:m2,:] = self.f(X[m1:m2,:])
-        rval[m2:,:] = self.f(X[m2:,:])
+        for i in xrange(0,m,self.max_rows):
+            rval[i:i+self.max_rows,:] = self.f(X[i:i+self.max_rows,:])
 
         return rval
 
+def region_bounds(ns, count):
+    """ Start of each of the count pooling regions along a side of length ns """
+
+    return np.arange(count) * ns // count
+
+def average_pool(topo_feat, pooling_region_counts):
+    """
+    Averages topo_feat, of shape (batch, ns, ns, nhid), over each cell of
+    a count x count grid, for every count in pooling_region_counts.
+
+    The feature maps are summed only once, over the cells of the grid
+    formed by the union of all the region boundaries; each pooling grid
+    is then made of whole cells of that grid.
+    """
+
+    ns = topo_feat.shape[1]
+    assert topo_feat.shape[2] == ns
+
+    all_bounds = np.unique(np.concatenate([region_bounds(ns, count)
+        for count in pooling_region_counts]))
+    cell_sums = np.add.reduceat(np.add.reduceat(topo_feat, all_bounds, axis=1),
+            all_bounds, axis=2)
+
+    rval = []
+    for count in pooling_region_counts:
+        bounds = region_bounds(ns, count)
+        pos = np.searchsorted(all_bounds, bounds)
+        sums = np.add.reduceat(np.add.reduceat(cell_sums, pos, axis=1), pos, axis=2)
+        sizes = np.diff(np.append(bounds, ns))
+        area = np.cast['float32'](np.outer(sizes, sizes))
+        rval.append(sums / area[None,:,:,None])
+
+    return rval
+
 
 class FeaturesDataset:
     def __init__(self, dataset_maker, num_examples, pipeline_path):
@@ -116,10 +175,26 @@ for which_set in ['train', 'test']:
 class FeatureExtractor:
     def __init__(self, model, preprocessor,
             pooling_region_counts = [3],
-           feature_type = 'exp_h'):
+           feature_type = 'exp_h',
+           memory_budget = 2 ** 30,
+           device_memory_budget = 'auto'):
+        """
+            memory_budget: approximate number of bytes of features to hold
+                           on the host at once; images are processed in
+                           batches sized to fit in it
+            device_memory_budget: approximate number of bytes of features
+                           to compute per call of the theano function, or
+                           None for no limit. 'auto' picks it from the
+                           free GPU memory, and means no limit on the CPU
+                           (see default_device_memory_budget)
+        """
+
+        if device_memory_budget == 'auto':
+            device_memory_budget = default_device_memory_budget()
 
         self.pooling_region_counts = pooling_region_counts
         self.feature_type = feature_type
+        self.memory_budget = memory_budget
 
         self.model = model
         self.size = int(np.sqrt(self.model.nvis/3))
@@ -156,44 +231,27 @@ class FeatureExtractor:
         print 'compiling theano function'
         f = function([V],feat)
 
-        if config.device.startswith('gpu') and model.nhid >= 4000:
-            f = halver(f, model.nhid)
-
-        self.f = f
-
-        topo_feat_var = T.TensorType(broadcastable = (False,False,False,False), dtype='float32')()
-        self.region_features = function([topo_feat_var],
-                topo_feat_var.mean(axis=(1,2)) )
+        self.f = row_chunker(f, model.nhid, device_memory_budget)
 
     def __call__(self, full_X):
+        """
+            full_X: a single 32x32x3 image, or a batch of them
+            returns the pooled features for the first pooling region
+            count, of shape (num_examples, count, count, nhid)
+        """
 
-        feature_type = self.feature_type
         pooling_region_counts = self.pooling_region_counts
         model = self.model
         size = self.size
 
         nan = 0
 
-
-        full_X = full_X.reshape(1,full_X.shape[0],full_X.shape[1],full_X.shape[2])
+        if len(full_X.shape) == 3:
+            full_X = full_X.reshape(1,full_X.shape[0],full_X.shape[1],full_X.shape[2])
         num_examples = full_X.shape[0]
-        assert num_examples == 1
 
         pipeline = self.preprocessor
 
-
-        def average_pool( stride ):
-            def point( p ):
-                return p * ns / stride
-
-            rval = np.zeros( (topo_feat.shape[0], stride, stride, topo_feat.shape[3] ) , dtype = 'float32')
-
-            for i in xrange(stride):
-                for j in xrange(stride):
-                    rval[:,i,j,:] = self.region_features( topo_feat[:,point(i):point(i+1), point(j):point(j+1),:] )
-
-            return rval
-
         outputs = [ np.zeros((num_examples,count,count,model.nhid),dtype='float32') for count in pooling_region_counts ]
 
         assert len(outputs) > 0
@@ -203,13 +261,16 @@ class FeatureExtractor:
         ns = 32 - size + 1
         depatchifier = ReassembleGridPatches( orig_shape  = (ns, ns), patch_shape=(1,1) )
 
-        batch_size = 1
+        # The features of a batch are held twice: as a design matrix
+        # and as a topological view
+        batch_size = max(1, self.memory_budget // (2 * 4 * ns * ns * model.nhid))
 
-        for i in xrange(0,num_examples-batch_size+1,batch_size):
+        for i in xrange(0,num_examples,batch_size):
             print i
             t1 = time.time()
 
             d = DenseDesignMatrix( topo_view =  np.cast['float32'](full_X[i:i+batch_size,:]), view_converter = DefaultViewConverter((32,32,3)))
+            cur_batch_size = d.X.shape[0]
 
             t2 = time.time()
 
@@ -239,13 +300,13 @@ class FeatureExtractor:
 
             #print '\tmaking topological view'
             topo_feat = feat_dataset.get_topological_view()
-            assert topo_feat.shape[0] == batch_size
+            assert topo_feat.shape[0] == cur_batch_size
 
             t5 = time.time()
 
             #average pooling
-            for output, count in zip(outputs, pooling_region_counts):
-                output[i:i+batch_size,...] = average_pool(count)
+            for output, pooled in zip(outputs, average_pool(topo_feat, pooling_region_counts)):
+                output[i:i+cur_batch_size,...] = pooled
 
             t6 = time.time()
 
@@ -254,24 +315,34 @@ class FeatureExtractor:
         return outputs[0]
 
 if __name__ == '__main__':
-    assert len(sys.argv) == 3
+    assert len(sys.argv) in [3, 4]
     ipath = sys.argv[1]
     opath = sys.argv[2]
+    # optional: megabytes of features to compute per theano call
+    if len(sys.argv) == 4:
+        device_memory_budget = int(sys.argv[3]) * 2 ** 20
+    else:
+        device_memory_budget = 'auto'
 
     serial.mkdir(opath)
 
     model = serial.load('/data/lisatmp/goodfeli/darpa_s3c.pkl')
     preprocessor = serial.load('/data/lisatmp/goodfeli/darpa_imagenet_patch_6x6_train_preprocessor.pkl')
+    size = int(np.sqrt(model.nvis/3))
     patchifier = ExtractGridPatches( patch_shape = (size,size), patch_stride = (1,1) )
     preprocessor.items.insert(0,patchifier)
 
-    extractor = FeatureExtractor( model = model, preprocessor = preprocessor)
+    extractor = FeatureExtractor( model = model, preprocessor = preprocessor,
+            device_memory_budget = device_memory_budget)
 
     contents = os.listdir(ipath)
+    files_per_call = 1000
 
-    for i, fname in enumerate(contents):
-        print str(i+1)+'/'+str(len(contents))
-        X = np.load(ipath+'/'+fname)
+    for i in xrange(0,len(contents),files_per_call):
+        fnames = contents[i:i+files_per_call]
+        print str(i+len(fnames))+'/'+str(len(contents))
+        X = np.concatenate([np.load(ipath+'/'+fname)[None,...] for fname in fnames], axis=0)
         X = extractor(X)
-        np.save(opath+'/'+fname,X)
+        for fname, feat in zip(fnames, X):
+            np.save(opath+'/'+fname,feat[None,...])
 
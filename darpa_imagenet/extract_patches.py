@@ -1,45 +1,90 @@
-from galatea.darpa_imagenet.utils import count_images
-from galatea.darpa_imagenet.utils import ImageIterator
+from galatea.darpa_imagenet.utils import count_thumbnails
+from galatea.darpa_imagenet.utils import read_thumbnail_manifest
+from multiprocessing import Pool
+from numpy.lib.stride_tricks import as_strided
 import numpy as np
+import os
 from pylearn2.utils import serial
-from pylearn2.datasets.preprocessing import ExtractPatches
 from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix, DefaultViewConverter
 
 path = '/data/lisatmp/goodfeli/darpa_imagenet'
 image_shape = (32,32)
 patch_shape = (6,6)
-
-m = count_images(path,'.npy')
 k = 3
-
-X = np.zeros((m*k,patch_shape[0]*patch_shape[1]*3),dtype='float32')
-
-rng = np.random.RandomState([1,2,3])
-
-for i, img_path in enumerate(ImageIterator(path, suffix=".npy")):
-
-    img = np.load(img_path)
-
-    if img.shape[2] == 1:
-        img = np.concatenate((img,img,img),axis=2)
-
-    img = img.reshape(1,img.shape[0],img.shape[1],img.shape[2])
-
-    d = DenseDesignMatrix( topo_view = img, view_converter = DefaultViewConverter(img.shape[1:]) )
-
-    random_rng = np.random.RandomState([ rng.randint(0,256), rng.randint(0,256), rng.randint(0,256)])
-
-    p = ExtractPatches( patch_shape = patch_shape, num_patches = k , rng = random_rng)
-
-    d.apply_preprocessor(p)
-
-    X[i*3:(i+1)*3,:] = d.X
-
-d.X = X
-
-base = '/data/lisatmp/goodfeli/darpa_imagenet_patch_%dx%d_train.' % (patch_shape[0], patch_shape[1])
-
-d.use_design_loc(base+'npy')
-serial.save(base+'pkl',d)
-
-
+block_size = 1000
+num_workers = 8
+
+def sample_patches(images, patch_shape, k, rng, out):
+    """
+    Draws k random patches from each image of a batch.
+
+    images: array of shape (num_images, rows, cols, channels)
+    rng: all the patch coordinates are drawn with one call to it
+    out: array of shape (num_images*k, patch_rows*patch_cols*channels)
+         that the patches are gathered into, in image order
+    """
+
+    n, rows, cols, channels = images.shape
+    pr, pc = patch_shape
+    images = np.ascontiguousarray(images)
+
+    # View of every patch position of every image, without copying
+    s = images.strides
+    windows = as_strided(images,
+            shape = (n, rows - pr + 1, cols - pc + 1, pr, pc, channels),
+            strides = (s[0], s[1], s[2], s[1], s[2], s[3]))
+
+    # Flat patch positions, so one draw covers both coordinates
+    pos = rng.randint(0, (rows - pr + 1) * (cols - pc + 1), size = n * k)
+    idx = np.repeat(np.arange(n), k)
+    patches = windows[idx, pos // (cols - pc + 1), pos % (cols - pc + 1)]
+    out[...] = patches.reshape(n * k, pr * pc * channels)
+
+def sample_shard(args):
+    """
+    Worker function: samples k patches from every thumbnail of a shard,
+    reading the memory mapped shard block_size thumbnails at a time.
+    """
+
+    shard_path, patch_shape, k, seed, block_size = args
+
+    shard = np.load(shard_path, mmap_mode = 'r')
+    rng = np.random.RandomState(seed)
+    n = shard.shape[0]
+    rval = np.zeros((n*k,patch_shape[0]*patch_shape[1]*shard.shape[3]),dtype='float32')
+
+    for i in xrange(0, n, block_size):
+        block = shard[i:i+block_size]
+        sample_patches(block, patch_shape, k, rng, rval[i*k:(i+block.shape[0])*k])
+
+    return rval
+
+if __name__ == '__main__':
+    m = count_thumbnails(path)
+
+    X = np.zeros((m*k,patch_shape[0]*patch_shape[1]*3),dtype='float32')
+
+    rng = np.random.RandomState([1,2,3])
+
+    manifest = read_thumbnail_manifest(path)
+    # One seed per shard, so the patches do not depend on num_workers
+    seeds = rng.randint(0, 2**30, size = len(manifest))
+    tasks = [ (os.path.join(path, entry['file']), patch_shape, k, seed, block_size)
+              for entry, seed in zip(manifest, seeds) ]
+
+    pool = Pool(num_workers)
+    pos = 0
+    for i, patches in enumerate(pool.imap(sample_shard, tasks)):
+        print '%d/%d' % (i+1, len(tasks))
+        X[pos:pos+patches.shape[0],:] = patches
+        pos += patches.shape[0]
+    pool.close()
+    pool.join()
+    assert pos == X.shape[0]
+
+    d = DenseDesignMatrix(X = X, view_converter = DefaultViewConverter((patch_shape[0], patch_shape[1], 3)))
+
+    base = '/data/lisatmp/goodfeli/darpa_imagenet_patch_%dx%d_train.' % (patch_shape[0], patch_shape[1])
+
+    d.use_design_loc(base+'npy')
+    serial.save(base+'pkl',d)
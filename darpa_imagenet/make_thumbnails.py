@@ -1,51 +1,146 @@
+"""
+Builds a packed thumbnail store from a tree of JPEG images.
+
+The images are listed once into output_path/index.txt and split into
+shards of consecutive images. A pool of worker processes loads and
+letterboxes each shard and saves it as a single float32 array
+output_path/thumbs_<shard>.npy of shape (count, rows, cols, 3). The
+parent process appends one JSON line per finished shard to
+output_path/manifest.txt, so a restarted job reads the index and the
+manifest and only redoes the missing shards, without touching the
+individual thumbnails. Use galatea.darpa_imagenet.utils.load_thumbnail_shards
+to read the store back.
+"""
 from galatea.darpa_imagenet.utils import explore_images
+from galatea.darpa_imagenet.utils import read_thumbnail_index
+from galatea.darpa_imagenet.utils import read_thumbnail_manifest
 from pylearn2.utils import serial
 from pylearn2.utils import image
+from multiprocessing import Pool
 import numpy as np
+import json
 import os
 import time
 
 input_path = '/data/lisatmp/glorotxa/train'
 output_path = '/data/lisatmp/goodfeli/darpa_imagenet'
 image_shape = (32,32)
+shard_size = 10000
+num_workers = 8
+
+def make_thumbnail(image_path, image_shape):
+    """ Loads an image and returns its letterboxed RGB thumbnail """
 
-created_subdirs = set([])
+    img = image.load(image_path)
+    assert len(img.shape) == 3
+    thumbnail = image.make_letterboxed_thumbnail(img, image_shape)
+    if thumbnail.shape[2] == 1:
+        thumbnail = np.concatenate((thumbnail,thumbnail,thumbnail),axis=2)
+    return thumbnail
 
-for image_path in explore_images(input_path):
+def make_shard(args):
+    """
+    Worker function: builds and saves the thumbnails of one shard.
 
-    thumbnail_path = image_path.replace(input_path,output_path)
-    thumbnail_path = thumbnail_path.replace('.JPEG','.npy')
+    Returns the manifest entry of the shard.
+    """
+
+    input_path, output_path, shard, shard_size, rel_paths, image_shape = args
 
     t1 = time.time()
-    e =  os.path.exists(thumbnail_path)
-    t2 = time.time()
-    print t2-t1
+    X = np.zeros((len(rel_paths),image_shape[0],image_shape[1],3),dtype='float32')
+    count = 0
+    failed = []
+    for rel_path in rel_paths:
+        try:
+            X[count,:] = make_thumbnail(os.path.join(input_path, rel_path), image_shape)
+            count += 1
+        except Exception, e:
+            print "Encountered a problem with "+rel_path+": "+str(e)
+            failed.append(rel_path)
 
-    if e:
-        continue
+    fname = 'thumbs_%05d.npy' % shard
+    # Write under a temporary name so an interrupted job never leaves a
+    # truncated shard behind
+    tmp_path = os.path.join(output_path, 'thumbs_%05d.tmp.npy' % shard)
+    np.save(tmp_path, X[:count])
+    os.rename(tmp_path, os.path.join(output_path, fname))
 
-    thumbnail_subdir = '/'.join(thumbnail_path.split('/')[:-1])
+    return { 'shard' : shard, 'shard_size' : shard_size, 'file' : fname,
+             'count' : count, 'failed' : failed,
+             'seconds' : time.time() - t1 }
 
-    if thumbnail_subdir not in created_subdirs:
-        serial.mkdir(thumbnail_subdir)
-        created_subdirs = created_subdirs.union([thumbnail_subdir])
+def read_index(input_path, output_path):
+    """
+    Returns the relative paths of all the images to process, walking
+    the input tree only the first time.
+    """
 
-    try:
-        t1 = time.time()
-        img = image.load(image_path)
-        t2 = time.time()
-    except Exception, e:
-        print "Encountered a problem: "+str(e)
-        img = None
+    index_path = os.path.join(output_path, 'index.txt')
+
+    if not os.path.exists(index_path):
+        print 'indexing '+input_path
+        rel_paths = [os.path.relpath(image_path, input_path)
+                     for image_path in explore_images(input_path, '.JPEG')]
+        tmp_path = index_path + '.tmp'
+        f = open(tmp_path, 'w')
+        f.write('\n'.join(rel_paths))
+        f.close()
+        os.rename(tmp_path, index_path)
+
+    return read_thumbnail_index(output_path)
+
+def build_thumbnails(input_path, output_path, image_shape = (32,32),
+        shard_size = 10000, num_workers = 8):
+    """ Builds (or finishes building) a packed thumbnail store """
 
-    if img is not None:
-        assert len(img.shape) == 3
-        thumbnail = image.make_letterboxed_thumbnail(img, image_shape)
-        t3 = time.time()
+    serial.mkdir(output_path)
 
-        np.save(thumbnail_path, thumbnail)
-        t4 = time.time()
+    rel_paths = read_index(input_path, output_path)
+    num_shards = (len(rel_paths) + shard_size - 1) // shard_size
+    entries = read_thumbnail_manifest(output_path)
+    for entry in entries:
+        # The shard index only locates the images of a shard for the
+        # shard_size it was built with
+        if entry.get('shard_size') != shard_size:
+            raise ValueError("shard %d of %s was built with shard_size %s, "
+                    "can't resume it with shard_size %d" % (entry['shard'],
+                        output_path, entry.get('shard_size'), shard_size))
+    done = set([entry['shard'] for entry in entries])
+
+    tasks = [ (input_path, output_path, shard, shard_size,
+               rel_paths[shard*shard_size:(shard+1)*shard_size], image_shape)
+              for shard in xrange(num_shards) if shard not in done ]
+    num_images = sum(len(task[4]) for task in tasks)
+    print '%d/%d shards done, %d images to process' % (len(done), num_shards, num_images)
+
+    if len(tasks) == 0:
+        return
+
+    pool = Pool(num_workers)
+    manifest = open(os.path.join(output_path, 'manifest.txt'), 'a')
+
+    t1 = time.time()
+    processed = 0
+    try:
+        for entry in pool.imap_unordered(make_shard, tasks):
+            manifest.write(json.dumps(entry) + '\n')
+            manifest.flush()
 
-        print (t2-t1,t3-t2,t4-t3)
+            processed += entry['count'] + len(entry['failed'])
+            elapsed = time.time() - t1
+            print 'shard %d: %d thumbnails, %d failures, %.1fs; total %d/%d at %.1f images/s' % \
+                    (entry['shard'], entry['count'], len(entry['failed']), entry['seconds'],
+                     processed, num_images, processed / elapsed)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        manifest.close()
 
+    print 'done in %.1fs' % (time.time() - t1)
 
+if __name__ == '__main__':
+    build_thumbnails(input_path, output_path, image_shape, shard_size, num_workers)
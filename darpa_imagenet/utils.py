@@ -1,19 +1,232 @@
+import cPickle
+import hashlib
+import json
 import os
+import warnings
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 def explore_images(path, suffix):
     """ An iterator over all JPG file paths in a directory (recursive)"""
 
-    return ImageIterator(path, suffix)
+    return iter(get_image_index(path).paths(suffix))
 
 def count_images(path, suffix):
 
-    count = 0
+    return len(get_image_index(path).paths(suffix))
+
+_image_indices = {}
+
+def get_image_index(path, cache_path = None):
+    """
+    Returns the ImageIndex of a directory. The index is shared within
+    the process, so counting and then iterating over the images of a
+    directory only walks it once. A shared index is refreshed when the
+    mtime of the root directory has changed; call its refresh method to
+    pick up changes deeper in the tree.
+    """
+
+    # the paths are served under the path as given, so it is part of the key
+    key = (path, os.path.abspath(path), cache_path)
+    mtime = os.stat(path).st_mtime
+    if key not in _image_indices:
+        _image_indices[key] = (mtime, ImageIndex(path, cache_path))
+    elif _image_indices[key][0] != mtime:
+        _image_indices[key][1].refresh()
+        _image_indices[key] = (mtime, _image_indices[key][1])
+    return _image_indices[key][1]
+
+def _list_dir(path):
+    """
+    Returns the sorted (name, is_dir, size, mtime) tuples of the entries
+    of a directory, using scandir when it is available so that
+    directories need no extra stat call.
+    """
+
+    entries = []
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_dir():
+                entries.append((entry.name, True, 0, 0.))
+            else:
+                st = entry.stat()
+                entries.append((entry.name, False, st.st_size, st.st_mtime))
+    else:
+        for name in os.listdir(path):
+            full_path = os.path.join(path, name)
+            if os.path.isdir(full_path):
+                entries.append((name, True, 0, 0.))
+            else:
+                st = os.stat(full_path)
+                entries.append((name, False, st.st_size, st.st_mtime))
+    entries.sort()
+    return entries
+
+def _stat_entry(path, entry):
+    """ Updates the size and mtime of a _list_dir entry of directory path """
+
+    name, is_dir, size, mtime = entry
+    if is_dir:
+        return entry
+    st = os.stat(os.path.join(path, name))
+    return (name, is_dir, st.st_size, st.st_mtime)
+
+class ImageIndex:
+    """
+    A persistent index of all the files below a directory.
+
+    The listing of every directory is cached on disk along with the
+    directory's mtime. Refreshing the index costs one stat per directory;
+    only the directories whose mtime changed (files added, removed or
+    renamed) are listed again. Files are served in the same order as
+    ImageIterator, and like its paths, theirs start with path as given.
+
+    The size and mtime of a file are those it had when its directory was
+    last listed, since rewriting a file in place does not change the
+    mtime of its directory. refresh(stat_files = True) updates them.
+
+    path: the root directory
+    cache_path: where to keep the index. Defaults to a file named after
+                the root under ~/.cache/galatea/image_index, so the
+                indexed tree itself is never written to.
+    """
+
+    version = 1
+
+    def __init__(self, path, cache_path = None):
+        self.root = path
+        self.path = os.path.abspath(path)
+        if cache_path is None:
+            cache_path = os.path.join(os.path.expanduser('~'), '.cache',
+                    'galatea', 'image_index',
+                    hashlib.md5(self.path).hexdigest() + '.pkl')
+        self.cache_path = cache_path
+        self.dirs = {}
+        self._load()
+        self.refresh()
+
+    def _load(self):
+        if not os.path.exists(self.cache_path):
+            return
+        try:
+            f = open(self.cache_path, 'rb')
+            try:
+                cache = cPickle.load(f)
+            finally:
+                f.close()
+        except Exception, e:
+            warnings.warn("Ignoring unreadable image index cache " +
+                    self.cache_path + ": " + str(e))
+            return
+        if cache['version'] == self.version and cache['path'] == self.path:
+            self.dirs = cache['dirs']
+
+    def _save(self):
+        try:
+            cache_dir = os.path.dirname(self.cache_path)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_path = self.cache_path + '.%d.tmp' % os.getpid()
+            f = open(tmp_path, 'wb')
+            try:
+                cPickle.dump({ 'version' : self.version, 'path' : self.path,
+                               'dirs' : self.dirs }, f, protocol = 2)
+            finally:
+                f.close()
+            os.rename(tmp_path, self.cache_path)
+        except (IOError, OSError), e:
+            warnings.warn("Could not save image index cache " +
+                    self.cache_path + ": " + str(e))
+
+    def refresh(self, stat_files = False):
+        """
+        Brings the index up to date with the file system and saves it if
+        anything changed. Returns the number of directories that were
+        listed again or had files whose size or mtime changed.
+
+        stat_files: if True, the sizes and mtimes of the files of the
+                    directories that did not change are checked too, at
+                    the cost of one stat per file
+        """
+
+        old_dirs = self.dirs
+        self.dirs = {}
+        changed = [0]
+
+        def update(rel_dir):
+            full_dir = os.path.join(self.path, rel_dir)
+            mtime = os.stat(full_dir).st_mtime
+            cached = old_dirs.get(rel_dir)
+            if cached is not None and cached[0] == mtime:
+                entries = cached[1]
+                if stat_files:
+                    entries = [_stat_entry(full_dir, entry) for entry in entries]
+                    if entries != cached[1]:
+                        changed[0] += 1
+            else:
+                entries = _list_dir(full_dir)
+                changed[0] += 1
+            self.dirs[rel_dir] = (mtime, entries)
+            for name, is_dir, size, file_mtime in entries:
+                if is_dir:
+                    update(os.path.join(rel_dir, name))
+
+        update('')
+        self._cache = {}
+
+        if changed[0] > 0 or len(old_dirs) != len(self.dirs):
+            self._save()
+        return changed[0]
+
+    def _walk(self, rel_dir):
+        for name, is_dir, size, mtime in self.dirs[rel_dir][1]:
+            rel_path = os.path.join(rel_dir, name)
+            if is_dir:
+                for item in self._walk(rel_path):
+                    yield item
+            else:
+                yield rel_path, size, mtime
+
+    def entries(self, suffix = '.JPEG'):
+        """
+        Returns a list of (path, size, mtime, class) tuples for all the
+        files ending in suffix. The class is the name of the top level
+        subdirectory holding the file (None for files in the root).
+        """
+
+        if suffix not in self._cache:
+            rval = []
+            for rel_path, size, mtime in self._walk(''):
+                if rel_path.endswith(suffix):
+                    parts = rel_path.split(os.sep)
+                    if len(parts) > 1:
+                        cls = parts[0]
+                    else:
+                        cls = None
+                    rval.append((os.path.join(self.root, rel_path),
+                                 size, mtime, cls))
+            self._cache[suffix] = rval
+        return self._cache[suffix]
+
+    def paths(self, suffix = '.JPEG'):
+        """ The paths of all the files ending in suffix """
 
-    for img_path in explore_images(path, suffix):
-        #print '\t',img_path
-        count += 1
+        return [entry[0] for entry in self.entries(suffix)]
 
-    return count
+    def __len__(self):
+        return len(self.entries())
+
+    def __iter__(self):
+        return iter(self.paths())
 
 class ImageIterator:
 
@@ -49,3 +262,203 @@ class ImageIterator:
         else:
             raise StopIteration()
 
+
+def read_thumbnail_manifest(path):
+    """
+    Returns the entries of the manifest written by make_thumbnails for a
+    packed thumbnail store, sorted by shard. Each entry is a dict with
+    the shard index, the shard_size the store was built with, the
+    shard's .npy file name, the number of
+    thumbnails it holds and the relative paths of the images that failed
+    to load (and so have no row in the shard).
+    """
+
+    manifest_path = os.path.join(path, 'manifest.txt')
+    entries = {}
+    if os.path.exists(manifest_path):
+        for line in open(manifest_path):
+            line = line.strip()
+            if line:
+                entry = json.loads(line)
+                entries[entry['shard']] = entry
+    return [entries[shard] for shard in sorted(entries)]
+
+def read_thumbnail_index(path):
+    """
+    Returns the relative paths of all the images of a packed thumbnail
+    store, as listed in its index.txt
+    """
+
+    return [line.rstrip('\n') for line in open(os.path.join(path, 'index.txt'))
+            if line.strip()]
+
+def thumbnail_shard_paths(path):
+    """
+    An iterator over the finished shards of a packed thumbnail store, in
+    shard order. Yields (entry, rel_paths) pairs: the manifest entry of
+    the shard and the relative paths of the images held by its rows, in
+    row order.
+    """
+
+    index = read_thumbnail_index(path)
+    for entry in read_thumbnail_manifest(path):
+        shard_size = entry['shard_size']
+        start = entry['shard'] * shard_size
+        failed = set(entry['failed'])
+        rel_paths = [rel_path for rel_path in index[start:start+shard_size]
+                     if rel_path not in failed]
+        assert len(rel_paths) == entry['count']
+        yield entry, rel_paths
+
+def count_thumbnails(path):
+    """ The number of thumbnails held by a packed thumbnail store """
+
+    return sum(entry['count'] for entry in read_thumbnail_manifest(path))
+
+def load_thumbnail_shards(path, mmap_mode = 'r'):
+    """
+    An iterator over the thumbnail arrays of a packed thumbnail store,
+    in shard order. Each array has shape (count, rows, cols, 3). By
+    default the shards are memory mapped rather than read into memory.
+    """
+
+    for entry in read_thumbnail_manifest(path):
+        yield np.load(os.path.join(path, entry['file']), mmap_mode = mmap_mode)
+
+def write_shard_manifest(shard_paths, manifest_path):
+    """
+    Writes a JSON manifest giving the row range each .npy shard would
+    occupy in the concatenation of the shards, along with the shape and
+    dtype of that concatenation. Only the shard headers are read.
+    Returns the manifest.
+    """
+
+    shards = []
+    start = 0
+    row_shape = None
+    dtype = None
+    for shard_path in shard_paths:
+        shard = np.load(shard_path, mmap_mode = 'r')
+        if row_shape is None:
+            row_shape = shard.shape[1:]
+            dtype = shard.dtype
+        elif shard.shape[1:] != row_shape or shard.dtype != dtype:
+            raise ValueError(shard_path + " has shape " + str(shard.shape) +
+                    " and dtype " + str(shard.dtype) + ", incompatible with " +
+                    str(row_shape) + " rows of dtype " + str(dtype))
+        stop = start + shard.shape[0]
+        shards.append({ 'path' : os.path.abspath(shard_path),
+                        'start' : start, 'stop' : stop })
+        start = stop
+        del shard
+
+    if row_shape is None:
+        raise ValueError("No shards to stitch")
+
+    manifest = { 'shape' : [start] + list(row_shape),
+                 'dtype' : np.dtype(dtype).str,
+                 'shards' : shards }
+    f = open(manifest_path, 'w')
+    json.dump(manifest, f, indent = 1)
+    f.close()
+    return manifest
+
+def _copy_shard(args):
+    """ Copies one shard into its rows of the stitched array, chunk by chunk """
+
+    shard_path, output_path, start, chunk_bytes = args
+
+    shard = np.load(shard_path, mmap_mode = 'r')
+    out = np.load(output_path, mmap_mode = 'r+')
+    row_bytes = max(1, shard[0:1].nbytes)
+    chunk_rows = max(1, chunk_bytes // row_bytes)
+    for i in xrange(0, shard.shape[0], chunk_rows):
+        chunk = shard[i:i+chunk_rows]
+        out[start+i:start+i+chunk.shape[0]] = chunk
+    out.flush()
+    del out
+    return shard_path
+
+def stitch_shards(shard_paths, output_path, manifest_path = None,
+        num_workers = 1, chunk_bytes = 2 ** 28):
+    """
+    Concatenates .npy shards along their first axis into the .npy file
+    output_path, without ever holding more than about chunk_bytes of
+    each shard in memory. The output is preallocated as a memory mapped
+    array and the shards are copied into it, by num_workers processes
+    if num_workers > 1.
+
+    A manifest of the shard offsets is written to manifest_path
+    (defaults to output_path with its extension replaced by
+    _shards.json), so that ShardedArray can read the shards lazily
+    without stitching them.
+    """
+
+    if manifest_path is None:
+        manifest_path = os.path.splitext(output_path)[0] + '_shards.json'
+    manifest = write_shard_manifest(shard_paths, manifest_path)
+
+    out = open_memmap(output_path, mode = 'w+',
+            dtype = np.dtype(manifest['dtype']),
+            shape = tuple(manifest['shape']))
+    del out
+
+    tasks = [ (shard['path'], output_path, shard['start'], chunk_bytes)
+              for shard in manifest['shards'] ]
+    if num_workers > 1:
+        from multiprocessing import Pool
+        pool = Pool(num_workers)
+        for shard_path in pool.imap_unordered(_copy_shard, tasks):
+            print shard_path
+        pool.close()
+        pool.join()
+    else:
+        for task in tasks:
+            print _copy_shard(task)
+
+class ShardedArray:
+    """
+    Read-only, lazily loaded view of the concatenation of the shards
+    listed in a manifest written by write_shard_manifest. The shards are
+    memory mapped the first time rows are read from them; indexing with
+    an integer or a slice of rows returns an ordinary array.
+    """
+
+    def __init__(self, manifest_path):
+        f = open(manifest_path)
+        manifest = json.load(f)
+        f.close()
+        self.shape = tuple(manifest['shape'])
+        self.dtype = np.dtype(manifest['dtype'])
+        self.shards = manifest['shards']
+        self._starts = np.array([shard['start'] for shard in self.shards])
+        self._arrays = {}
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _shard(self, i):
+        if i not in self._arrays:
+            self._arrays[i] = np.load(self.shards[i]['path'], mmap_mode = 'r')
+        return self._arrays[i]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(self.shape[0])
+            if step != 1:
+                raise NotImplementedError("ShardedArray only supports contiguous slices")
+            rval = np.zeros((max(0, stop - start),) + self.shape[1:], dtype = self.dtype)
+            pos = start
+            while pos < stop:
+                i = np.searchsorted(self._starts, pos, side = 'right') - 1
+                shard = self.shards[i]
+                end = min(stop, shard['stop'])
+                rval[pos-start:end-start] = self._shard(i)[pos-shard['start']:end-shard['start']]
+                pos = end
+            return rval
+        if idx < 0:
+            idx += self.shape[0]
+        if not 0 <= idx < self.shape[0]:
+            raise IndexError(str(idx))
+        i = np.searchsorted(self._starts, idx, side = 'right') - 1
+        return np.array(self._shard(i)[idx - self.shards[i]['start']])
@@ -271,23 +271,30 @@ if __name__ == '__main__':
     extractor = FeatureExtractor( model = model, preprocessor = preprocessor)
 
     xavier = '/data/lisatmp/glorotxa/val'
-    thumbnail = '/data/lisatmp/goodfeli/darpa_imagenet_valid_thumb'
+    thumbnail = '/data/lisatmp/goodfeli/darpa_imagenet_valid'
     feature = '/data/lisatmp/goodfeli/darpa_imagenet_valid_features'
 
-    from galatea.darpa_imagenet.utils import explore_images
+    from galatea.darpa_imagenet.utils import load_thumbnail_shards
+    from galatea.darpa_imagenet.utils import read_thumbnail_index
+    from galatea.darpa_imagenet.utils import thumbnail_shard_paths
 
-    for img_path in explore_images(xavier,'.JPEG'):
-        print img_path
-        thumbnail_path = img_path.replace(xavier,thumbnail)
-        thumbnail_path = thumbnail_path.replace('.JPEG','.npy')
-        if os.path.exists(thumbnail_path):
-            feature_path = thumbnail_path.replace(thumbnail,feature)
+    missing = set(read_thumbnail_index(thumbnail))
+
+    for (entry, rel_paths), thumbs in zip(thumbnail_shard_paths(thumbnail),
+            load_thumbnail_shards(thumbnail)):
+        for row, rel_path in enumerate(rel_paths):
+            missing.remove(rel_path)
+            print rel_path
+            feature_path = os.path.join(feature, rel_path).replace('.JPEG','.npy')
             if not os.path.exists(feature_path):
                 print 'making '+feature_path
-                X = np.load(thumbnail_path)
+                serial.mkdir(os.path.dirname(feature_path))
+                X = np.array(thumbs[row])
                 X = extractor(X)
                 np.save(feature_path,X)
-        else:
-            print 'No thumbnail!'
-            report.write(img_path)
+
+    # Images that failed to load or whose shard was never built
+    for rel_path in sorted(missing):
+        print 'No thumbnail for '+rel_path
+        report.write(os.path.join(xavier, rel_path)+'\n')
 
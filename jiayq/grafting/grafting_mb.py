@@ -189,6 +189,9 @@ class GrafterMPI:
         # other buffers
         self.localGradMat = np.zeros((self.nCodeLocal, self.nMetabins, self.nLabel), dtype = self.dtype)
         self.scoreVec = np.zeros((self.nCodeLocal, self.nMetabins),dtype=self.dtype) # the buffer to store local gradients for feature selection
+        # cache of the normalized features of the first nCachedCodes local codes, see cache_features()
+        self.nCachedCodes = 0
+        self.featCache = None
 
     def compute_feature(self, codeLocalid, metabinid, normalize=True, target = None):
         '''
@@ -202,12 +205,64 @@ class GrafterMPI:
         if normalize:
             fm.normalizev(target, self.mLocal[codeLocalid, metabinid], self.stdLocal[codeLocalid, metabinid])
 
-    def compute_feature_for_code(self, codeLocalid, normalize=True):
+    def compute_feature_for_code(self, codeLocalid, normalize=True, target = None):
         '''
-        compute all the features for codeLocalid and store them at featBufferPerCode
+        compute all the features for codeLocalid and store them at target
+        (default: featBufferPerCode)
         '''
+        if target is None:
+            target = self.featBufferPerCode
         for metabinid in range(self.nMetabins):
-            self.compute_feature(codeLocalid, metabinid,normalize=normalize, target=self.featBufferPerCode[metabinid])
+            self.compute_feature(codeLocalid, metabinid,normalize=normalize, target=target[metabinid])
+
+    def cache_features(self, max_codes = None, filename = None):
+        '''
+        precompute the normalized features of the local codes once, so that
+        selecting features by gradient becomes a single matrix product per
+        step instead of regenerating every feature. This needs
+        nCodeLocal*nMetabins*nData*sizeof(dtype) bytes per node.
+        ==Parameters==
+        max_codes: only cache the first max_codes local codes and compute
+            the rest on the fly, to bound the memory. Since every step scans
+            all the codes in the same order, a fixed subset is kept instead
+            of an LRU cache (which would evict every entry before its reuse).
+            Pass None to cache all the local codes.
+        filename: if given, the cache is a memory-mapped file at this
+            (node-local) path instead of being held in memory.
+        '''
+        if not self.normalized:
+            mpi.rootprint('Warning: caching features before normalizing the data.')
+        if max_codes is None:
+            nCachedCodes = self.nCodeLocal
+        else:
+            nCachedCodes = min(max_codes, self.nCodeLocal)
+        shape = (nCachedCodes, self.nMetabins, self.nData)
+        if filename is None:
+            self.featCache = np.empty(shape, dtype=self.dtype)
+        else:
+            self.featCache = np.memmap(filename, dtype=self.dtype, mode='w+', shape=shape)
+        timer = Timer()
+        for codeLocalid in range(nCachedCodes):
+            self.compute_feature_for_code(codeLocalid, normalize=True, target=self.featCache[codeLocalid])
+        self.nCachedCodes = nCachedCodes
+        mpi.nodeprint('Caching features of {} codes took {} secs.'.format(nCachedCodes, timer.lap()))
+
+    def clear_feature_cache(self):
+        self.featCache = None
+        self.nCachedCodes = 0
+
+    def get_feature(self, codeLocalid, metabinid, target = None):
+        '''
+        get the normalized feature from the cache if possible, and compute it
+        otherwise. The feature is put at target (default: self.featBuffer).
+        '''
+        if target is None:
+            target = self.featBuffer
+        if codeLocalid < self.nCachedCodes:
+            target[:] = self.featCache[codeLocalid, metabinid]
+        else:
+            self.compute_feature(codeLocalid, metabinid, target=target)
+        return target
 
     def dump_current_state(self, filename):
         # dump the current state: feature mean, std, selected features, and the classifier
@@ -226,6 +281,8 @@ class GrafterMPI:
     def normalize_data(self, m = None, std = None, sabotage = False):
         if self.normalized:
             mpi.rootprint('Warning: you are re-normalizing.')
+        # cached features are normalized with the old statistics
+        self.clear_feature_cache()
         if m is None or std is None:
             # if either is none, we recompute.
             for i in range(self.nCodeLocal):
@@ -274,12 +331,18 @@ class GrafterMPI:
                 self.featSlice[:,:,sid:sid+batchNdata] = matdata['feat']
                 sid += batchNdata
         elif rootRead:
-            # root reads the file, and then propagates the values to other machines
+            # root reads the file, and then scatters to each node only the
+            # codeRange slice it is responsible for, in one collective per batch.
             dataid = 0 # current feature id
-            dataBuffer = np.zeros(self.nBaseFeat, dtype = self.dtype)
+            # the code ranges of all the nodes, as computed in init_specs
+            codeStarts = np.minimum(np.arange(self.size) * self.ncode_per_node, self.nCodes)
+            codeEnds = np.minimum(codeStarts + self.ncode_per_node, self.nCodes)
             timer = Timer()
+            readTime = 0.
+            scatterTime = 0.
             for bid in allrange:
                 mpi.rootprint('RootRead: Loading batch {} of {}'.format(bid, nBatches))
+                timer.lap()
                 if self.rank == 0:
                     # read only of I am root
                     filename = os.path.join(root, file_template.format(batch_size, bid))
@@ -287,22 +350,32 @@ class GrafterMPI:
                     matdata = io.loadmat(filename)
                     feat = matdata['feat']
                     batchNdata = feat.shape[0]
-                else:
+                    # the data storage is like
+                    # [bin1_code1 bin1_code2 ... bin1_codeK bin2_code1 ... binN_codeK]
+                    # while our data is [nCodeLocal, nBins, nData], so we make it a
+                    # [nCodes, nBins, batchNdata] array where each node's slice is contiguous
+                    sendBuffer = np.ascontiguousarray(\
+                        feat.reshape(batchNdata, self.nBins, self.nCodes).transpose(2,1,0), dtype=self.dtype)
+                    matdata = None
                     feat = None
+                else:
+                    sendBuffer = None
                     batchNdata = 0
-                # broadcast the features
-                # it seems that doing this one-datum-by-one-datum is the fastest...
                 batchNdata = self.comm.bcast(batchNdata, root=0)
-                for batchfeatid in range(batchNdata):
-                    if self.rank == 0:
-                        dataBuffer[:] = feat[batchfeatid]
-                    self.comm.Bcast(dataBuffer, root = 0)
-                    # the data storage is like
-                    # [bin1_code1 bin1_code2 ... bin1_codeK bin2_code1 ... binN_codeK]
-                    # while our data is [nCodeLocal, nBins, nData]
-                    self.featSlice[:,:,dataid] = \
-                        dataBuffer.reshape(self.nBins, self.nCodes)[:,self.codeRange[0]:self.codeRange[1]].T
-                    dataid += 1
+                batchReadTime = timer.lap()
+                counts = (codeEnds - codeStarts) * self.nBins * batchNdata
+                displs = codeStarts * self.nBins * batchNdata
+                recvBuffer = np.empty((self.nCodeLocal, self.nBins, batchNdata), dtype=self.dtype)
+                # only double precision is supported (see init_specs)
+                self.comm.Scatterv([sendBuffer, [int(c) for c in counts], [int(d) for d in displs], MPI.DOUBLE], \
+                                   [recvBuffer, MPI.DOUBLE], root=0)
+                self.featSlice[:,:,dataid:dataid+batchNdata] = recvBuffer
+                dataid += batchNdata
+                sendBuffer = None
+                recvBuffer = None
+                batchScatterTime = timer.lap()
+                readTime += batchReadTime
+                scatterTime += batchScatterTime
                 if local_cache_root is not None:
                     # write local cache, so we may read it back later
                     filename = os.path.join(local_cache_root, file_template.format(batch_size, bid))
@@ -310,20 +383,24 @@ class GrafterMPI:
                         io.savemat(filename,{'feat': self.featSlice[:,:, dataid-batchNdata:dataid]}, oned_as='row')
                     except Exception, e:
                         mpi.nodeprint('Unable to save to local buffer {}'.format(filename))
-                mpi.rootprint('Elapsed {} secs.'.format(timer.lap()))
+                mpi.rootprint('Batch {}: read {} secs, scatter {} secs, elapsed {} secs.'.format(\
+                        bid, batchReadTime, batchScatterTime, timer.total()))
+            mpi.rootprint('RootRead: total read {} secs, total scatter {} secs.'.format(readTime, scatterTime))
         else:
             sid = 0
+            timer = Timer()
             # everyone for him/herself.
             for bid in allrange:
                 mpi.nodeprint('Loading batch {} of {}'.format(bid,nBatches))
                 filename = os.path.join(root, file_template.format(batch_size,bid))
                 matdata = io.loadmat(filename)
+                batchReadTime = timer.lap()
                 eid = sid + matdata['feat'].shape[0]
                 # load the data into featSlice
-                for i in range(sid,eid):
-                    self.featSlice[:,:,i] = \
-                        matdata['feat'][i-sid].reshape([self.nBins, self.nCodes])\
-                        [:,self.codeRange[0]:self.codeRange[1]].T
+                self.featSlice[:,:,sid:eid] = \
+                    matdata['feat'].reshape([eid-sid, self.nBins, self.nCodes])\
+                    [:,:,self.codeRange[0]:self.codeRange[1]].transpose(2,1,0)
+                mpi.nodeprint('Batch {}: read {} secs, reshape {} secs.'.format(bid, batchReadTime, timer.lap()))
                 if local_cache_root is not None:
                     # write local cache, so we may read it back later
                     filename = os.path.join(local_cache_root, file_template.format(batch_size, bid))
@@ -334,9 +411,39 @@ class GrafterMPI:
                 sid = eid
                 # this sometimes helps python do garbage collection
                 matdata = None
-        # load label
+        self.load_label(os.path.join(root, labelfile), isTest, should_normalize)
+
+    def load_data_stream(self, filename, labelfile, isTest = False, should_normalize = True, \
+                         batch_size = 1000):
+        '''
+        load the data from a single memory-mapped feature file written by
+        jiayq.imageclassify.pipeline.Pipeliner.stream_process_dataset, which
+        stores a [nData, nBins, nCodes] array. Each node pages in only the
+        codeRange slice it is responsible for, batch_size data at a time.
+        labelfile is the full path to the label file.
+        '''
+        feat = np.load(filename, mmap_mode='r')
+        if feat.shape[1] != self.nBins or feat.shape[2] != self.nCodes:
+            raise ValueError, 'Feature file layout {} does not match nBins={}, nCodes={}'.format(\
+                                feat.shape[1:], self.nBins, self.nCodes)
+        nData = min(self.nData, feat.shape[0])
+        timer = Timer()
+        for sid in range(0, nData, batch_size):
+            eid = min(sid + batch_size, nData)
+            # feat is [nData, nBins, nCodes] while featSlice is [nCodeLocal, nBins, nData]
+            self.featSlice[:,:,sid:eid] = \
+                feat[sid:eid, :, self.codeRange[0]:self.codeRange[1]].transpose(2,1,0)
+        mpi.nodeprint('Loading {} data from stream took {} secs.'.format(nData, timer.lap()))
+        feat = None
+        self.load_label(labelfile, isTest, should_normalize)
+
+    def load_label(self, labelfile, isTest = False, should_normalize = True):
+        '''
+        load the labels from labelfile (starting from either 0 or 1) and, for
+        the training data, normalize the features.
+        '''
         if self.rank == 0:
-            matdata = io.loadmat(os.path.join(root, labelfile))
+            matdata = io.loadmat(labelfile)
             # if the label starts with 1, make it start with 0
             if matdata['label'].min() == 1:
                 matdata['label'] -= 1
@@ -363,7 +470,7 @@ class GrafterMPI:
         # find the owner
         owner = int( codeid / self.ncode_per_node )
         if self.rank == owner:
-            self.compute_feature(codeid-self.codeRange[0],metabinid)
+            self.get_feature(codeid-self.codeRange[0],metabinid)
         self.comm.Bcast(self.featBuffer,root=owner)
         if self.dataSel is not None:
             self.dataSel[self.nSelFeats] = self.featBuffer
@@ -393,11 +500,15 @@ class GrafterMPI:
         self.gL = np.ascontiguousarray(gL_bnll(self.labels, self.curr_wxb).T, dtype=self.dtype)
 
         if samplePerRun == 1:
-            # this might take some time: for each feature, we basically
-            # need to regenerate features and compute the dot.
+            # the cached features are scored with one matrix product
+            if self.nCachedCodes > 0:
+                dot_Asafe(self.featCache.reshape(self.nCachedCodes*self.nMetabins, self.nData), self.gL, \
+                          self.localGradMat[:self.nCachedCodes].reshape(self.nCachedCodes*self.nMetabins, self.nLabel))
+            # this might take some time: for each feature that is not cached,
+            # we basically need to regenerate features and compute the dot.
             # to alleviate the problem a little bit, we regenerate a batch
             # every time
-            for codeLocalid in range(self.nCodeLocal):
+            for codeLocalid in range(self.nCachedCodes, self.nCodeLocal):
                 self.compute_feature_for_code(codeLocalid, normalize=True)
                 #self.localGradMat is a [self.nCodeLocal, self.nMetabins, self.nLabel] matrix
                 self.localGradMat[codeLocalid] = np.dot(self.featBufferPerCode, self.gL)
@@ -438,8 +549,8 @@ class GrafterMPI:
                 end = np.minimum(start+batchsize, sampleSize)
                 for j in range(start,end):
                     # we will use featBufferPerCode to store the computed features
-                    self.compute_feature(temp_feat_codelocalid[j], temp_feat_metabinid[j],\
-                                         target=self.featBufferPerCode[j-start])
+                    self.get_feature(temp_feat_codelocalid[j], temp_feat_metabinid[j],\
+                                     target=self.featBufferPerCode[j-start])
                 temp_gradMat = np.dot(self.featBufferPerCode[:end-start], self.gL)
                 temp_scoreVec = np.sum(temp_gradMat**2, axis=1)
                 temp_opt_feat_id = temp_scoreVec.argmax()
@@ -456,13 +567,18 @@ class GrafterMPI:
 
         return opt_feat_score, opt_feat_codeid, opt_feat_metabinid
 
-    def retrain_model(self, nActiveSet=None, samplePerRun = 1.0, factr = 10, pgtol = 1e-08, iprint=-1):
+    def retrain_model(self, nActiveSet=None, samplePerRun = 1.0, factr = 10, pgtol = 1e-08, iprint=-1, \
+                      warmStart = False):
         '''
         train the current model. Since we often have multiple labels, we will ask
         each node to do one optimization
+        nActiveSet: see graft(). nActiveSet = 1 only optimizes the latest feature
+            (and the bias), and updates curr_wxb with a rank-one correction.
+        warmStart: if True, start the optimization from the current weights and
+            bias instead of from scratch, also when retraining the whole model.
         '''
         loss = 0
-        if nActiveSet is not None and np.abs(nActiveSet) < self.nSelFeats:
+        if nActiveSet is not None and nActiveSet < 0 and -nActiveSet < self.nSelFeats:
             # gradient computation will be carried out only when necessary
             gw_local = np.zeros((self.nLabel, self.nSelFeats), dtype = self.dtype)
             gw_reduced = np.zeros((self.nLabel, self.nSelFeats), dtype = self.dtype)
@@ -476,7 +592,7 @@ class GrafterMPI:
             else:
                 # compute each one
                 for feat in my_features:
-                    self.compute_feature(self.selCodeID[feat]-self.codeRange[0], self.selMetabinID[feat])
+                    self.get_feature(self.selCodeID[feat]-self.codeRange[0], self.selMetabinID[feat])
                     gw_local[:,feat] = np.dot(self.featBuffer, self.gL) + \
                                        self.gamma * self.nData * self.weights[:,feat]
             # reduce gw_local so we all have the gradients. There will be only one non-zero element
@@ -512,15 +628,21 @@ class GrafterMPI:
                     dataActiveSet = np.empty((len(weight_range), self.nData), dtype = self.dtype)
                     dataActiveSet[:] = self.dataSel[weight_range]
                 # update curr_wxb
-                if nActiveSet is None:
+                if nActiveSet is None and not warmStart:
                     # completely retrain
                     self.curr_wxb[idx] = 0
                     self.b[idx] = 0
                     self.weights[idx] = 0
+                elif nActiveSet is None or np.abs(nActiveSet) >= self.nSelFeats:
+                    # all the features are active, so only the bias remains.
+                    # This also removes the drift of the rank-one corrections.
+                    self.curr_wxb[idx] = self.b[idx]
                 else:
                     self.curr_wxb[idx] -= np.dot(self.weights[idx,weight_range], dataActiveSet)
+                # when warm starting, the bias is already in curr_wxb and we
+                # optimize its increment
                 opt_return = optimize.fmin_l_bfgs_b(ObjFuncIncrement, \
-                        np.hstack((self.weights[idx,weight_range], 1.0)),\
+                        np.hstack((self.weights[idx,weight_range], 0.0 if warmStart else 1.0)),\
                         args = (dataActiveSet, \
                                 self.labels[idx], \
                                 self.curr_wxb[idx], \
@@ -689,7 +811,11 @@ class GrafterMPI:
               tester = None, \
               test_every = 10, \
               samplePerRun = 1, \
-              fromDumpFile = None \
+              fromDumpFile = None, \
+              cache_max_codes = 0, \
+              incremental = False, \
+              full_retrain_every = 0, \
+              full_retrain_tol = None \
              ):
         '''
         the main grafting algorithm
@@ -707,6 +833,19 @@ class GrafterMPI:
         samplePerRun: in each feature selection run, how many features (in proportions)
             we should sample to select feature from. Pass 1 to enumerate all features.
         fromDumpFile: restore from dump file (not implemented for the mb version yet)
+        cache_max_codes: the number of local codes whose features are precomputed
+            before grafting (see cache_features). Pass 0 to not cache, and None
+            to cache all the local codes (fastest, if memory allows).
+        incremental: if True, nActiveSet is ignored and each round only optimizes
+            the weight of the new feature, warm-started from the previous model,
+            so that the cost of a round does not grow with the number of selected
+            features. The whole model is then retrained (also warm-started)
+            according to full_retrain_every and full_retrain_tol.
+        full_retrain_every: in incremental mode, retrain the whole model every
+            this many rounds. 0 to disable.
+        full_retrain_tol: in incremental mode, retrain the whole model when the
+            relative loss reduction of a round falls below this value. None to
+            disable.
         '''
         self.comm.barrier()
         mpi.rootprint('*'*38)
@@ -724,6 +863,8 @@ class GrafterMPI:
         mpi.rootprint('Graft Settings:')
         mpi.rootprint('dump_every = {}\nnActiveSet={}\ntest_every={}\nsamplePerRun={}'.format(\
                             dump_every, nActiveSet, test_every, samplePerRun))
+        mpi.rootprint('incremental={}\nfull_retrain_every={}\nfull_retrain_tol={}'.format(\
+                            incremental, full_retrain_every, full_retrain_tol))
         self.comm.barrier()
 
         if tester is not None:
@@ -731,8 +872,11 @@ class GrafterMPI:
             tester.normalize_data(self.mLocal, self.stdLocal)
         if fromDumpFile is not None:
             self.restore_from_dump_file(fromDumpFile, tester)
+        if cache_max_codes != 0 and self.featCache is None:
+            self.cache_features(cache_max_codes)
 
         old_loss = 1e10
+        rounds_since_full = 0
         timer = Timer()
         itertimer = Timer()
         for T in range(self.nSelFeats, self.maxGraftDim):
@@ -745,7 +889,16 @@ class GrafterMPI:
             mpi.rootprint('Number of Features: {}'.format(self.nSelFeats))
             mpi.rootprint('Feature selection took {} secs'.format(itertimer.lap()))
             mpi.rootprint('Retraining the model...')
-            loss = self.retrain_model(nActiveSet, samplePerRun)
+            if incremental:
+                loss = self.retrain_model(1, samplePerRun, warmStart = True)
+                rounds_since_full += 1
+                if (full_retrain_every > 0 and rounds_since_full >= full_retrain_every) or \
+                   (full_retrain_tol is not None and (old_loss - loss) / old_loss < full_retrain_tol):
+                    mpi.rootprint('Retraining the whole model...')
+                    loss = self.retrain_model(None, samplePerRun, warmStart = True)
+                    rounds_since_full = 0
+            else:
+                loss = self.retrain_model(nActiveSet, samplePerRun)
             mpi.rootprint('Total loss reduction {}/{}={}'.format(loss, old_loss, loss/old_loss))
             mpi.rootprint('Current training accuracy: {}'.format(self.compute_current_accuracy()))
             mpi.rootprint('Model retraining took {} secs'.format(itertimer.lap()))
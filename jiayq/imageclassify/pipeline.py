@@ -1,4 +1,6 @@
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from numpy.lib.format import open_memmap
 from matplotlib import cm,pyplot
 from jiayq.utils import gemm, fastop, mpiutils
 from jiayq import kmeans
@@ -54,37 +56,111 @@ class PatchExtractor:
         else:
             return patches
 
-    def denseExtract(self, image, positionNormalize = True):
+    def windows(self, image, batch = False):
+        '''
+        returns a zero-copy sliding window view of the image, of shape
+        (nh, nw, psize[0], psize[1]) for grayscale images and
+        (nh, nw, psize[0], psize[1], nChannels) for color images, where
+        nh and nw are the number of patch positions along the height and
+        width with the current stride. If batch is True, image is a stack
+        of images and the view has the same leading dimension as well.
+        '''
+        image = np.asarray(image)
+        batchaxes = 1 if batch else 0
+        h = image.shape[batchaxes]
+        w = image.shape[batchaxes+1]
+        nh = max(0, (h - self.psize[0]) / self.stride + 1)
+        nw = max(0, (w - self.psize[1]) / self.stride + 1)
+        strides = image.strides
+        shape = image.shape[:batchaxes] + (nh, nw, self.psize[0], self.psize[1]) + \
+                image.shape[batchaxes+2:]
+        newstrides = strides[:batchaxes] + \
+                     (strides[batchaxes]*self.stride, strides[batchaxes+1]*self.stride,\
+                      strides[batchaxes], strides[batchaxes+1]) + \
+                     strides[batchaxes+2:]
+        return as_strided(image, shape=shape, strides=newstrides)
+
+    def densePositions(self, imheight, imwidth, positionNormalize = True):
+        '''
+        returns the (relative) positions of the densely extracted patches
+        as a 2*nPatches matrix, and the (height,width) of the patch grid.
+        '''
+        idxh = np.arange(0,imheight-self.psize[0]+1,self.stride)
+        idxw = np.arange(0,imwidth-self.psize[1]+1,self.stride)
+        if positionNormalize:
+            positions = np.vstack( ((np.repeat(idxh,len(idxw))+0.5) / np.float(imheight-self.psize[0]+1),\
+                                (np.tile(idxw,len(idxh))+0.5) / np.float(imwidth-self.psize[0]+1) ) )
+        else:
+            positions = np.vstack( (np.repeat(idxh,len(idxw)), np.tile(idxw,len(idxh))) )
+        return positions, (len(idxh), len(idxw))
+
+    def checkOut(self, out, shape):
+        '''
+        checks that out can be used as an output buffer of the given shape.
+        The patches are written through a reshaped view of out, which
+        would silently be a copy if out were not C-contiguous.
+        '''
+        if out.shape != shape:
+            raise exceptions.ValueError, \
+                "PatchExtractor: out has shape {}, expected {}.".format(out.shape, shape)
+        if not out.flags.c_contiguous:
+            raise exceptions.ValueError, "PatchExtractor: out should be C-contiguous."
+        return out
+
+    def denseExtract(self, image, positionNormalize = True, out = None):
         '''
         dense extraction of image patches with a given stride
         returns the patches and the relative positions, and
         the (height,width) pair that can be used
         to reconstruct the patches to a height*width*Dim cube
+
+        The patches are gathered from a sliding window view of the image
+        in a single copy. If out is given, it should be a C-contiguous
+        nPatches*Dim float64 matrix and is used as the output buffer.
         '''
-        imheight = image.shape[0]
-        imwidth = image.shape[1]
-        stride = self.stride
-        idxh = range(0,imheight-self.psize[0]+1,stride)
-        idxw = range(0,imwidth-self.psize[1]+1,stride)
-        nPatches= len(idxh)*len(idxw)
+        view = self.windows(image)
+        nPatches = view.shape[0] * view.shape[1]
         if nPatches == 0:
             return np.array([])
-        patches = np.empty((nPatches,self.Dim))
-        curr = 0
-        for i in idxh:
-            for j in idxw:
-                patches[curr] = image[i:i+self.psize[0],j:j+self.psize[1]].flat
-                curr += 1
+        if out is None:
+            patches = np.empty((nPatches,self.Dim))
+        else:
+            patches = self.checkOut(out, (nPatches,self.Dim))
+        patches.reshape(view.shape)[...] = view
         self.normalizePatches(patches)
-        if positionNormalize:
-            positions = np.vstack( ((np.tile(idxh,(len(idxw),1)).T.flatten()+0.5) / np.float(imheight-self.psize[0]+1),\
-                                (np.tile(idxw,len(idxh))+0.5) / np.float(imwidth-self.psize[0]+1) ) )
+        positions, gridshape = self.densePositions(image.shape[0], image.shape[1], positionNormalize)
+        return patches, positions, gridshape
+
+    def denseExtractBatch(self, images, positionNormalize = True, out = None):
+        '''
+        dense extraction of a batch of images at once. images should be
+        either a list of images of the same size, or an array whose first
+        dimension indexes the images. Returns the patches as a
+        (nImages*nPatches)*Dim matrix, where the patches of image i occupy
+        rows [i*nPatches, (i+1)*nPatches), together with the positions and
+        the (height,width) pair of a single image, which are shared by
+        all images in the batch.
+        '''
+        if type(images) is list:
+            images = np.array(images)
+        view = self.windows(images, batch=True)
+        nImages = images.shape[0]
+        nPatches = view.shape[1] * view.shape[2]
+        if nPatches == 0:
+            return np.array([])
+        if out is None:
+            patches = np.empty((nImages*nPatches, self.Dim))
         else:
-            positions = np.vstack( (np.tile(idxh,(len(idxw),1)).T.flatten(),\
-                                np.tile(idxw,len(idxh))) )
-        return patches, positions, (len(idxh), len(idxw))
+            patches = self.checkOut(out, (nImages*nPatches, self.Dim))
+        patches.reshape(view.shape)[...] = view
+        self.normalizePatches(patches)
+        positions, gridshape = self.densePositions(images.shape[1], images.shape[2], positionNormalize)
+        return patches, positions, gridshape
 
     def normalizePatches(self,patches):
+        '''
+        normalizes the patches in place.
+        '''
         if self.normalize == 'meanvar':
             # subtract the mean, and normalize the contrast
             if 'reg' in self.specs.keys():
@@ -92,18 +168,26 @@ class PatchExtractor:
             else:
                 # default parameter
                 reg = 10.0
-            patches -= np.mean(patches,axis=1).reshape((patches.shape[0],1))
-            patches /= (np.sqrt(np.mean(patches**2,axis=1))+reg).reshape((patches.shape[0],1))
+            patches -= np.mean(patches,axis=1)[:,np.newaxis]
+            norm = np.einsum('ij,ij->i', patches, patches)
+            norm /= patches.shape[1]
+            np.sqrt(norm, out=norm)
+            norm += reg
+            patches /= norm[:,np.newaxis]
         elif self.normalize == 'unitball':
             try:
                 reg = self.specs['reg']
-            except KeyErrorw:
+            except KeyError:
                 # default parameter
                 # we set this to the default parameter as used by
                 # Andrew Ng in his AISTATS10 paper.
                 reg = 10.0
             # move everything onto the unit ball
-            patches /= (np.sqrt(np.mean(patches**2,axis=1))+reg).reshape((patches.shape[0],1))
+            norm = np.einsum('ij,ij->i', patches, patches)
+            norm /= patches.shape[1]
+            np.sqrt(norm, out=norm)
+            norm += reg
+            patches /= norm[:,np.newaxis]
         else:
             # do nothing
             pass
@@ -311,7 +395,11 @@ class DictTrainer:
                 verbose = self.specs['verbose']
             if 'ninit' in self.specs.keys():
                 ninit = self.specs['ninit']
-            self.dictionary = kmeans.kmeans(patches, self.K, n_init = ninit, max_iter=maxiter, verbose=verbose)[0]
+            # the k-means algorithm: 'lloyd', 'hamerly' or 'minibatch'
+            kmeansmethod = self.specs.get('kmeansmethod', 'lloyd')
+            batchsize = self.specs.get('batchsize', 1000)
+            self.dictionary = kmeans.kmeans(patches, self.K, n_init = ninit, max_iter=maxiter, verbose=verbose,
+                                            method=kmeansmethod, batch_size=batchsize)[0]
         elif self.method == 'random':
             idx = np.array(range(patches.shape[0]))
             np.random.shuffle(idx)
@@ -346,7 +434,10 @@ class PatchEncoder:
         elif self.method == 'tri':
             distance = kmeans.euclidean_distances(patches,self.dictionary)
             mu = np.mean(distance,axis=1)
-            encoded = np.maximum(0.0,mu.reshape(mu.size,1)-distance)
+            # compute max(0, mu - distance) in place
+            distance *= -1.0
+            distance += mu.reshape(mu.size,1)
+            encoded = np.maximum(0.0, distance, out=distance)
         else:
             raise exceptions.NotImplementedError, "Not Implemented."
         return encoded
@@ -374,6 +465,25 @@ class SpatialPooler:
             raise exceptions.NotImplementedError, 'Not Implemented.'
         return output
 
+    def pool_batch(self, activations, positions, nImages):
+        '''
+        pools the activations of a batch of nImages images in one call.
+        activations is a (nImages*nPatches)*K matrix where the patches of
+        each image are stored consecutively, and positions are the patch
+        positions shared by all images. Returns a nImages*nBins*K array.
+        '''
+        hwbins = (positions * np.array(self.grid).reshape(2,1)).astype(np.int)
+        bins = hwbins[0]*self.grid[1] + hwbins[1]
+        # give every (image, bin) pair its own segment id
+        bins = (np.arange(nImages).reshape(nImages,1) * self.nBins + bins).flatten()
+        if self.method == 'max':
+            output = fastop.fastmaximums(activations, bins, nImages*self.nBins)[0]
+        elif self.method == 'ave':
+            output = fastop.fastcenters(activations, bins, nImages*self.nBins)[0]
+        else:
+            raise exceptions.NotImplementedError, 'Not Implemented.'
+        return output.reshape((nImages, self.nBins, output.shape[1]))
+
 class Pipeliner:
     # the parameters are set to be Andrew Ng's default parameters
     def __init__(self, extractor = PatchExtractor(6,nChannels=3,normalize='meanvar'), \
@@ -408,9 +518,27 @@ class Pipeliner:
         pooled = self.pooler.pool(activations, positions)
         return pooled
 
-    def process_dataset(self, dataset, fromTraining = True, start = 0, end = None):
+    def process_batch(self, images):
+        '''
+        processes a batch of equally sized images at once: the patches of
+        all images are whitened and encoded with one large matrix product
+        each. Returns a nImages*nFeatures matrix.
+        '''
+        patches, positions = self.extractor.denseExtractBatch(images)[:2]
+        patches = self.preprocessor.process(patches)
+        activations = self.encoder.encode(patches)
+        pooled = self.pooler.pool_batch(activations, positions, len(images))
+        return pooled.reshape((pooled.shape[0], pooled.shape[1]*pooled.shape[2]))
+
+    def process_dataset(self, dataset, fromTraining = True, start = 0, end = None, minibatch = 1):
         '''
         process the whole dataset. Warning: may be very time-consuming.
+        By default images are processed one by one with process_single.
+        With minibatch > 1, up to minibatch consecutive images of the same
+        size are processed at a time with process_batch. The peak memory
+        is then roughly minibatch * nPatches * (Dim + nFeatures) doubles,
+        e.g. about 2GB for 100 32x32 images with the default 'thres'
+        encoder and 1600 codes.
         '''
         if end is None:
             if fromTraining:
@@ -423,12 +551,30 @@ class Pipeliner:
         # the features are sorted as
         # [bin1feat1,bin1feat2....bin2feat1,bin2feat2....binMfeatN]
         data = np.empty((end-start,pooled.size))
-        for idx in range(start,end):
-            data[idx-start] = self.process_single(dataset.image(idx, fromTraining)).flatten()
+        if minibatch <= 1:
+            for idx in range(start,end):
+                data[idx-start] = self.process_single(dataset.image(idx, fromTraining)).flatten()
+            return data
+        for batchstart in range(start, end, minibatch):
+            batchend = min(batchstart + minibatch, end)
+            images = [dataset.image(idx, fromTraining) for idx in range(batchstart, batchend)]
+            # only images of the same size can be stacked, so each run of
+            # equally sized images is processed as one batch
+            runstart = 0
+            while runstart < len(images):
+                runend = runstart + 1
+                while runend < len(images) and images[runend].shape == images[runstart].shape:
+                    runend += 1
+                offset = batchstart - start
+                if runend - runstart == 1:
+                    data[offset+runstart] = self.process_single(images[runstart]).flatten()
+                else:
+                    data[offset+runstart:offset+runend] = self.process_batch(np.array(images[runstart:runend]))
+                runstart = runend
         return data
 
     def batch_process_dataset(self, dataset, batchsize = 1000, filename_template = '{}_{}.mat',
-                              fromTraining = True):
+                              fromTraining = True, minibatch = 1):
         '''
         process the whole dataset. Warning: may be very time-consuming.
         '''
@@ -442,7 +588,52 @@ class Pipeliner:
             mpiutils.nodeprint('Batch {} of {}'.format(batchid, Nbatches))
             start = batchsize * batchid
             end = min(start+batchsize, Nimages)
-            feat = Pipeliner.process_dataset(self, dataset, fromTraining, start, end)
+            feat = Pipeliner.process_dataset(self, dataset, fromTraining, start, end, minibatch)
             io.savemat(filename_template.format(batchsize, batchid),\
                        {'feat':feat}, oned_as='rows')
 
+    def stream_process_dataset(self, dataset, filename, batchsize = 1000, fromTraining = True,
+                               minibatch = 1, dtype = np.float64):
+        '''
+        process the whole dataset, writing the features of all MPI nodes
+        directly into a single preallocated memory-mapped .npy file instead
+        of one .mat file per batch. The array stored in the file has shape
+        [Nimages, nBins, nCodes], so its header describes the bins/codes
+        layout; use load_feature_stream() to read it back.
+        '''
+        if fromTraining:
+            Nimages = dataset.Ntrain
+        else:
+            Nimages = dataset.Ntest
+        # run the first image to obtain the [nBins, nCodes] layout
+        layout = self.process_single(dataset.image(0, fromTraining)).shape
+        if mpiutils.rank == 0:
+            feat = open_memmap(filename, mode='w+', dtype=dtype, shape=(Nimages,)+layout)
+            feat.flush()
+            del feat
+        mpiutils.safebarrier()
+        feat = open_memmap(filename, mode='r+')
+        Nbatches = (Nimages+batchsize-1) / batchsize
+        for batchid in range(mpiutils.rank, Nbatches, mpiutils.size):
+            mpiutils.nodeprint('Batch {} of {}'.format(batchid, Nbatches))
+            start = batchsize * batchid
+            end = min(start+batchsize, Nimages)
+            feat[start:end] = Pipeliner.process_dataset(self, dataset, fromTraining, start, end, minibatch)\
+                                .reshape((end-start,)+layout)
+            feat.flush()
+        del feat
+        mpiutils.safebarrier()
+
+def load_feature_stream(filename, start = 0, end = None, flatten = False):
+    '''
+    reads the features written by Pipeliner.stream_process_dataset. The
+    file is memory-mapped, so only the slices that are actually accessed are
+    paged in. Returns a read-only [N, nBins, nCodes] array for images
+    start to end, or a N*(nBins*nCodes) matrix in the same order as
+    Pipeliner.process_dataset if flatten is True (which reads the slice).
+    '''
+    feat = np.load(filename, mmap_mode='r')[start:end]
+    if flatten:
+        return np.array(feat).reshape((feat.shape[0], feat.shape[1]*feat.shape[2]))
+    else:
+        return feat
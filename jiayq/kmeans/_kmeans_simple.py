@@ -20,30 +20,118 @@ comm = mpiutils.comm
 rank = mpiutils.rank
 size = mpiutils.size
 
-def euclidean_distances(X, Y=None, Y_norm_squared=None,squared=False):
+def euclidean_distances(X, Y=None, Y_norm_squared=None,squared=False, X_norm_squared=None, out=None):
+    """Computes the euclidean distances between the rows of X and Y
+
+    The computation is carried out in the dtype of X, so float32 input
+    gives float32 distances. If out is given, it should be a C-contiguous
+    X.shape[0] * Y.shape[0] array of dtype np.result_type(X, Y), and the
+    distances are written into it without allocating a new distance
+    matrix.
+    """
     if Y is None:
         Y = X
     if Y_norm_squared is None:
         Y_norm_squared = np.sum(Y**2,axis=1)
-    X_norm_squared = np.sum(X**2,axis=1)
-    distance = gemm.mygemm(-2.0, X, Y.T)
-    #distance = np.dot(X,Y.T)*-2.0
+    if X_norm_squared is None:
+        X_norm_squared = np.sum(X**2,axis=1)
+    if out is None:
+        distance = gemm.mygemm(-2.0, X, Y.T)
+        #distance = np.dot(X,Y.T)*-2.0
+    else:
+        distance = np.dot(X, Y.T, out=out)
+        distance *= -2.0
     distance += Y_norm_squared
     distance += np.atleast_2d(X_norm_squared).T
     if squared:
         return distance
     else:
-        return np.sqrt(distance)
+        # clip the small negative values due to numerical errors
+        np.maximum(distance, 0, out=distance)
+        return np.sqrt(distance, out=distance)
 
-def l1_distance(X,Y=None):
+def l1_distance(X,Y=None, out=None, block_bytes=2**26):
+    """Computes the l1 distances between the rows of X and Y
+
+    The rows of X are processed in blocks so that the intermediate
+    block_size * Y.shape[0] * n_features difference tensor takes at most
+    block_bytes bytes. out is an optional output buffer as in
+    euclidean_distances.
+    """
     if Y is None:
         Y = X
-    distance = np.empty((X.shape[0], Y.shape[0]))
-    for i in range(X.shape[0]):
-        distance[i] = np.sum(np.abs(Y - X[i]),axis=1)
+    if out is None:
+        distance = np.empty((X.shape[0], Y.shape[0]), dtype=np.result_type(X.dtype, Y.dtype))
+    else:
+        distance = out
+    block_size = max(1, int(block_bytes / (Y.size * distance.itemsize)))
+    for start in range(0, X.shape[0], block_size):
+        end = min(X.shape[0], start + block_size)
+        np.sum(np.abs(X[start:end, np.newaxis, :] - Y[np.newaxis]), axis=2, out=distance[start:end])
     return distance
 
-def k_init(X, k, n_local_trials=None, x_squared_norms=None):
+def pairwise_argmin_min(X, Y, distance='l2', Y_norm_squared=None, X_norm_squared=None,
+                        block_size=1000, buffer=None):
+    """Finds the closest row of Y for each row of X
+
+    The distances are computed block_size rows of X at a time into a
+    single reusable buffer, so the full X.shape[0] * Y.shape[0] distance
+    matrix is never materialized.
+
+    Parameters
+    ----------
+    X: array, shape (n_samples, n_features)
+
+    Y: array, shape (k, n_features)
+
+    distance: string, optional
+        'l2' (which gives squared euclidean distances) or 'l1'
+
+    Y_norm_squared, X_norm_squared: array, optional
+        Precomputed squared norms of the rows of Y and X, for 'l2' only.
+
+    block_size: int, optional
+        The number of rows of X processed at a time.
+
+    buffer: array, optional
+        A C-contiguous array with at least block_size*k elements of
+        dtype np.result_type(X, Y), used to hold the distances of a block.
+
+    Returns
+    -------
+    argmin: array of shape(n_samples)
+        The index of the closest row of Y
+
+    mindist: array of shape(n_samples)
+        The distance to the closest row of Y
+    """
+    n_samples = X.shape[0]
+    k = Y.shape[0]
+    dtype = np.result_type(X.dtype, Y.dtype)
+    if buffer is None:
+        buffer = np.empty(min(block_size, n_samples) * k, dtype=dtype)
+    if distance == 'l2' or distance == 'euclidean':
+        if Y_norm_squared is None:
+            Y_norm_squared = np.sum(Y**2,axis=1)
+        if X_norm_squared is None:
+            X_norm_squared = np.sum(X**2,axis=1)
+    argmin = np.empty(n_samples, dtype=np.int)
+    mindist = np.empty(n_samples, dtype=dtype)
+    for start in range(0, n_samples, block_size):
+        end = min(n_samples, start + block_size)
+        out = buffer[:(end - start) * k].reshape((end - start, k))
+        if distance == 'l2' or distance == 'euclidean':
+            euclidean_distances(X[start:end], Y, Y_norm_squared, squared=True,
+                                X_norm_squared=X_norm_squared[start:end], out=out)
+        elif distance == 'l1':
+            l1_distance(X[start:end], Y, out=out)
+        else:
+            raise exceptions.NotImplementedError, "Kmeans distance not implemented"
+        out.argmin(axis=1, out=argmin[start:end])
+        mindist[start:end] = out[np.arange(end - start), argmin[start:end]]
+    return argmin, mindist
+
+def k_init(X, k, n_local_trials=None, x_squared_norms=None, sample_weight=None):
     """Init k seeds according to kmeans++
 
     Parameters
@@ -64,6 +152,10 @@ def k_init(X, k, n_local_trials=None, x_squared_norms=None):
         Squared euclidean norm of each data point. Pass it if you have it at
         hands already to avoid it being recomputed here. Default: None
 
+    sample_weight: array, shape (n_samples,), optional
+        The weight of each data point, which multiplies its sampling
+        probability. Used by k_init_parallel. Default: None
+
     Notes
     ------
     Selects initial cluster centers for k-mean clustering in a smart way
@@ -85,8 +177,12 @@ def k_init(X, k, n_local_trials=None, x_squared_norms=None):
         # that it helped.
         n_local_trials = 2 + int(np.log(k))
 
+    if sample_weight is None:
+        sample_weight = np.ones(n_samples)
+
     # Pick first center randomly
-    center_id = np.random.randint(n_samples)
+    center_id = np.searchsorted(sample_weight.cumsum(),
+                                np.random.random_sample() * sample_weight.sum())
     centers[0] = X[center_id]
 
     # Initialize list of closest distances and calculate current potential
@@ -94,46 +190,144 @@ def k_init(X, k, n_local_trials=None, x_squared_norms=None):
         x_squared_norms = np.sum(X**2,axis=1)
     closest_dist_sq = euclidean_distances(
         np.atleast_2d(centers[0]), X, Y_norm_squared=x_squared_norms,
-        squared=True)
-    current_pot = closest_dist_sq.sum()
+        squared=True)[0]
+    current_pot = np.dot(sample_weight, closest_dist_sq)
 
     # Pick the remaining k-1 points
     for c in range(1, k):
         # Choose center candidates by sampling with probability proportional
         # to the squared distance to the closest existing center
         rand_vals = np.random.random_sample(n_local_trials) * current_pot
-        candidate_ids = np.searchsorted(closest_dist_sq.cumsum(), rand_vals)
+        candidate_ids = np.searchsorted((sample_weight * closest_dist_sq).cumsum(), rand_vals)
+        candidate_ids = np.minimum(candidate_ids, n_samples - 1)
 
         # Compute distances to center candidates
         distance_to_candidates = euclidean_distances(
             X[candidate_ids], X, Y_norm_squared=x_squared_norms, squared=True)
 
-        # Decide which candidate is the best
-        best_candidate = None
-        best_pot = None
-        best_dist_sq = None
-        for trial in xrange(n_local_trials):
-            # Compute potential when including center candidate
-            new_dist_sq = np.minimum(closest_dist_sq,
-                                     distance_to_candidates[trial])
-            new_pot = new_dist_sq.sum()
-
-            # Store result if it is the best local trial so far
-            if (best_candidate is None) or (new_pot < best_pot):
-                best_candidate = candidate_ids[trial]
-                best_pot = new_pot
-                best_dist_sq = new_dist_sq
+        # Compute the potential when including each center candidate, and
+        # decide which candidate is the best
+        new_dist_sq = np.minimum(closest_dist_sq, distance_to_candidates)
+        new_pot = np.dot(new_dist_sq, sample_weight)
+        best_trial = np.argmin(new_pot)
 
         # Permanently add best center candidate found in local tries
-        centers[c] = X[best_candidate]
-        current_pot = best_pot
-        closest_dist_sq = best_dist_sq
+        centers[c] = X[candidate_ids[best_trial]]
+        current_pot = new_pot[best_trial]
+        closest_dist_sq = new_dist_sq[best_trial]
+    return centers
+
+def k_init_parallel(X, k, oversampling_factor=None, n_rounds=5, x_squared_norms=None, n_refine=5,
+                    parallel=True):
+    """Init k seeds according to k-means|| over all the MPI nodes
+
+    Parameters
+    -----------
+    X: array, shape (n_samples, n_features)
+        The local data points of this node to pick seeds from
+
+    k: integer
+        The number of seeds to choose
+
+    oversampling_factor: float, optional
+        The expected number of candidates sampled over all the nodes in
+        each round. Default: 2*k
+
+    n_rounds: integer, optional
+        The number of sampling rounds. Default: 5
+
+    x_squared_norms: array, shape (n_samples,), optional
+        Squared euclidean norm of each local data point. Default: None
+
+    n_refine: integer, optional
+        The number of weighted Lloyd iterations run on the candidates after
+        the k-means++ reduction. Default: 5
+
+    parallel: boolean, optional
+        If False, X is all the data and no MPI communication is done, so
+        each node seeds on its own. Default: True
+
+    Notes
+    ------
+    In each round, every node independently samples each of its points
+    with probability proportional to its squared distance to the closest
+    candidate so far, and the new candidates are shared with allgather.
+    The candidates are then weighted by the number of points closest to
+    them, and the root reduces them to k seeds with weighted k-means++,
+    which are broadcast to all the nodes. See: Bahmani et al. "Scalable
+    k-means++". VLDB 2012.
+    """
+    n_samples, n_features = X.shape
+    if oversampling_factor is None:
+        oversampling_factor = 2.0 * k
+    if x_squared_norms is None:
+        x_squared_norms = np.sum(X**2,axis=1)
+
+    # Pick the first candidate randomly from a random node
+    candidates = np.empty((1, n_features))
+    if parallel:
+        president = mpiutils.vote()
+        if rank == president:
+            candidates[0] = X[np.random.randint(n_samples)]
+        comm.Bcast(candidates, root=president)
+    else:
+        candidates[0] = X[np.random.randint(n_samples)]
+    closest_dist_sq = _e_step(X, candidates, 'l2', x_squared_norms=x_squared_norms,
+                              return_distances=True)[2]
+
+    for r in range(n_rounds):
+        potential = closest_dist_sq.sum()
+        if parallel:
+            potential = comm.allreduce(potential)
+        if potential <= 0:
+            break
+        prob = oversampling_factor * closest_dist_sq / potential
+        new_candidates = X[np.random.random_sample(n_samples) < prob]
+        if parallel:
+            new_candidates = np.vstack(comm.allgather(new_candidates))
+        if new_candidates.shape[0] == 0:
+            continue
+        new_dist_sq = _e_step(X, new_candidates, 'l2', x_squared_norms=x_squared_norms,
+                              return_distances=True)[2]
+        np.minimum(closest_dist_sq, new_dist_sq, out=closest_dist_sq)
+        candidates = np.vstack((candidates, new_candidates))
+
+    # weight each candidate by the number of points closest to it
+    labels = _e_step(X, candidates, 'l2', x_squared_norms=x_squared_norms)[0]
+    local_weights = np.bincount(labels, minlength=candidates.shape[0]).astype(np.float64)
+    if parallel:
+        weights = np.empty_like(local_weights)
+        comm.Allreduce(local_weights, weights)
+    else:
+        weights = local_weights
+
+    centers = np.empty((k, n_features))
+    if not parallel or rank == 0:
+        if candidates.shape[0] <= k:
+            # not enough candidates: use all of them and fill up randomly
+            centers[:candidates.shape[0]] = candidates
+            centers[candidates.shape[0]:] = \
+                candidates[np.random.randint(candidates.shape[0], size=k-candidates.shape[0])]
+        else:
+            centers[:] = k_init(candidates, k, sample_weight=weights)
+            # refine with a few weighted Lloyd iterations on the candidates
+            weighted_candidates = candidates * weights.reshape(weights.size, 1)
+            for i in range(n_refine):
+                z = _e_step(candidates, centers, 'l2')[0]
+                means, counts = fastop.fastcenters(weighted_candidates, z, k)
+                sums = means * counts.reshape(k, 1)
+                center_weights = np.bincount(z, weights=weights, minlength=k)
+                nonempty = np.flatnonzero(center_weights > 0)
+                centers[nonempty] = sums[nonempty] / center_weights[nonempty].reshape(nonempty.size, 1)
+    if parallel:
+        comm.Bcast(centers, root=0)
     return centers
 
 ###############################################################################
 # K-means estimation by EM (expectation maximisation)
 
-def kmeans(X, k, init=None, n_init=1, max_iter=300, verbose=0, tol=1e-4, distance='l2', parallel = True):
+def kmeans(X, k, init=None, n_init=1, max_iter=300, verbose=0, tol=1e-4, distance='l2', parallel = True,
+           method='lloyd', batch_size=1000):
     """ K-means clustering algorithm.
 
     Parameters
@@ -150,6 +344,10 @@ def kmeans(X, k, init=None, n_init=1, max_iter=300, verbose=0, tol=1e-4, distanc
         centroids to generate.
         if k is an ndarray, then we do kmeans prediction
 
+    init: string, optional
+        None for random initialization, 'kmeans++' or 'kmeans||'. Under
+        mpi, 'kmeans++' falls back to 'kmeans||' (see k_init_parallel).
+
     max_iter: int, optional, default 300
         Maximum number of iterations of the k-means algorithm to run.
 
@@ -168,6 +366,24 @@ def kmeans(X, k, init=None, n_init=1, max_iter=300, verbose=0, tol=1e-4, distanc
         distance measure to use. default 'l2', can be:
         'l2', 'l1', more to come
 
+    method: string, optional
+        the k-means algorithm to use. default 'lloyd', can be:
+        'lloyd': the standard EM iterations over all the data.
+        'hamerly': Lloyd iterations that keep an upper and a lower distance
+            bound per data point and use the triangle inequality to skip
+            the points whose assignment cannot change (Hamerly, "Making
+            k-means even faster", SDM 2010). Gives the same result as
+            'lloyd'.
+        'minibatch': each iteration updates the centers with batch_size
+            randomly sampled points per MPI node (Sculley, "Web-scale
+            k-means clustering", WWW 2010). max_iter is then the number
+            of minibatches.
+        'hamerly' and 'minibatch' are only available for l2 distances.
+
+    batch_size: int, optional
+        the number of points sampled per node per iteration for the
+        'minibatch' method.
+
     Returns
     -------
     centroid: ndarray
@@ -187,8 +403,10 @@ def kmeans(X, k, init=None, n_init=1, max_iter=300, verbose=0, tol=1e-4, distanc
         # do kmeans prediction
         return _e_step(X,k,distance)[0]
 
-    if parallel and ((distance != 'l2' and distance != 'euclidean') or init == 'kmeans++'):
-        raise NotImplementedError, 'mpi kmeans only available for l2 distances, with random initialization.'
+    if parallel and (distance != 'l2' and distance != 'euclidean'):
+        raise NotImplementedError, 'mpi kmeans only available for l2 distances.'
+    if method != 'lloyd' and distance != 'l2' and distance != 'euclidean':
+        raise NotImplementedError, 'kmeans method {} only available for l2 distances.'.format(method)
     if parallel:
         mpiutils.rootprint('Parallel K-means in play.')
 
@@ -201,11 +419,16 @@ def kmeans(X, k, init=None, n_init=1, max_iter=300, verbose=0, tol=1e-4, distanc
     x_squared_norms = np.sum(X**2,axis=1)
     for it in range(n_init):
         # init
-        if init == 'kmeans++':
+        if init == 'kmeans||' or (parallel and init == 'kmeans++'):
+            # under mpi, kmeans++ seeding is carried out as kmeans||, and all
+            # the nodes already agree on the centers.
+            centers = k_init_parallel(X, k, x_squared_norms=x_squared_norms,
+                                      parallel=parallel)
+        elif init == 'kmeans++':
             centers = k_init(X, k, x_squared_norms=x_squared_norms)
         else:
             centers = X[np.random.randint(X.shape[0],size=k)]
-        if parallel:
+        if parallel and init != 'kmeans||' and init != 'kmeans++':
             # if we have more than 1 nodes, we need to have them agree on centers
             centers_all = comm.gather(centers)
             if rank == 0:
@@ -216,32 +439,17 @@ def kmeans(X, k, init=None, n_init=1, max_iter=300, verbose=0, tol=1e-4, distanc
         if verbose:
             mpiutils.rootprint('Initialization complete')
 
-        # iterations
-        timer = Timer()
-        for i in range(max_iter):
-            centers_old = centers.copy()
-            labels, inertia = _e_step(X, centers, distance,
-                                      x_squared_norms=x_squared_norms)
-            if parallel:
-                # gather inertia
-                inertia = comm.allreduce(inertia)
-            if verbose:
-                mpiutils.rootprint('Attempt %i, Iteration %i, inertia %s, this iteration took %ss.' % (it, i, inertia, timer.lap()) )
-
-            centers = _m_step(X, labels, k, distance, parallel)
-            # debug code
-            #print 'After update centers: inertia %s' % (_calc_inertia(X, centers, labels))
-
-            # for numerical stability, convergence is only carried out on rank 0
-            converged = 0
-            if rank == 0:
-                if np.sum((centers_old - centers) ** 2) < tol * vdata:
-                    if verbose:
-                        mpiutils.rootprint('Converged to similar centers at iteration {}'.format(i))
-                    converged = 1
-            converged = comm.bcast(converged, root=0)
-            if converged:
-                break
+        if method == 'lloyd':
+            centers, labels, inertia = _kmeans_lloyd(X, centers, k, max_iter, tol*vdata, verbose,
+                                                     parallel, x_squared_norms, distance, it)
+        elif method == 'hamerly':
+            centers, labels, inertia = _kmeans_hamerly(X, centers, k, max_iter, tol*vdata, verbose,
+                                                       parallel, x_squared_norms, it)
+        elif method == 'minibatch':
+            centers, labels, inertia = _kmeans_minibatch(X, centers, k, max_iter, tol*vdata, verbose,
+                                                         parallel, x_squared_norms, batch_size, it)
+        else:
+            raise exceptions.NotImplementedError, "Kmeans method {} not implemented".format(method)
 
         if inertia < best_inertia:
             best_labels = labels.copy()
@@ -249,6 +457,195 @@ def kmeans(X, k, init=None, n_init=1, max_iter=300, verbose=0, tol=1e-4, distanc
             best_inertia = inertia
     return best_centers, best_labels, best_inertia
 
+def _converged(centers_old, centers, tol, verbose, i):
+    """Checks if the centers moved less than tol in total (squared)
+
+    for numerical stability, convergence is only carried out on rank 0
+    and then broadcast to all the nodes.
+    """
+    converged = 0
+    if rank == 0:
+        if np.sum((centers_old - centers) ** 2) < tol:
+            if verbose:
+                mpiutils.rootprint('Converged to similar centers at iteration {}'.format(i))
+            converged = 1
+    converged = comm.bcast(converged, root=0)
+    return converged
+
+def _kmeans_lloyd(X, centers, k, max_iter, tol, verbose, parallel, x_squared_norms, distance, it):
+    """Standard K-means EM iterations
+
+    Returns
+    -------
+    centers, labels, inertia: same as kmeans()
+    """
+    timer = Timer()
+    for i in range(max_iter):
+        centers_old = centers.copy()
+        labels, inertia = _e_step(X, centers, distance,
+                                  x_squared_norms=x_squared_norms)
+        if parallel:
+            # gather inertia
+            inertia = comm.allreduce(inertia)
+        if verbose:
+            mpiutils.rootprint('Attempt %i, Iteration %i, inertia %s, this iteration took %ss.' % (it, i, inertia, timer.lap()) )
+
+        centers = _m_step(X, labels, k, distance, parallel)
+        # debug code
+        #print 'After update centers: inertia %s' % (_calc_inertia(X, centers, labels))
+
+        if _converged(centers_old, centers, tol, verbose, i):
+            break
+    return centers, labels, inertia
+
+def _two_nearest(x, centers, x_squared_norms, minibatch=1000):
+    """Finds the closest and the second closest center for each point
+
+    Returns
+    -------
+    z: array of shape(n)
+        The index of the closest center
+
+    upper: array of shape(n)
+        The (non-squared) distance to the closest center
+
+    lower: array of shape(n)
+        The (non-squared) distance to the second closest center
+    """
+    n_samples = x.shape[0]
+    z = np.empty(n_samples, dtype=np.int)
+    upper = np.empty(n_samples)
+    lower = np.empty(n_samples)
+    centers_squared_norms = np.sum(centers**2, axis=1)
+    # centers from k_init / k_init_parallel are float64 even for float32 x
+    buffer = np.empty(min(minibatch, n_samples) * centers.shape[0],
+                      dtype=np.result_type(x.dtype, centers.dtype))
+    for start in range(0, n_samples, minibatch):
+        end = min(n_samples, start + minibatch)
+        distances = euclidean_distances(x[start:end], centers, centers_squared_norms, squared=True,
+                                        X_norm_squared=x_squared_norms[start:end],
+                                        out=buffer[:(end - start) * centers.shape[0]].reshape((end - start, -1)))
+        np.maximum(distances, 0, out=distances)
+        rows = np.arange(end - start)
+        z[start:end] = np.argmin(distances, axis=1)
+        upper[start:end] = distances[rows, z[start:end]]
+        if centers.shape[0] > 1:
+            distances[rows, z[start:end]] = np.inf
+            lower[start:end] = np.min(distances, axis=1)
+        else:
+            lower[start:end] = np.inf
+    return z, np.sqrt(upper), np.sqrt(lower)
+
+def _kmeans_hamerly(X, centers, k, max_iter, tol, verbose, parallel, x_squared_norms, it):
+    """K-means with Hamerly's triangle inequality bounds
+
+    Each point keeps an upper bound to the distance to its assigned center
+    and a lower bound to the distance to any other center. A point is
+    only reassigned if its upper bound exceeds both its lower bound and
+    half the distance from its center to the closest other center. The M
+    step is the same as Lloyd's, so the MPI reduction in _m_step is reused
+    and every node only keeps the bounds of its local data.
+
+    Returns
+    -------
+    centers, labels, inertia: same as kmeans()
+    """
+    timer = Timer()
+    labels, upper, lower = _two_nearest(X, centers, x_squared_norms)
+    for i in range(max_iter):
+        centers_old = centers.copy()
+        if i > 0:
+            # s[j] is half the distance from center j to its closest center
+            center_distances = np.sqrt(np.maximum(
+                euclidean_distances(centers, centers, squared=True), 0))
+            center_distances.flat[::k+1] = np.inf
+            s = 0.5 * np.min(center_distances, axis=1)
+            bound = np.maximum(s[labels], lower)
+            candidates = np.flatnonzero(upper > bound)
+            # tighten the upper bound and check again
+            upper[candidates] = np.sqrt(np.sum((X[candidates] - centers[labels[candidates]])**2, axis=1))
+            candidates = candidates[upper[candidates] > bound[candidates]]
+            if len(candidates) > 0:
+                labels[candidates], upper[candidates], lower[candidates] = \
+                    _two_nearest(X[candidates], centers, x_squared_norms[candidates])
+            n_recomputed = len(candidates)
+        else:
+            n_recomputed = X.shape[0]
+        if verbose:
+            if parallel:
+                n_recomputed = comm.allreduce(n_recomputed)
+            mpiutils.rootprint('Attempt %i, Iteration %i, %i points reassigned, this iteration took %ss.' \
+                               % (it, i, n_recomputed, timer.lap()))
+
+        centers = _m_step(X, labels, k, 'l2', parallel)
+
+        # update the bounds with the center movements
+        movement = np.sqrt(np.sum((centers - centers_old)**2, axis=1))
+        upper += movement[labels]
+        if k > 1:
+            order = np.argsort(movement)
+            lower -= movement[order[-1]]
+            # for the points assigned to the center that moved most, the
+            # other centers moved at most the second largest amount
+            lower[labels == order[-1]] += movement[order[-1]] - movement[order[-2]]
+
+        if _converged(centers_old, centers, tol, verbose, i):
+            break
+    # compute the exact assignment and inertia for the final centers
+    labels, inertia = _e_step(X, centers, 'l2', x_squared_norms=x_squared_norms)
+    if parallel:
+        inertia = comm.allreduce(inertia)
+    return centers, labels, inertia
+
+def _kmeans_minibatch(X, centers, k, max_iter, tol, verbose, parallel, x_squared_norms, batch_size, it):
+    """Mini-batch K-means
+
+    Each iteration samples batch_size local points per node, assigns them
+    to the closest centers, and moves each center to the running mean of
+    all the points ever assigned to it. The per-center sums and counts of
+    the minibatch are reduced over the nodes with comm.Allreduce, so all
+    nodes keep identical centers.
+
+    Returns
+    -------
+    centers, labels, inertia: same as kmeans()
+    """
+    timer = Timer()
+    centers = centers.copy()
+    total_counts = np.zeros(k)
+    for i in range(max_iter):
+        centers_old = centers.copy()
+        idx = np.random.randint(X.shape[0], size=batch_size)
+        X_batch = X[idx]
+        batch_labels, batch_inertia = _e_step(X_batch, centers, 'l2',
+                                              x_squared_norms=x_squared_norms[idx])
+        means, counts = fastop.fastcenters(X_batch, batch_labels, k)
+        sums = means * counts.reshape(k,1)
+        if parallel:
+            allsums = sums.copy()
+            allcounts = counts.copy()
+            comm.Allreduce(sums, allsums)
+            comm.Allreduce(counts, allcounts)
+            sums = allsums
+            counts = allcounts
+            batch_inertia = comm.allreduce(batch_inertia)
+        if verbose:
+            mpiutils.rootprint('Attempt %i, Iteration %i, batch inertia %s, this iteration took %ss.' \
+                               % (it, i, batch_inertia, timer.lap()))
+        # centers without members in this batch stay where they are
+        updated = np.flatnonzero(counts)
+        new_counts = total_counts[updated] + counts[updated]
+        centers[updated] = (centers[updated] * total_counts[updated].reshape(len(updated),1) \
+                            + sums[updated]) / new_counts.reshape(len(updated),1)
+        total_counts[updated] = new_counts
+
+        if _converged(centers_old, centers, tol, verbose, i):
+            break
+    labels, inertia = _e_step(X, centers, 'l2', x_squared_norms=x_squared_norms)
+    if parallel:
+        inertia = comm.allreduce(inertia)
+    return centers, labels, inertia
+
 def _m_step(X, z, k, distance, parallel):
     """M step of the K-means EM algorithm
 
@@ -317,7 +714,7 @@ def _m_step(X, z, k, distance, parallel):
     return centers
 
 
-def _e_step(x, centers, distance, x_squared_norms=None):
+def _e_step(x, centers, distance, x_squared_norms=None, return_distances=False):
     """E step of the K-means EM algorithm
 
     Computation of the input-to-cluster assignment
@@ -333,37 +730,27 @@ def _e_step(x, centers, distance, x_squared_norms=None):
         Squared euclidean norm of each data point, speeds up computations in
         case of precompute_distances == True. Default: None
 
+    return_distances: boolean, optional
+        If True, also return the distance of each point to its closest
+        center (squared for l2).
+
     Returns
     -------z: array of shape(n)
         The resulting assignment
 
     inertia: float
         The value of the inertia criterion with the assignment
+
+    mindist: array of shape(n), only if return_distances is True
+        The distance of each point to its assigned center
     """
 
-    n_samples = x.shape[0]
-    minibatch = 1000
-    #if x.shape[0] <= minibatch:
-    #    distances = euclidean_distances(centers, x, x_squared_norms, squared=True)
-    #    minid = np.argmin(distances, axis=0)
-    #    inertia = np.sum(distances[minid, range(n_samples)])
-    #else:
-    #print 'Dataset too large. Using minibatches'
-    minid = np.empty(n_samples, dtype=np.int)
-    inertia = 0.0
-    for start in range(0, n_samples, minibatch):
-        end = min(n_samples, start + minibatch)
-        if distance == 'l2':
-            if x_squared_norms is None:
-                x_squared_norms = np.sum(x**2,axis=1)
-            distances = euclidean_distances(centers, x[start:end], x_squared_norms[start:end], squared=True)
-        elif distance == 'l1':
-            distances = l1_distance(centers, x[start:end])
-        else:
-            raise exceptions.NotImplementedError, "Kmeans distance not implemented"
-        minid[start:end] = np.argmin(distances, axis=0)
-        inertia += np.sum(distances[minid[start:end], range(end - start)])
+    minid, mindist = pairwise_argmin_min(x, centers, distance, X_norm_squared=x_squared_norms)
+    inertia = np.sum(mindist, dtype=np.float64)
 
+    if return_distances:
+        # clip the small negative values due to numerical errors
+        return minid, inertia, np.maximum(mindist, 0)
     return minid, inertia
 
 '''
@@ -0,0 +1,53 @@
+import numpy as np
+from _kmeans_simple import kmeans, k_init, k_init_parallel
+
+def blobs(seed=0, n_per_blob=200):
+    rng = np.random.RandomState(seed)
+    means = np.array([[0., 0.], [10., 0.], [0., 10.]])
+    return np.vstack([rng.randn(n_per_blob, 2) + mean for mean in means])
+
+def run(X, seed, **kwargs):
+    # reseed so that all the methods start from the same kmeans++ centers
+    np.random.seed(seed)
+    return kmeans(X, 3, init='kmeans++', max_iter=100, parallel=False, **kwargs)
+
+class TestKmeans:
+    def setup(self):
+        pass
+
+    def teardown(self):
+        pass
+
+    def test_hamerly(self):
+        X = blobs()
+        centers, labels, inertia = run(X, 1, method='lloyd')
+        h_centers, h_labels, h_inertia = run(X, 1, method='hamerly')
+        assert np.all(h_labels == labels)
+        assert np.allclose(h_centers, centers)
+        assert np.allclose(h_inertia, inertia)
+
+    def test_minibatch(self):
+        X = blobs()
+        centers, labels, inertia = run(X, 1, method='lloyd')
+        m_centers, m_labels, m_inertia = run(X, 1, method='minibatch', batch_size=100)
+        # the clusters are the same up to a permutation of their indices
+        pairs = set(zip(labels, m_labels))
+        assert len(pairs) == 3
+        assert len(set(m_labels)) == 3
+        assert m_inertia <= 1.05 * inertia
+
+    def test_seeding(self):
+        X = blobs()
+        np.random.seed(2)
+        for centers in [k_init(X, 3), k_init_parallel(X, 3, parallel=False)]:
+            assert centers.shape == (3, 2)
+            assert len(set(map(tuple, centers))) == 3
+
+    def test_kmeans_parallel_init(self):
+        X = blobs()
+        centers, labels, inertia = run(X, 3, method='lloyd')
+        np.random.seed(3)
+        p_centers, p_labels, p_inertia = kmeans(X, 3, init='kmeans||', max_iter=100,
+                                                parallel=False)
+        assert len(set(zip(labels, p_labels))) == 3
+        assert np.allclose(p_inertia, inertia)
@@ -5,87 +5,165 @@ import numpy as np
 import ctypes as ct
 import os.path
 
-_fastop_cpp = np.ctypeslib.load_library('libfastop.so', os.path.dirname(__file__))
-
-#int fastmeanstd(double *a, int n, double * pmean, double * pstd)
-_fastop_cpp.fastmeanstd.restype = ct.c_int
-_fastop_cpp.fastmeanstd.argtypes = [ct.POINTER(ct.c_double), \
-                                    ct.c_int, \
-                                    ct.POINTER(ct.c_double)]
-
-_fastop_cpp.normalizev.restype = ct.c_int
-_fastop_cpp.normalizev.argtypes = [ct.POINTER(ct.c_double), \
-                                    ct.c_int, \
-                                    ct.c_double, \
-                                    ct.c_double]
-
-_fastop_cpp.normalizev.restype = ct.c_int
-_fastop_cpp.normalizev.argtypes = [ct.POINTER(ct.c_double), \
-                                    ct.c_int, \
-                                    ct.c_double, \
-                                    ct.c_double]
-
-_fastop_cpp.fastmaxm.restype = ct.c_int
-_fastop_cpp.fastmaxm.argtypes = [ct.POINTER(ct.c_double), \
-                                  ct.POINTER(ct.c_double), \
-                                  ct.POINTER(ct.c_int), \
-                                  ct.c_int,\
-                                  ct.c_int]
-_fastop_cpp.fastsumm.restype = ct.c_int
-_fastop_cpp.fastsumm.argtypes = [ct.POINTER(ct.c_double), \
-                                  ct.POINTER(ct.c_double), \
-                                  ct.POINTER(ct.c_int), \
-                                  ct.c_int,\
-                                  ct.c_int]
-_fastop_cpp.fastcenters.restype = ct.c_int
-_fastop_cpp.fastcenters.argtypes = [ct.POINTER(ct.c_double), \
-                                  ct.POINTER(ct.c_double), \
-                                  ct.POINTER(ct.c_int), \
-                                  ct.POINTER(ct.c_int), \
-                                  ct.c_int,\
-                                  ct.c_int,\
-                                  ct.c_int]
-_fastop_cpp.fastmaximums.restype = ct.c_int
-_fastop_cpp.fastmaximums.argtypes = [ct.POINTER(ct.c_double), \
-                                  ct.POINTER(ct.c_double), \
-                                  ct.POINTER(ct.c_int), \
-                                  ct.POINTER(ct.c_int), \
-                                  ct.c_int,\
-                                  ct.c_int,\
-                                  ct.c_int]
+try:
+    _fastop_cpp = np.ctypeslib.load_library('libfastop.so', os.path.dirname(__file__))
+except OSError:
+    # libfastop.so is not built: fall back to the numpy implementations below.
+    import warnings
+    warnings.warn('jiayq.utils.fastop: libfastop.so not found, using the numpy fallback.')
+    _fastop_cpp = None
+
+_c_types = {np.dtype(np.float64): ct.c_double, np.dtype(np.float32): ct.c_float}
+
+def _ptr(array, dtype=None):
+    '''
+    returns a pointer to the data of array, which should already be a
+    C-contiguous float32 or float64 array (see _float_array).
+    '''
+    if dtype is None:
+        dtype = _c_types[array.dtype]
+    return array.ctypes.data_as(ct.POINTER(dtype))
+
+def _float_dtype(matrix):
+    '''
+    the dtype the computation is carried out in: float32 stays float32,
+    everything else is done in double precision.
+    '''
+    if matrix.dtype == np.float32:
+        return np.float32
+    else:
+        return np.float64
+
+def _float_array(array):
+    '''
+    returns array as a C-contiguous array of _float_dtype(array), without a
+    copy if it already is one.
+    '''
+    return np.ascontiguousarray(array, dtype=_float_dtype(array))
+
+def _is_float_array(array):
+    '''
+    tells if the C code can write into array in place.
+    '''
+    return array.dtype in _c_types and array.flags.c_contiguous
+
+if _fastop_cpp is not None:
+    for _suffix, _ctype in (('', ct.c_double), ('_f', ct.c_float)):
+        #int fastmeanstd(double *a, int n, double * pmeanstd)
+        getattr(_fastop_cpp, 'fastmeanstd'+_suffix).restype = ct.c_int
+        getattr(_fastop_cpp, 'fastmeanstd'+_suffix).argtypes = [ct.POINTER(_ctype), \
+                                            ct.c_int, \
+                                            ct.POINTER(_ctype)]
+
+        getattr(_fastop_cpp, 'normalizev'+_suffix).restype = ct.c_int
+        getattr(_fastop_cpp, 'normalizev'+_suffix).argtypes = [ct.POINTER(_ctype), \
+                                            ct.c_int, \
+                                            _ctype, \
+                                            _ctype]
+
+        for _name in ('fastmaxm', 'fastsumm'):
+            getattr(_fastop_cpp, _name+_suffix).restype = ct.c_int
+            getattr(_fastop_cpp, _name+_suffix).argtypes = [ct.POINTER(_ctype), \
+                                          ct.POINTER(_ctype), \
+                                          ct.POINTER(ct.c_int), \
+                                          ct.c_int,\
+                                          ct.c_int]
+
+    #int fastcenters(double* M, double* C, int* Ccounts, int* idx, int nrows, int ncols, int nctrs)
+    for _name, _ctype in (('fastcenters', ct.c_double), ('fastmaximums', ct.c_double), \
+                          ('fastcenters_omp', ct.c_double), ('fastmaximums_omp', ct.c_double), \
+                          ('fastcenters_f', ct.c_float), ('fastmaximums_f', ct.c_float)):
+        getattr(_fastop_cpp, _name).restype = ct.c_int
+        getattr(_fastop_cpp, _name).argtypes = [ct.POINTER(_ctype), \
+                                          ct.POINTER(_ctype), \
+                                          ct.POINTER(ct.c_int), \
+                                          ct.POINTER(ct.c_int), \
+                                          ct.c_int,\
+                                          ct.c_int,\
+                                          ct.c_int]
+
+def _cppfunc(name, dtype):
+    if dtype == np.float32:
+        return getattr(_fastop_cpp, name+'_f')
+    else:
+        return getattr(_fastop_cpp, name)
+
+def _segment_reduce(matrix, idx, k, ufunc, out):
+    '''
+    numpy fallback for the segmented reductions: reduces the rows of matrix
+    that share the same idx with ufunc, writing row i of out for the
+    segment i. Rows of out for empty segments are set to zero.
+    '''
+    counts = np.bincount(idx, minlength=k)[:k]
+    order = np.argsort(idx, kind='mergesort')
+    nonempty = np.flatnonzero(counts)
+    out[:] = 0
+    if len(nonempty) > 0:
+        starts = np.hstack((0, np.cumsum(counts[nonempty])[:-1]))
+        out[nonempty] = ufunc.reduceat(matrix[order], starts, axis=0)
+    return counts.astype(ct.c_int)
 
 def fastmeanstd(vector):
-    meanstd = np.empty(2)
-    _fastop_cpp.fastmeanstd(vector.ctypes.data_as(ct.POINTER(ct.c_double)),\
+    if _fastop_cpp is None:
+        return np.mean(vector), np.std(vector)
+    vector = _float_array(vector)
+    meanstd = np.empty(2, dtype=vector.dtype)
+    _cppfunc('fastmeanstd', vector.dtype)(_ptr(vector),\
                             ct.c_int(vector.size),\
-                            meanstd.ctypes.data_as(ct.POINTER(ct.c_double)))
+                            _ptr(meanstd))
     return meanstd[0],meanstd[1]
 
 def normalizev(vector, mean, std):
-    _fastop_cpp.normalizev(vector.ctypes.data_as(ct.POINTER(ct.c_double)),\
+    # vector is normalized in place, so it cannot be converted first
+    if _fastop_cpp is None or not _is_float_array(vector):
+        vector -= mean
+        if std >= 1e-10:
+            vector /= std
+        return
+    ctype = _c_types[vector.dtype]
+    _cppfunc('normalizev', vector.dtype)(_ptr(vector),\
                             ct.c_int(len(vector)),\
-                            ct.c_double(mean),\
-                            ct.c_double(std))
+                            ctype(mean),\
+                            ctype(std))
                             
 def fastop(matrix,rowids,cppfunc,out=None):
+    # matrix and out should be C-contiguous arrays of the dtype cppfunc
+    # takes (see _fastrows)
     if out is None:
-        out = np.empty(matrix.shape[1])
+        out = np.empty(matrix.shape[1], dtype=matrix.dtype)
     rowids = rowids.astype(ct.c_int)
     if rowids.size == matrix.shape[0]:
         # in this case, the rowids is specified as a 0-1 indicator
-        cppfunc(out.ctypes.data_as(ct.POINTER(ct.c_double)),\
-                          matrix.ctypes.data_as(ct.POINTER(ct.c_double)),\
+        cppfunc(_ptr(out),\
+                          _ptr(matrix),\
                           rowids.ctypes.data_as(ct.POINTER(ct.c_int)),\
                           ct.c_int(-matrix.shape[0]),\
                           ct.c_int(matrix.shape[1]))
     else:
-        cppfunc(out.ctypes.data_as(ct.POINTER(ct.c_double)),\
-                          matrix.ctypes.data_as(ct.POINTER(ct.c_double)),\
+        cppfunc(_ptr(out),\
+                          _ptr(matrix),\
                           rowids.ctypes.data_as(ct.POINTER(ct.c_int)),\
                           ct.c_int(len(rowids)),\
                           ct.c_int(matrix.shape[1]))
     
     return out
+
+def _fastop_numpy(matrix, rowids, ufunc, out=None):
+    if rowids.size == matrix.shape[0]:
+        # in this case, the rowids is specified as a 0-1 indicator
+        rowids = np.flatnonzero(rowids)
+    if out is None:
+        return ufunc.reduce(matrix[rowids], axis=0)
+    out[:] = ufunc.reduce(matrix[rowids], axis=0)
+    return out
+
+def _fastrows(matrix, rowids, name, out):
+    matrix = _float_array(matrix)
+    cppfunc = _cppfunc(name, matrix.dtype)
+    if out is None or (_is_float_array(out) and out.dtype == matrix.dtype):
+        return fastop(matrix, rowids, cppfunc, out)
+    out[:] = fastop(matrix, rowids, cppfunc)
+    return out
     
 def fastmaxm(matrix, rowids, out=None):
     '''
@@ -96,7 +174,9 @@ def fastmaxm(matrix, rowids, out=None):
     simply segfault. If you create out using numpy, usually 
     it will be aligned already.
     '''
-    return fastop(matrix,rowids,_fastop_cpp.fastmaxm, out)
+    if _fastop_cpp is None:
+        return _fastop_numpy(matrix, rowids, np.maximum, out)
+    return _fastrows(matrix, rowids, 'fastmaxm', out)
 
 def fastsumm(matrix, rowids, out=None):
     '''
@@ -107,48 +187,85 @@ def fastsumm(matrix, rowids, out=None):
     simply segfault. If you create out using numpy, usually 
     it will be aligned already.
     '''
-    return fastop(matrix,rowids,_fastop_cpp.fastsumm, out)
-    
+    if _fastop_cpp is None:
+        return _fastop_numpy(matrix, rowids, np.add, out)
+    return _fastrows(matrix, rowids, 'fastsumm', out)
+
+def _fastsegment(matrix, idx, k, centers, name):
+    matrix = _float_array(matrix)
+    dtype = matrix.dtype
+    if centers is not None and not (_is_float_array(centers) and centers.dtype == dtype):
+        result, counts = _fastsegment(matrix, idx, k, None, name)
+        centers[:] = result
+        return centers, counts
+    if centers is None:
+        centers = np.empty((k, matrix.shape[1]),dtype=dtype)
+    # just in case
+    idx = idx.astype(ct.c_int)
+    if _fastop_cpp is None:
+        if name == 'fastcenters':
+            counts = _segment_reduce(matrix, idx, k, np.add, centers)
+            centers /= np.maximum(counts, 1).reshape(k, 1)
+        else:
+            counts = _segment_reduce(matrix, idx, k, np.maximum, centers)
+            # the C version starts the maximum from zero
+            np.maximum(centers, 0, out=centers)
+        return centers, counts
+    counts = np.empty(k, dtype=ct.c_int)
+    if dtype == np.float32:
+        cppfunc = getattr(_fastop_cpp, name + '_f')
+    else:
+        cppfunc = getattr(_fastop_cpp, name + '_omp')
+    cppfunc(_ptr(matrix),\
+            _ptr(centers),\
+            counts.ctypes.data_as(ct.POINTER(ct.c_int)),\
+            idx.ctypes.data_as(ct.POINTER(ct.c_int)),\
+            ct.c_int(matrix.shape[0]),\
+            ct.c_int(matrix.shape[1]),\
+            ct.c_int(k))
+    return centers, counts
+
 def fastcenters(matrix, idx, k, centers = None):
     '''
     this function is essentially the center computation step for k-means
     it returns two values: centers and counts, where centers are the 
     clustering centers and counts are the number of members per center.
+    float32 matrices are processed in float32, everything else in double.
+    The computation is parallelized with OpenMP (set OMP_NUM_THREADS).
     '''
-    #int fastcenters(double* M, double* C, int* Ccounts, int* idx, int nrows, int ncols, int nctrs)
-    if centers is None:
-        centers = np.empty((k, matrix.shape[1]),dtype=np.float64)
-    counts = np.empty(k, dtype=ct.c_int)
-    matrix = np.ascontiguousarray(matrix, dtype=np.float64)
-    # just in case
-    idx = idx.astype(ct.c_int)
-    _fastop_cpp.fastcenters(matrix.ctypes.data_as(ct.POINTER(ct.c_double)),\
-                            centers.ctypes.data_as(ct.POINTER(ct.c_double)),\
-                            counts.ctypes.data_as(ct.POINTER(ct.c_int)),\
-                            idx.ctypes.data_as(ct.POINTER(ct.c_int)),\
-                            ct.c_int(matrix.shape[0]),\
-                            ct.c_int(matrix.shape[1]),\
-                            ct.c_int(k))
-    return centers, counts
+    return _fastsegment(matrix, idx, k, centers, 'fastcenters')
 
 def fastmaximums(matrix, idx, k, centers = None):
     '''
     this function is essentially the maximum computation step for maxpooling
     it returns two values: centers and counts, where centers are the 
     clustering centers and counts are the number of members per center.
+    Note that the maximums start from zero, i.e. negative values are
+    clipped. float32 and OpenMP are handled as in fastcenters.
     '''
-    #int fastcenters(double* M, double* C, int* Ccounts, int* idx, int nrows, int ncols, int nctrs)
-    if centers is None:
-        centers = np.empty((k, matrix.shape[1]),dtype=np.float64)
-    counts = np.empty(k, dtype=ct.c_int)
-    matrix = np.ascontiguousarray(matrix, dtype=np.float64)
-    # just in case
-    idx = idx.astype(ct.c_int)
-    _fastop_cpp.fastmaximums(matrix.ctypes.data_as(ct.POINTER(ct.c_double)),\
-                            centers.ctypes.data_as(ct.POINTER(ct.c_double)),\
-                            counts.ctypes.data_as(ct.POINTER(ct.c_int)),\
-                            idx.ctypes.data_as(ct.POINTER(ct.c_int)),\
-                            ct.c_int(matrix.shape[0]),\
-                            ct.c_int(matrix.shape[1]),\
-                            ct.c_int(k))
-    return centers, counts
+    return _fastsegment(matrix, idx, k, centers, 'fastmaximums')
+
+if __name__ == "__main__":
+    # benchmark the segmented reductions against their numpy equivalents
+    from jiayq.utils.timer import Timer
+    k = 1600
+    matrix = np.random.rand(100000, 100)
+    idx = np.random.randint(k, size=matrix.shape[0])
+    timer = Timer()
+    for dtype in [np.float64, np.float32]:
+        m = matrix.astype(dtype)
+        timer.lap()
+        fastcenters(m, idx, k)
+        print 'fastcenters {}: {}'.format(np.dtype(dtype).name, timer.lap())
+        fastmaximums(m, idx, k)
+        print 'fastmaximums {}: {}'.format(np.dtype(dtype).name, timer.lap())
+        sums = np.zeros((k, m.shape[1]), dtype=dtype)
+        np.add.at(sums, idx, m)
+        sums /= np.maximum(np.bincount(idx, minlength=k), 1).reshape(k, 1)
+        print 'np.add.at {}: {}'.format(np.dtype(dtype).name, timer.lap())
+        maxs = np.zeros((k, m.shape[1]), dtype=dtype)
+        np.maximum.at(maxs, idx, m)
+        print 'np.maximum.at {}: {}'.format(np.dtype(dtype).name, timer.lap())
+        centers = np.empty((k, m.shape[1]), dtype=dtype)
+        _segment_reduce(m, idx.astype(ct.c_int), k, np.add, centers)
+        print 'numpy fallback (reduceat) {}: {}'.format(np.dtype(dtype).name, timer.lap())
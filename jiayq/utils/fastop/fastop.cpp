@@ -1,8 +1,13 @@
 #include <emmintrin.h>
 #include <stdint.h>
+#include <stdlib.h>
 #include <string.h>
 #include <math.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 #define max(a,b) ((a)>(b)? (a):(b))
+#define min(a,b) ((a)<(b)? (a):(b))
 #define sum(a,b) ((a)+(b))
 #define ALIGNMENT_VALUE 16u
 extern "C" {
@@ -294,3 +299,213 @@ int fastmaximums(double* M, double* C, int* Ccounts, int* idx, int nrows, int nc
 
 } // extern C
 
+/*
+ * Generic versions of the functions above, used for the float32 entry
+ * points and for the OpenMP-parallel segmented reductions. These use
+ * plain loops and rely on the compiler to vectorize them.
+ */
+template <typename T>
+int tmeanstd(T *a, int n, T * pmeanstd)
+{
+    int i;
+    double mean = 0.0, sq = 0.0;
+    for (i = 0; i < n; i ++)
+    {
+        mean += a[i];
+        sq += (double)a[i] * a[i];
+    }
+    mean /= n;
+    pmeanstd[0] = (T)mean;
+    pmeanstd[1] = (T)sqrt(sq / n - mean * mean);
+    return 0;
+}
+
+template <typename T>
+int tnormalizev(T * a, int n, T mean, T std)
+{
+    int i;
+    std = (std < 1e-10) ? (T)1.0 : (T)1.0 / std;
+    for (i = 0; i < n; i ++)
+    {
+        a[i] = (a[i] - mean) * std;
+    }
+    return 0;
+}
+
+template <typename T, bool domax>
+int tsegm(T* out, T* M, int* rows, int nrows, int ncols)
+{
+    int i, j, nsel = 0;
+    T* Mpointer;
+    int n = (nrows < 0) ? -nrows : nrows;
+    for (i = 0; i < n; i ++)
+    {
+        if (nrows < 0) {
+            // rows is the 0-1 indicator function
+            if (rows[i] == 0) continue;
+            Mpointer = M + i*ncols;
+        } else {
+            Mpointer = M + rows[i]*ncols;
+        }
+        if (nsel == 0) {
+            memcpy(out, Mpointer, sizeof(T)*ncols);
+        } else if (domax) {
+            for (j = 0; j < ncols; j ++) out[j] = max(out[j], Mpointer[j]);
+        } else {
+            for (j = 0; j < ncols; j ++) out[j] += Mpointer[j];
+        }
+        nsel ++;
+    }
+    return 0;
+}
+
+template <typename T, bool domax>
+void tsegreduce_rows(T* M, T* C, int* idx, int rstart, int rend, int ncols)
+{
+    int i, j;
+    for (i = rstart; i < rend; i ++)
+    {
+        T* c = C + idx[i]*ncols;
+        T* m = M + i*ncols;
+        if (domax) {
+            for (j = 0; j < ncols; j ++) c[j] = max(c[j], m[j]);
+        } else {
+            for (j = 0; j < ncols; j ++) c[j] += m[j];
+        }
+    }
+}
+
+// inputs with fewer elements than this are reduced by a single thread
+#define SEGREDUCE_PARALLEL_MIN (1 << 18)
+
+template <typename T, bool domax>
+int tsegreduce(T* M, T* C, int* Ccounts, int* idx, int nrows, int ncols, int nctrs)
+{
+    /* The segmented reduction is parallelized over the rows: each thread
+     * reduces its own block of rows into a private copy of C (thread 0
+     * uses C itself), and the copies are then combined, each thread
+     * taking a block of centers. Threads never share output cache lines
+     * and every row of M is read once. Each thread has to own at least
+     * as many elements of M as there are in C for its private copy to
+     * pay off, and small inputs are reduced serially.
+     */
+    int i;
+    long nout = (long)nctrs * ncols;
+    memset(Ccounts, 0, sizeof(int)*nctrs);
+    for (i = 0; i < nrows; i ++)
+    {
+        Ccounts[idx[i]] ++;
+    }
+    memset(C, 0, sizeof(T)*nout);
+
+    int nthreads = 1;
+#ifdef _OPENMP
+    if ((long)nrows * ncols >= SEGREDUCE_PARALLEL_MIN)
+    {
+        long nmax = (long)nrows * ncols / max(nout, 1L);
+        nthreads = omp_get_max_threads();
+        if (nthreads > nmax) nthreads = (int)nmax;
+    }
+#endif
+    T* partial = NULL;
+    if (nthreads > 1)
+    {
+        partial = (T*)calloc((size_t)(nthreads - 1) * nout, sizeof(T));
+    }
+
+    if (partial == NULL)
+    {
+        tsegreduce_rows<T, domax>(M, C, idx, 0, nrows, ncols);
+    }
+#ifdef _OPENMP
+    else
+    {
+        #pragma omp parallel num_threads(nthreads)
+        {
+            // the runtime may give us fewer threads than we asked for
+            int nt = omp_get_num_threads();
+            int tid = omp_get_thread_num();
+            T* acc = (tid == 0) ? C : partial + (size_t)(tid - 1) * nout;
+            int chunk = (nrows + nt - 1) / nt;
+            int rstart = tid * chunk;
+            int rend = (rstart + chunk < nrows) ? rstart + chunk : nrows;
+            if (rstart < rend)
+            {
+                tsegreduce_rows<T, domax>(M, acc, idx, rstart, rend, ncols);
+            }
+            #pragma omp barrier
+            chunk = (nctrs + nt - 1) / nt;
+            long estart = (long)(tid * chunk) * ncols;
+            long eend = (long)min(tid * chunk + chunk, nctrs) * ncols;
+            for (int t = 1; t < nt; t ++)
+            {
+                T* p = partial + (size_t)(t - 1) * nout;
+                for (long e = estart; e < eend; e ++)
+                {
+                    if (domax) {
+                        C[e] = max(C[e], p[e]);
+                    } else {
+                        C[e] += p[e];
+                    }
+                }
+            }
+        }
+        free(partial);
+    }
+#endif
+
+    if (!domax) {
+        // divide by the number of members to get the centers
+        for (i = 0; i < nctrs; i ++)
+        {
+            T scale = (T)1.0 / max(Ccounts[i], 1);
+            for (int j = 0; j < ncols; j ++) C[i*ncols + j] *= scale;
+        }
+    }
+    return 0;
+}
+
+extern "C" {
+
+int fastmeanstd_f(float *a, int n, float * pmeanstd)
+{
+    return tmeanstd<float>(a, n, pmeanstd);
+}
+
+int normalizev_f(float * a, int n, float mean, float std)
+{
+    return tnormalizev<float>(a, n, mean, std);
+}
+
+int fastmaxm_f(float* out, float* M, int* rows, int nrows, int ncols)
+{
+    return tsegm<float, true>(out, M, rows, nrows, ncols);
+}
+
+int fastsumm_f(float* out, float* M, int* rows, int nrows, int ncols)
+{
+    return tsegm<float, false>(out, M, rows, nrows, ncols);
+}
+
+int fastcenters_omp(double* M, double* C, int* Ccounts, int* idx, int nrows, int ncols, int nctrs)
+{
+    return tsegreduce<double, false>(M, C, Ccounts, idx, nrows, ncols, nctrs);
+}
+
+int fastmaximums_omp(double* M, double* C, int* Ccounts, int* idx, int nrows, int ncols, int nctrs)
+{
+    return tsegreduce<double, true>(M, C, Ccounts, idx, nrows, ncols, nctrs);
+}
+
+int fastcenters_f(float* M, float* C, int* Ccounts, int* idx, int nrows, int ncols, int nctrs)
+{
+    return tsegreduce<float, false>(M, C, Ccounts, idx, nrows, ncols, nctrs);
+}
+
+int fastmaximums_f(float* M, float* C, int* Ccounts, int* idx, int nrows, int ncols, int nctrs)
+{
+    return tsegreduce<float, true>(M, C, Ccounts, idx, nrows, ncols, nctrs);
+}
+
+} // extern C
+
@@ -1,4 +1,5 @@
 from _fastop import *
+from _fastop import _segment_reduce
 
 threshold = 1e-14
 
@@ -117,3 +118,60 @@ class TestFastmax:
             if len(center_mask) > 0:
                 print 'debug:', np.vstack((centers[q],centers_fastop[q]))
                 assert np.all(np.abs(centers[q] - centers_fastop[q]) <= threshold)
+
+    def test_fastcenters_float32(self):
+        k = 10
+        matrix = np.random.rand(1000,10).astype(np.float32)
+        z = np.random.randint(k,size=1000)
+        centers_fastop, counts = fastcenters(matrix,z,k)
+        assert centers_fastop.dtype == np.float32
+        for q in range(k):
+            center_mask = np.flatnonzero(z==q)
+            assert counts[q] == len(center_mask)
+            if len(center_mask) > 0:
+                assert np.all(np.abs(np.mean(matrix[center_mask], axis=0) - centers_fastop[q]) <= 1e-5)
+
+    def test_fastmaximums_float32(self):
+        k = 10
+        matrix = np.random.rand(1000,10).astype(np.float32)
+        z = np.random.randint(k,size=1000)
+        centers_fastop = fastmaximums(matrix,z,k)[0]
+        assert centers_fastop.dtype == np.float32
+        for q in range(k):
+            center_mask = np.flatnonzero(z==q)
+            if len(center_mask) > 0:
+                assert np.all(np.max(matrix[center_mask], axis=0) == centers_fastop[q])
+
+    def test_segment_reduce(self):
+        # the numpy fallback, including an empty segment
+        k = 10
+        matrix = np.random.rand(1000,10)
+        z = np.random.randint(k-1,size=1000)
+        sums = np.empty((k, 10))
+        counts = _segment_reduce(matrix, z, k, np.add, sums)
+        assert counts[k-1] == 0
+        assert np.all(sums[k-1] == 0)
+        for q in range(k-1):
+            center_mask = np.flatnonzero(z==q)
+            assert counts[q] == len(center_mask)
+            assert np.all(np.abs(np.sum(matrix[center_mask], axis=0) - sums[q]) <= 1e-10)
+
+    def test_integer_input(self):
+        # integer matrices are processed in double precision
+        k = 10
+        matrix = np.random.randint(100, size=(1000,10))
+        z = np.random.randint(k,size=1000)
+        rowids = np.random.randint(1000, size=10)
+        out = np.zeros(10, dtype=np.int64)
+        assert np.all(fastmaxm(matrix,rowids) == np.max(matrix[rowids], axis=0))
+        assert np.all(fastsumm(matrix,rowids,out) == np.sum(matrix[rowids], axis=0))
+        assert np.all(out == np.sum(matrix[rowids], axis=0))
+        meanstd = fastmeanstd(matrix[0])
+        assert np.abs(meanstd[0] - np.mean(matrix[0])) <= 1e-10
+        centers_fastop, counts = fastcenters(matrix,z,k)
+        assert centers_fastop.dtype == np.float64
+        for q in range(k):
+            center_mask = np.flatnonzero(z==q)
+            assert counts[q] == len(center_mask)
+            if len(center_mask) > 0:
+                assert np.all(np.abs(np.mean(matrix[center_mask], axis=0) - centers_fastop[q]) <= 1e-10)
@@ -38,6 +38,10 @@ from pylearn2.sandbox.cuda_convnet.pool import max_pool_c01b
 from pylearn2.models.mlp import Layer
 from pylearn2.monitor import Monitor
 
+from galatea.mlp.ave_pool import AvePoolC01B
+from galatea.mlp.ave_pool import pool_sizes
+from galatea.mlp.ave_pool import pooled_shape
+
 class Adaptive(Layer):
     """
         WRITEME
@@ -1971,8 +1975,68 @@ class TwoStage(MLP):
 
 def ave_pool_c01b(c01b, pool_shape, pool_stride, image_shape):
     """
+    Average pooling over the 0 and 1 axes of a c01b tensor. Pools that
+    hang over the edge of the image are averaged over the pixels they
+    cover.
+
+    On the CPU this is the single pass AvePoolC01B Op. On the GPU, where
+    that Op would force a transfer to the host, it is the equivalent
+    graph built by ave_pool_c01b_graph, which stays on the device.
+    """
+    if config.device.startswith('gpu') or config.device.startswith('cuda'):
+        return ave_pool_c01b_graph(c01b, pool_shape, pool_stride, image_shape)
+
+    for c01bv in get_debug_values(c01b):
+        assert not np.any(np.isinf(c01bv))
+        assert c01bv.shape[1] == image_shape[0]
+        assert c01bv.shape[2] == image_shape[1]
+
+    name = c01b.name
+    if name is None:
+        name = 'anon_bc01'
+    ave = AvePoolC01B(pool_shape, pool_stride, image_shape)(c01b)
+    ave.name = 'ave_pool('+name+')'
+
+    return ave
+
+def _sum_pools(x, axis, im_shp, p_shp, p_strd):
+    """
+    Sums x over pools of p_shp entries along axis, starting every p_strd
+    entries. The pools that fit in the image are summed as p_shp strided
+    slices; the ones that hang over the edge are summed separately over
+    the entries they cover, so x never needs to be padded.
+    """
+    num_pools, = pooled_shape((im_shp,), (p_shp,), (p_strd,))
+    num_full = (im_shp - p_shp) // p_strd + 1
+
+    def take(start, stop, step=None):
+        idx = [slice(None)] * x.ndim
+        idx[axis] = slice(start, stop, step)
+        return x[tuple(idx)]
+
+    rval = None
+    for offset in xrange(p_shp):
+        cur = take(offset, offset + p_strd * (num_full - 1) + 1, p_strd)
+        if rval is None:
+            rval = cur
+        else:
+            rval = rval + cur
+
+    if num_pools == num_full:
+        return rval
+
+    parts = [rval]
+    for i in xrange(num_full, num_pools):
+        part = take(i * p_strd, im_shp).sum(axis=axis, keepdims=True)
+        parts.append(T.unbroadcast(part, axis))
+    return T.concatenate(parts, axis=axis)
+
+def ave_pool_c01b_graph(c01b, pool_shape, pool_stride, image_shape):
+    """
+    Average pooling as sums of strided slices of c01b, first along the
+    rows and then along the columns. Gives the same result as
+    ave_pool_c01b, using only ordinary Theano ops.
     """
-    ave = None
     r, c = image_shape
     pr, pc = pool_shape
     rs, cs = pool_stride
@@ -1981,49 +2045,20 @@ def ave_pool_c01b(c01b, pool_shape, pool_stride, image_shape):
     assert pr <= r
     assert pc <= c
 
-    # Compute index in pooled space of last needed pool
-    # (needed = each input pixel must appear in at least one pool)
-    def last_pool(im_shp, p_shp, p_strd):
-        rval = int(np.ceil(float(im_shp - p_shp) / p_strd))
-        assert p_strd * rval + p_shp >= im_shp
-        assert p_strd * (rval - 1) + p_shp < im_shp
-        return rval
-    # Compute starting row of the last pool
-    last_pool_r = last_pool(image_shape[0] ,pool_shape[0], pool_stride[0]) * pool_stride[0]
-    # Compute number of rows needed in image for all indexes to work out
-    required_r = last_pool_r + pr
-
-    last_pool_c = last_pool(image_shape[1] ,pool_shape[1], pool_stride[1]) * pool_stride[1]
-    required_c = last_pool_c + pc
-
     for c01bv in get_debug_values(c01b):
         assert not np.any(np.isinf(c01bv))
         assert c01bv.shape[1] == r
         assert c01bv.shape[2] == c
 
-    wide_zero = T.alloc(0., c01b.shape[0], required_r, required_c, c01b.shape[3])
-
-
     name = c01b.name
     if name is None:
         name = 'anon_bc01'
-    c01b = T.set_subtensor(wide_zero[:, 0:r, 0:c, :], c01b)
-    c01b.name = 'zero_padded_' + name
-
-    for row_within_pool in xrange(pool_shape[0]):
-        row_stop = last_pool_r + row_within_pool + 1
-        for col_within_pool in xrange(pool_shape[1]):
-            col_stop = last_pool_c + col_within_pool + 1
-            cur = c01b[:,row_within_pool:row_stop:rs, col_within_pool:col_stop:cs, :]
-            cur.name = 'max_pool_cur_'+c01b.name+'_'+str(row_within_pool)+'_'+str(col_within_pool)
-            if ave is None:
-                ave = cur
-            else:
-                ave = ave + cur
-                ave.name = 'ave_pool_ave_'+c01b.name+'_'+str(row_within_pool)+'_'+str(col_within_pool)
 
-    ave /= (pool_shape[0] * pool_shape[1])
-    warnings.warn("Divides boundary pools by full pool size")
+    ave = _sum_pools(c01b, 1, r, pr, rs)
+    ave = _sum_pools(ave, 2, c, pc, cs)
+
+    sizes = pool_sizes(image_shape, pool_shape, pool_stride)
+    ave /= T.constant(sizes.astype(ave.dtype)).dimshuffle('x', 0, 1, 'x')
 
     ave.name = 'ave_pool('+name+')'
 
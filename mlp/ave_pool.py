@@ -0,0 +1,291 @@
+"""
+Average pooling over the 0 and 1 axes of a (c, 0, 1, b) tensor as a
+single Theano Op.
+
+Pools that hang over the bottom or right edge of the image are averaged
+over the pixels they actually cover, rather than over the full pool
+size. The Op has a C implementation that computes each pool in one pass
+over its window, with the batch axis innermost, and a numpy fallback.
+There is no GPU implementation: on the GPU, ave_pool_c01b uses the
+graph built by galatea.mlp.ave_pool_c01b_graph instead.
+
+Running this file benchmarks it against the graph of strided slices
+built by galatea.mlp.ave_pool_c01b_graph.
+"""
+__authors__ = "Ian Goodfellow"
+__copyright__ = "Copyright 2012-2013, Universite de Montreal"
+__credits__ = ["Ian Goodfellow"]
+__license__ = "3-clause BSD"
+__maintainer__ = "Ian Goodfellow"
+
+import numpy as np
+
+import theano.tensor as T
+from theano.gof import Apply
+from theano.gof import Op
+
+
+def pooled_shape(image_shape, pool_shape, pool_stride):
+    """
+    Returns the number of pools along each of the 0 and 1 axes, enough
+    for every pixel of the image to be in at least one pool.
+    """
+    rval = []
+    for im_shp, p_shp, p_strd in zip(image_shape, pool_shape, pool_stride):
+        assert 0 < p_shp <= im_shp
+        last = int(np.ceil(float(im_shp - p_shp) / p_strd))
+        rval.append(last + 1)
+    return tuple(rval)
+
+
+def pool_sizes(image_shape, pool_shape, pool_stride):
+    """
+    Returns a matrix giving the number of image pixels covered by each
+    pool.
+    """
+    sizes = []
+    for im_shp, p_shp, p_strd, n in zip(image_shape, pool_shape, pool_stride,
+            pooled_shape(image_shape, pool_shape, pool_stride)):
+        starts = np.arange(n) * p_strd
+        sizes.append(np.minimum(starts + p_shp, im_shp) - starts)
+    return np.outer(sizes[0], sizes[1])
+
+
+_c_loops = """
+    npy_intp nc = PyArray_DIMS(%(x)s)[0];
+    npy_intp nb = PyArray_DIMS(%(x)s)[3];
+    for (npy_intp ch = 0; ch < nc; ++ch)
+    {
+        for (npy_intp i = 0; i < %(out_r)d; ++i)
+        {
+            npy_intp r0 = i * %(rs)d;
+            npy_intp r1 = r0 + %(pr)d < %(r)d ? r0 + %(pr)d : %(r)d;
+            for (npy_intp j = 0; j < %(out_c)d; ++j)
+            {
+                npy_intp c0 = j * %(cs)d;
+                npy_intp c1 = c0 + %(pc)d < %(c)d ? c0 + %(pc)d : %(c)d;
+                dtype_%(x)s scale = 1. / ((r1 - r0) * (c1 - c0));
+                dtype_%(x)s * pooled = ((dtype_%(x)s *) PyArray_DATA(%(pooled)s))
+                    + ((ch * %(out_r)d + i) * %(out_c)d + j) * nb;
+                for (npy_intp rr = r0; rr < r1; ++rr)
+                {
+                    for (npy_intp cc = c0; cc < c1; ++cc)
+                    {
+                        dtype_%(x)s * image = ((dtype_%(x)s *) PyArray_DATA(%(image)s))
+                            + ((ch * %(r)d + rr) * %(c)d + cc) * nb;
+                        %(body)s
+                    }
+                }
+            }
+        }
+    }
+"""
+
+
+class _AvePoolBase(Op):
+    """
+    Common parts of AvePoolC01B and AvePoolC01BGrad.
+    """
+
+    def __init__(self, pool_shape, pool_stride, image_shape):
+        self.pool_shape = tuple(pool_shape)
+        self.pool_stride = tuple(pool_stride)
+        self.image_shape = tuple(image_shape)
+        self.out_shape = pooled_shape(self.image_shape, self.pool_shape,
+                self.pool_stride)
+
+    def __eq__(self, other):
+        return type(self) == type(other) and \
+                self.pool_shape == other.pool_shape and \
+                self.pool_stride == other.pool_stride and \
+                self.image_shape == other.image_shape
+
+    def __hash__(self):
+        return hash((type(self), self.pool_shape, self.pool_stride,
+            self.image_shape))
+
+    def __str__(self):
+        return '%s{%s, %s, %s}' % (self.__class__.__name__,
+                str(self.pool_shape), str(self.pool_stride),
+                str(self.image_shape))
+
+    def _sub(self):
+        r, c = self.image_shape
+        pr, pc = self.pool_shape
+        rs, cs = self.pool_stride
+        out_r, out_c = self.out_shape
+        return dict(r=r, c=c, pr=pr, pc=pc, rs=rs, cs=cs, out_r=out_r,
+                out_c=out_c)
+
+    def _windows(self):
+        r, c = self.image_shape
+        pr, pc = self.pool_shape
+        rs, cs = self.pool_stride
+        out_r, out_c = self.out_shape
+        for i in xrange(out_r):
+            for j in xrange(out_c):
+                rows = slice(i * rs, min(i * rs + pr, r))
+                cols = slice(j * cs, min(j * cs + pc, c))
+                yield i, j, rows, cols
+
+    def c_code_cache_version(self):
+        return (1,)
+
+
+class AvePoolC01B(_AvePoolBase):
+    """
+    Average pooling of a c01b tensor.
+
+    Parameters
+    ----------
+    pool_shape : tuple
+        Rows and columns of each pool
+    pool_stride : tuple
+        Rows and columns between the starts of neighbouring pools
+    image_shape : tuple
+        Rows and columns of the input images
+    """
+
+    def make_node(self, c01b):
+        c01b = T.as_tensor_variable(c01b)
+        assert c01b.ndim == 4
+        return Apply(self, [c01b], [c01b.type()])
+
+    def perform(self, node, inputs, output_storage):
+        c01b, = inputs
+        assert c01b.shape[1:3] == self.image_shape
+        out = np.zeros((c01b.shape[0],) + self.out_shape + (c01b.shape[3],),
+                dtype=c01b.dtype)
+        for i, j, rows, cols in self._windows():
+            out[:, i, j, :] = c01b[:, rows, cols, :].mean(axis=(1, 2))
+        output_storage[0][0] = out
+
+    def grad(self, inputs, output_grads):
+        c01b, = inputs
+        gz, = output_grads
+        return [AvePoolC01BGrad(self.pool_shape, self.pool_stride,
+            self.image_shape)(gz)]
+
+    def c_code(self, node, name, inputs, outputs, sub):
+        x, = inputs
+        z, = outputs
+        fail = sub['fail']
+        d = self._sub()
+        d.update(x=x, z=z, fail=fail, image='xc', pooled=z)
+        d['body'] = """
+                        for (npy_intp bb = 0; bb < nb; ++bb)
+                            pooled[bb] += image[bb] * scale;
+        """
+        loops = _c_loops % d
+        return """
+        {
+        if (PyArray_NDIM(%(x)s) != 4 || PyArray_DIMS(%(x)s)[1] != %(r)d
+            || PyArray_DIMS(%(x)s)[2] != %(c)d)
+        {
+            PyErr_SetString(PyExc_ValueError,
+                "AvePoolC01B: input does not have the expected image shape");
+            %(fail)s;
+        }
+        PyArrayObject * xc = PyArray_GETCONTIGUOUS(%(x)s);
+        if (!xc)
+        {
+            %(fail)s;
+        }
+        npy_intp dims[4] = {PyArray_DIMS(%(x)s)[0], %(out_r)d, %(out_c)d,
+                            PyArray_DIMS(%(x)s)[3]};
+        Py_XDECREF(%(z)s);
+        %(z)s = (PyArrayObject *) PyArray_ZEROS(4, dims, PyArray_TYPE(%(x)s), 0);
+        if (!%(z)s)
+        {
+            Py_DECREF(xc);
+            %(fail)s;
+        }
+        %(loops)s
+        Py_DECREF(xc);
+        }
+        """ % dict(d, loops=loops)
+
+
+class AvePoolC01BGrad(_AvePoolBase):
+    """
+    Gradient of AvePoolC01B: spreads the gradient on each pool evenly
+    over the pixels it covers.
+    """
+
+    def make_node(self, gz):
+        gz = T.as_tensor_variable(gz)
+        assert gz.ndim == 4
+        return Apply(self, [gz], [gz.type()])
+
+    def perform(self, node, inputs, output_storage):
+        gz, = inputs
+        assert gz.shape[1:3] == self.out_shape
+        gx = np.zeros((gz.shape[0],) + self.image_shape + (gz.shape[3],),
+                dtype=gz.dtype)
+        for i, j, rows, cols in self._windows():
+            size = (rows.stop - rows.start) * (cols.stop - cols.start)
+            gx[:, rows, cols, :] += gz[:, i:i+1, j:j+1, :] / size
+        output_storage[0][0] = gx
+
+    def c_code(self, node, name, inputs, outputs, sub):
+        gz, = inputs
+        gx, = outputs
+        fail = sub['fail']
+        d = self._sub()
+        d.update(x=gz, z=gx, fail=fail, image=gx, pooled='gzc')
+        d['body'] = """
+                        for (npy_intp bb = 0; bb < nb; ++bb)
+                            image[bb] += pooled[bb] * scale;
+        """
+        loops = _c_loops % d
+        return """
+        {
+        if (PyArray_NDIM(%(x)s) != 4 || PyArray_DIMS(%(x)s)[1] != %(out_r)d
+            || PyArray_DIMS(%(x)s)[2] != %(out_c)d)
+        {
+            PyErr_SetString(PyExc_ValueError,
+                "AvePoolC01BGrad: gradient does not have the pooled shape");
+            %(fail)s;
+        }
+        PyArrayObject * gzc = PyArray_GETCONTIGUOUS(%(x)s);
+        if (!gzc)
+        {
+            %(fail)s;
+        }
+        npy_intp dims[4] = {PyArray_DIMS(%(x)s)[0], %(r)d, %(c)d,
+                            PyArray_DIMS(%(x)s)[3]};
+        Py_XDECREF(%(z)s);
+        %(z)s = (PyArrayObject *) PyArray_ZEROS(4, dims, PyArray_TYPE(%(x)s), 0);
+        if (!%(z)s)
+        {
+            Py_DECREF(gzc);
+            %(fail)s;
+        }
+        %(loops)s
+        Py_DECREF(gzc);
+        }
+        """ % dict(d, loops=loops)
+
+
+if __name__ == '__main__':
+    import time
+    from theano import function
+    from pylearn2.utils import sharedX
+    from galatea.mlp import ave_pool_c01b, ave_pool_c01b_graph
+
+    rng = np.random.RandomState([2013, 5, 1])
+    image_shape = (32, 32)
+    for pool_shape, pool_stride in [((3, 3), (2, 2)), ((4, 4), (2, 2)),
+            ((2, 2), (2, 2))]:
+        X = sharedX(rng.randn(64, image_shape[0], image_shape[1], 128))
+        for name, pool in [('graph', ave_pool_c01b_graph),
+                ('op', ave_pool_c01b)]:
+            p = pool(X, pool_shape, pool_stride, image_shape)
+            f = function([], T.grad(p.sum(), X))
+            f()
+            t1 = time.time()
+            for i in xrange(10):
+                f()
+            t2 = time.time()
+            print '%s pool %s stride %s: %.4fs per fprop+bprop' % (name,
+                    str(pool_shape), str(pool_stride), (t2 - t1) / 10.)
@@ -0,0 +1,55 @@
+import numpy as np
+
+from theano import config
+from theano import function
+import theano.tensor as T
+from theano.tests import unittest_tools as utt
+
+from galatea.mlp import ave_pool_c01b_graph
+from galatea.mlp.ave_pool import AvePoolC01B
+
+def ground_truth_ave_pool(c01b, pool_shape, pool_stride):
+    r, c = c01b.shape[1:3]
+    pr, pc = pool_shape
+    rs, cs = pool_stride
+    out_r = int(np.ceil(float(r - pr) / rs)) + 1
+    out_c = int(np.ceil(float(c - pc) / cs)) + 1
+    out = np.zeros((c01b.shape[0], out_r, out_c, c01b.shape[3]))
+    for i in xrange(out_r):
+        for j in xrange(out_c):
+            window = c01b[:, i*rs:min(i*rs+pr, r), j*cs:min(j*cs+pc, c), :]
+            out[:, i, j, :] = window.mean(axis=1).mean(axis=1)
+    return out
+
+cases = [((3, 3), (2, 2), (7, 8)),
+         ((2, 2), (2, 2), (6, 6)),
+         ((3, 2), (1, 2), (5, 7))]
+
+def test_ave_pool_op():
+
+    rng = np.random.RandomState([2013,5,1])
+
+    X = T.TensorType(dtype=config.floatX, broadcastable=tuple([False]*4))()
+
+    for pool_shape, pool_stride, image_shape in cases:
+        c01b = rng.randn(3, image_shape[0], image_shape[1], 2).astype(config.floatX)
+        expected = ground_truth_ave_pool(c01b, pool_shape, pool_stride)
+
+        for mode in ['FAST_RUN', 'FAST_COMPILE']:
+            op = AvePoolC01B(pool_shape, pool_stride, image_shape)
+            out = function([X], op(X), mode=mode)(c01b)
+            assert out.shape == expected.shape
+            assert np.allclose(out, expected, atol=1e-5)
+
+        out = function([X], ave_pool_c01b_graph(X, pool_shape, pool_stride,
+            image_shape))(c01b)
+        assert np.allclose(out, expected, atol=1e-5)
+
+def test_ave_pool_grad():
+
+    rng = np.random.RandomState([2013,5,2])
+
+    for pool_shape, pool_stride, image_shape in cases:
+        c01b = rng.randn(2, image_shape[0], image_shape[1], 3)
+        utt.verify_grad(AvePoolC01B(pool_shape, pool_stride, image_shape),
+                [c01b], rng=rng)
@@ -28,6 +28,17 @@ from theano.sandbox import cuda
 if cuda.cuda_available:
     from pylearn2.sandbox.cuda_convnet.pool import max_pool_c01b
 
+from galatea.remu.piecewise import piecewise_max
+
+
+def use_stacked_pieces(layer):
+    """
+    Returns True if the layer should evaluate its pieces with
+    piecewise_max, which it only does if stacked_pieces was set to True.
+    Layers pickled before stacked_pieces existed keep the chained maxima.
+    """
+    return bool(getattr(layer, 'stacked_pieces', False))
+
 
 class RestrictedMaxout(Layer):
     """
@@ -53,7 +64,8 @@ class RestrictedMaxout(Layer):
                  b_lr_scale = None,
                  max_row_norm = None,
                  slope_lr_scale = None,
-                 min_zero = False
+                 min_zero = False,
+                 stacked_pieces = False
         ):
         """
             layer_name: A name for this layer that will be prepended to
@@ -85,6 +97,10 @@ class RestrictedMaxout(Layer):
             min_zero: If true, includes a zero in the set we take a max over
                     for each maxout unit. This is equivalent to pooling over
                     rectified linear units.
+            stacked_pieces: If true, the pieces are evaluated by
+                    piecewise_max, as one multiply-add over the stacked
+                    slopes and biases followed by one max, rather than
+                    chained T.maximum calls. Off by default.
         """
 
         detector_layer_dim = num_units
@@ -347,13 +363,20 @@ class RestrictedMaxout(Layer):
         else:
             p = None
 
-        last_start = self.detector_layer_dim  - self.pool_size
-        for i in xrange(self.num_pieces):
-            cur = z * self.slopes[i] + self.b[i]
-            if p is None:
-                p = cur
-            else:
-                p = T.maximum(cur, p)
+        if use_stacked_pieces(self):
+            slopes = [slope.dimshuffle('x', 'x', 0) for slope in self.slopes]
+            b = [b.dimshuffle('x', 'x', 0) for b in self.b]
+            if self.min_zero:
+                slopes.append(T.zeros_like(slopes[0]))
+                b.append(T.zeros_like(b[0]))
+            p = piecewise_max(z, T.concatenate(slopes), T.concatenate(b))
+        else:
+            for i in xrange(self.num_pieces):
+                cur = z * self.slopes[i] + self.b[i]
+                if p is None:
+                    p = cur
+                else:
+                    p = T.maximum(cur, p)
 
         p.name = self.layer_name + '_p_'
 
@@ -448,7 +471,8 @@ class ConvReMU(Layer):
                  detector_normalization = None,
                  min_zero = False,
                  output_normalization = None,
-                 kernel_stride=(1, 1)):
+                 kernel_stride=(1, 1),
+                 stacked_pieces = False):
         """
             num_channels: The number of output channels the layer should have.
                           Note that it must internally compute num_channels * num_pieces
@@ -502,6 +526,9 @@ class ConvReMU(Layer):
                     output: the output of the layer, after sptial pooling, can be normalized as well
             kernel_stride: vertical and horizontal pixel stride between
                            each detector.
+            stacked_pieces: If true, the pieces are evaluated by
+                    piecewise_max over the stacked slopes and biases
+                    (see RestrictedMaxout). Off by default.
         """
         check_cuda(str(type(self)))
 
@@ -709,6 +736,16 @@ class ConvReMU(Layer):
         assert self.detector_space.num_channels % 16 == 0
 
         def cross_channel_pool(lin):
+            if use_stacked_pieces(self):
+                slopes = [slope.dimshuffle('x', 0, 'x', 'x', 'x')
+                          for slope in self.slopes]
+                if self.tied_b:
+                    b = [b.dimshuffle('x', 0, 'x', 'x', 'x') for b in self.b]
+                else:
+                    b = [b.dimshuffle('x', 0, 1, 2, 'x') for b in self.b]
+                return piecewise_max(lin, T.concatenate(slopes),
+                                     T.concatenate(b))
+
             rval = None
             for i in xrange(self.num_pieces):
                 b = self.b[i]
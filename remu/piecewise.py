@@ -0,0 +1,45 @@
+"""
+Stacked-pieces evaluation of piecewise linear units.
+
+A ReMU unit computes max_i (z * slope_i + b_i) over its num_pieces
+linear pieces. Building each piece as its own tensor and chaining them
+with T.maximum makes a graph with 2 * num_pieces elemwise ops in the
+forward pass and as many again in the gradient. piecewise_max instead
+takes the slopes and biases stacked along a leading pieces axis, so the
+pieces are evaluated by one broadcasted multiply-add and combined by one
+max reduction. These are ordinary Theano ops, so the graph runs on the
+GPU as well as on the CPU.
+
+This only shortens the graph. The stacked pieces are still held in
+memory as one (num_pieces, ...) tensor, so the activation memory is the
+same as for chained maxima, and the gradient is Theano's gradient of
+max, which goes to every piece tied for the maximum.
+"""
+__authors__ = "Ian Goodfellow"
+__copyright__ = "Copyright 2012-2013, Universite de Montreal"
+__credits__ = ["Ian Goodfellow"]
+__license__ = "3-clause BSD"
+__maintainer__ = "Ian Goodfellow"
+
+from theano import tensor as T
+
+
+def piecewise_max(z, slopes, biases):
+    """
+    Returns max_i (z * slopes[i] + biases[i]).
+
+    Parameters
+    ----------
+    z : tensor
+        The linear response shared by all the pieces
+    slopes : tensor
+        The slopes of the pieces, with one more (leading) dimension than
+        z. slopes[i] must broadcast to the shape of z.
+    biases : tensor
+        The biases of the pieces, stacked like slopes
+    """
+    z = T.as_tensor_variable(z)
+    assert slopes.ndim == z.ndim + 1
+    assert biases.ndim == z.ndim + 1
+    pieces = z.dimshuffle(*(['x'] + range(z.ndim))) * slopes + biases
+    return pieces.max(axis=0)
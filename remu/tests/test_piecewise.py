@@ -0,0 +1,80 @@
+import numpy as np
+
+from theano import config
+from theano import function
+import theano.tensor as T
+from theano.tests import unittest_tools as utt
+
+from galatea.remu.piecewise import piecewise_max
+
+num_pieces = 3
+
+# (shape of z, shape of slopes[i], shape of biases[i]) for the dense
+# layout of RestrictedMaxout and the c01b layout of ConvReMU with tied and
+# untied biases
+cases = [((4, 5), (1, 5), (1, 5)),
+         ((6, 3, 2, 4), (6, 1, 1, 1), (6, 1, 1, 1)),
+         ((6, 3, 2, 4), (6, 1, 1, 1), (6, 3, 2, 1))]
+
+def stacked(shape):
+    return T.TensorType(dtype=config.floatX,
+        broadcastable=(False,) + tuple(dim == 1 for dim in shape))()
+
+def chained_max(z, slopes, biases, min_zero):
+    if min_zero:
+        p = np.zeros(z.shape)
+    else:
+        p = None
+    for slope, b in zip(slopes, biases):
+        cur = z * slope + b
+        if p is None:
+            p = cur
+        else:
+            p = np.maximum(cur, p)
+    return p
+
+def test_piecewise_max():
+
+    rng = np.random.RandomState([2013, 6, 2])
+
+    for z_shape, slope_shape, b_shape in cases:
+        z = T.TensorType(dtype=config.floatX,
+                broadcastable=(False,) * len(z_shape))()
+        slopes = stacked(slope_shape)
+        biases = stacked(b_shape)
+        f = function([z, slopes, biases], piecewise_max(z, slopes, biases))
+
+        z_val = rng.randn(*z_shape).astype(config.floatX)
+        slopes_val = rng.randn(num_pieces, *slope_shape).astype(config.floatX)
+        b_val = rng.randn(num_pieces, *b_shape).astype(config.floatX)
+
+        for min_zero in [False, True]:
+            if min_zero:
+                # min_zero is handled by the layers as an extra zero piece
+                s = np.concatenate([slopes_val, np.zeros_like(slopes_val[0:1])])
+                b = np.concatenate([b_val, np.zeros_like(b_val[0:1])])
+            else:
+                s = slopes_val
+                b = b_val
+            out = f(z_val, s, b)
+            expected = chained_max(z_val, slopes_val, b_val, min_zero)
+            assert out.shape == z_shape
+            assert np.allclose(out, expected, atol=1e-5)
+
+def test_piecewise_max_grad():
+
+    rng = np.random.RandomState([2013, 6, 3])
+
+    for z_shape, slope_shape, b_shape in cases:
+        z_val = rng.randn(*z_shape)
+        slopes_val = rng.randn(num_pieces, *slope_shape)
+        b_val = rng.randn(num_pieces, *b_shape)
+
+        def f(z, slopes, biases):
+            slopes = T.addbroadcast(slopes,
+                    *[i + 1 for i, dim in enumerate(slope_shape) if dim == 1])
+            biases = T.addbroadcast(biases,
+                    *[i + 1 for i, dim in enumerate(b_shape) if dim == 1])
+            return piecewise_max(z, slopes, biases)
+
+        utt.verify_grad(f, [z_val, slopes_val, b_val], rng=rng)
@@ -1,6 +1,7 @@
 import numpy as np
 import warnings
 
+import theano
 from theano.sandbox.rng_mrg import MRG_RandomStreams
 from theano import tensor as T
 
@@ -13,6 +14,93 @@ from pylearn2.utils import function
 from pylearn2.utils import grad
 from pylearn2.utils import safe_zip
 from pylearn2.utils import serial
+from theano.compat import OrderedDict
+
+
+def multipoint_cost(model, cost_value, root, basis, points,
+        enforce_constraints=False):
+    """
+    Returns a symbolic vector of cost_value evaluated with the parameters
+    of model set to root + T.dot(basis, point), for each row point of
+    points, and the updates of the scan computing it.
+
+    root is laid out like model.get_param_vector(). The parameters are
+    substituted in the graph, so their shared variables are left alone.
+    If enforce_constraints is True, the substituted values are first
+    passed through model.censor_updates, as model.enforce_constraints()
+    would do to the parameters.
+    """
+    params = model.get_params()
+    shapes = [param.get_value(borrow=True).shape for param in params]
+
+    def cost_at(point):
+        vector = root + T.dot(basis, point)
+        values = OrderedDict()
+        pos = 0
+        for param, shape in safe_zip(params, shapes):
+            size = int(np.prod(shape))
+            value = vector[pos:pos + size].reshape(shape)
+            value = T.cast(value, param.dtype)
+            values[param] = T.patternbroadcast(value, param.broadcastable)
+            pos += size
+        if enforce_constraints:
+            model.censor_updates(values)
+        return theano.clone(cost_value, replace=values)
+
+    return theano.scan(cost_at, sequences=[points])
+
+def multipoint_cost_fn(model, theano_args, cost_value,
+        enforce_constraints=False):
+    """
+    Compiles f(root, basis, points, *data), returning the vector of costs
+    of model on data at root + dot(basis, point) for each row of points
+    in a single call (see multipoint_cost).
+    """
+    root = T.vector('root')
+    basis = T.matrix('basis')
+    points = T.matrix('points')
+    costs, updates = multipoint_cost(model, cost_value, root, basis, points,
+            enforce_constraints=enforce_constraints)
+    return function([root, basis, points] + list(theano_args), costs,
+            updates=updates)
+
+def per_example_grad_fn(model, theano_args, cost_value):
+    """
+    Compiles f(*data), returning a matrix whose row i is the gradient of
+    cost_value on example i of data alone, laid out like
+    model.get_param_vector(). All the rows are computed in one call, by
+    a scan over the examples.
+    """
+    params = model.get_params()
+
+    def example_grad(i, *args):
+        replace = dict((arg, batch[i:i + 1])
+                for arg, batch in safe_zip(theano_args, args))
+        example_cost = theano.clone(cost_value, replace=replace)
+        grads = grad(example_cost, params)
+        return T.concatenate([g.flatten() for g in grads])
+
+    num_examples = theano_args[0].shape[0]
+    grads, updates = theano.scan(example_grad,
+            sequences=[T.arange(num_examples)],
+            non_sequences=list(theano_args))
+    return function(theano_args, grads, updates=updates)
+
+def orthonormalize(basis, tol=1e-4):
+    """
+    Returns a matrix with orthonormal columns spanning the same space as
+    the columns of basis, computed by a QR decomposition.
+
+    The columns are scaled to unit norm first, so that abs(r[i, i]) is the
+    norm of the part of column i not spanned by the columns before it.
+    The basis is required to have full column rank in that sense, to
+    within tol.
+    """
+    basis = basis / np.sqrt(np.square(basis).sum(axis=0))
+    q, r = np.linalg.qr(basis)
+    assert np.abs(np.diag(r)).min() > tol
+    return q
+
 
 class WarmStart(TrainExtension):
 
@@ -104,13 +192,8 @@ class WarmStart(TrainExtension):
             # ======================
 
             print "Compiling cost function..."
-            cost_fn = function(theano_args, cost_value)
-            self.cost_fn = cost_fn
-        else:
-            cost_fn = self.cost_fn
-
-        cost_values = np.zeros(self.num_points)
-
+            self.cost_fn = multipoint_cost_fn(model, theano_args, cost_value)
+        cost_fn = self.cost_fn
 
         data = list(dataset.get_batch_design(self.batch_size,
             include_labels=True))
@@ -126,46 +209,28 @@ class WarmStart(TrainExtension):
                 basis[rng.randint(dim), i] = 1.
         elif self.method == 'gradient':
             if not hasattr(self, 'grad_fn'):
-                self.grad_fn = function(theano_args, grad(cost_value, model.get_params()))
+                self.grad_fn = per_example_grad_fn(model, theano_args, cost_value)
             grad_fn = self.grad_fn
 
-            basis = np.zeros((dim, self.num_basis_vectors)).astype(root.dtype)
-            for i in xrange(self.num_basis_vectors):
-                ipt = list(dataset.get_batch_design(1, include_labels=True))
-                label = ipt[1]
-                assert label.size == 1
-                label = label[0]
-                one_hot = np.zeros((1, 10,),dtype='float32')
-                one_hot[0, label] = 1
-                ipt[1] = one_hot
-                g = grad_fn(*ipt)
-                basis[:,i] = np.concatenate([e.reshape(e.size) for e in g], axis=0)
+            # One basis vector per example, from the gradient of the cost on
+            # that example alone
+            ipt = list(dataset.get_batch_design(self.num_basis_vectors,
+                include_labels=True))
+            labels = ipt[1].reshape(ipt[1].size)
+            assert labels.size == self.num_basis_vectors
+            one_hot = np.zeros((labels.size, 10,),dtype='float32')
+            one_hot[np.arange(labels.size), labels] = 1
+            ipt[1] = one_hot
+            basis = grad_fn(*ipt).T.astype(root.dtype)
         else:
             assert False
 
-        basis /= np.sqrt(np.square(basis).sum(axis=0))
-
-        # Orthogonalize basis
-        for i in xrange(self.num_basis_vectors):
-            v = basis[:,i ].copy()
-            for j in xrange(i - 1):
-                u = basis[:, j].copy()
-                v -= np.dot(u, v) * u
-            norm = np.sqrt(np.square(v).sum())
-            assert norm > 1e-4
-            v /= norm
-            basis[:,i] = v
-
+        basis = orthonormalize(basis).astype(root.dtype)
 
-        for i in xrange(self.num_points):
-            print "Evaluating cost at point ", i
 
-            point = points[i, :]
-            full_point = root + np.dot(basis, point)
-            model.set_param_vector(full_point)
-
-            cost_values[i] = cost_fn(*data)
-            print cost_values[i]
+        print "Evaluating cost at %d points" % self.num_points
+        cost_values = cost_fn(root, basis, points, *data)
+        print cost_values
 
 
         from pylearn2.utils import sharedX
@@ -394,7 +459,16 @@ class FindBasis2(TrainExtension):
             serial.save(self.save_path, model)
 
 class Booster(TrainExtension):
-    def __init__(self, scales):
+    """
+    On each monitor, moves the parameters to origin + scale * (params -
+    origin) for the scale in scales with the lowest cost.
+
+    By default the cost is evaluated at all the scales in one call, with
+    the parameters, constrained by model.censor_updates, substituted in
+    the cost graph. Pass batched=False to set the parameters and call
+    model.enforce_constraints() for each scale instead.
+    """
+    def __init__(self, scales, batched=True):
         self.__dict__.update(locals())
         del self.self
         self.batch_size = 2000
@@ -435,8 +509,11 @@ class Booster(TrainExtension):
         # ======================
 
         print "Compiling cost function..."
-        cost_fn = function(theano_args, cost_value)
-        self.cost_fn = cost_fn
+        if self.batched:
+            self.cost_fn = multipoint_cost_fn(model, theano_args, cost_value,
+                    enforce_constraints=True)
+        else:
+            self.cost_fn = function(theano_args, cost_value)
 
     def on_monitor(self, model, dataset, algorithm):
         d = model.get_param_vector() - self.origin
@@ -446,14 +523,20 @@ class Booster(TrainExtension):
         from pylearn2.utils.one_hot import one_hot
         data[1] = one_hot(data[1])
 
-        cost_values = []
-        for scale in self.scales:
-            print "Evaluating cost at scale ", scale
+        if self.batched:
+            print "Evaluating cost at scales ", self.scales
+            scales = np.asarray(self.scales, dtype=d.dtype)
+            cost_values = list(self.cost_fn(self.origin, d.reshape(d.size, 1),
+                scales.reshape(scales.size, 1), *data))
+        else:
+            cost_values = []
+            for scale in self.scales:
+                print "Evaluating cost at scale ", scale
 
-            model.set_param_vector(self.origin + scale * d)
-            model.enforce_constraints()
+                model.set_param_vector(self.origin + scale * d)
+                model.enforce_constraints()
 
-            cost_values.append(self.cost_fn(*data))
+                cost_values.append(self.cost_fn(*data))
 
         print 'Scales searched: ',self.scales
         print 'Cost values: ', cost_values
@@ -0,0 +1,98 @@
+import numpy as np
+
+from theano import config
+import theano.tensor as T
+
+from pylearn2.models.mlp import MLP
+from pylearn2.models.mlp import Sigmoid
+from pylearn2.models.mlp import Softmax
+from pylearn2.utils import function
+from pylearn2.utils import grad
+
+from galatea.warm_start import multipoint_cost_fn
+from galatea.warm_start import orthonormalize
+from galatea.warm_start import per_example_grad_fn
+
+def make_model():
+    # The max_col_norms are small enough for most of the points below to
+    # violate them, so enforce_constraints has something to do
+    return MLP(layers=[Sigmoid(dim=4, layer_name='h0', irange=.5,
+                               max_col_norm=.5),
+                       Softmax(n_classes=3, layer_name='y', irange=.5,
+                               max_col_norm=.5)],
+               nvis=5)
+
+def make_data(rng, num_examples=6):
+    X = rng.randn(num_examples, 5).astype(config.floatX)
+    Y = np.zeros((num_examples, 3), dtype=config.floatX)
+    Y[np.arange(num_examples), rng.randint(3, size=num_examples)] = 1.
+    return X, Y
+
+def make_cost(model):
+    X = T.matrix()
+    Y = T.matrix()
+    return (X, Y), model.cost(Y, model.fprop(X))
+
+def test_multipoint_cost_fn():
+
+    rng = np.random.RandomState([2013, 6, 4])
+    model = make_model()
+    theano_args, cost_value = make_cost(model)
+    data = make_data(rng)
+
+    root = model.get_param_vector()
+    basis = rng.randn(root.size, 2).astype(root.dtype)
+    points = rng.randn(5, 2).astype(root.dtype)
+
+    single_fn = function(theano_args, cost_value)
+
+    for enforce_constraints in [False, True]:
+        cost_fn = multipoint_cost_fn(model, theano_args, cost_value,
+                enforce_constraints=enforce_constraints)
+        costs = cost_fn(root, basis, points, *data)
+
+        expected = []
+        for point in points:
+            model.set_param_vector(root + np.dot(basis, point))
+            if enforce_constraints:
+                model.enforce_constraints()
+            expected.append(single_fn(*data))
+        model.set_param_vector(root)
+
+        assert costs.shape == (points.shape[0],)
+        assert np.allclose(costs, expected, atol=1e-5)
+        # the substituted graph must leave the parameters alone
+        assert np.allclose(model.get_param_vector(), root)
+
+def test_per_example_grad_fn():
+
+    rng = np.random.RandomState([2013, 6, 5])
+    model = make_model()
+    theano_args, cost_value = make_cost(model)
+    X, Y = make_data(rng)
+
+    grad_fn = per_example_grad_fn(model, theano_args, cost_value)
+    grads = grad_fn(X, Y)
+
+    params = model.get_params()
+    flat_grad = T.concatenate([g.flatten()
+                               for g in grad(cost_value, params)])
+    single_fn = function(theano_args, flat_grad)
+
+    assert grads.shape == (X.shape[0], model.get_param_vector().size)
+    for i in xrange(X.shape[0]):
+        assert np.allclose(grads[i], single_fn(X[i:i + 1], Y[i:i + 1]),
+                atol=1e-5)
+
+def test_orthonormalize():
+
+    rng = np.random.RandomState([2013, 6, 6])
+    basis = rng.randn(20, 5) * rng.uniform(.1, 10., size=5)
+
+    q = orthonormalize(basis)
+
+    assert q.shape == basis.shape
+    assert np.allclose(np.dot(q.T, q), np.identity(5))
+    # q spans the same space as basis
+    proj = np.dot(q, np.dot(q.T, basis))
+    assert np.allclose(proj, basis)